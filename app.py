@@ -2,18 +2,31 @@ import os
 import time
 import logging
 import uuid
-import pandas as pd
 import threading
+import multiprocessing
+import itertools
+import shutil
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory
 from werkzeug.utils import secure_filename
-from pyxlsb import open_workbook
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
-from openpyxl.utils.dataframe import dataframe_to_rows
-from openpyxl.utils import get_column_letter
-import re
 import json
+import functools
+import fcntl
+import io
+import random
+import cProfile
+import pstats
+import tracemalloc
+from collections import OrderedDict, deque
+from apscheduler.schedulers.background import BackgroundScheduler
+import conversions
+from conversions import (
+    config, CONVERSIONS, FINAL_STATUSES, PDF_LAYOUTS_DIGEST, MemoryProgressStore, TaskProgress,
+    ResultCache, conversion_metrics, conversion_progress, convert_ofx_to_xlsx, convert_pdf_to_ofx,
+    convert_xlsb_to_xlsx_advanced, merge_ofx_to_xlsx
+)
 
 # Configurar logging
 logging.basicConfig(
@@ -26,6 +39,7 @@ logging.basicConfig(
 )
 
 UPLOAD_FOLDER = 'uploads'
+CACHE_FOLDER = 'cache'
 ALLOWED_EXTENSIONS = {
     'xlsb': {'xlsb'},
     'ofx': {'ofx', 'qfx'},
@@ -36,701 +50,502 @@ app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max
 app.secret_key = 'uma_chave_secreta_muito_segura'
+# Opções dos conversores (motores, escrita, PDF, progresso): ver conversions.config
+app.config.update(config)
+# Tamanho máximo do cache de resultados em disco (CACHE_FOLDER)
+app.config['RESULT_CACHE_MAX_BYTES'] = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+# Tamanho máximo do cache de planilhas já renderizadas (reconversão incremental)
+app.config['SHEET_CACHE_MAX_BYTES'] = int(os.environ.get('SHEET_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+# Fila de conversões: número de conversões simultâneas, tamanho máximo da
+# fila de espera e limite de conversões simultâneas por tipo
+# (ex.: 'xlsb_to_xlsx=2,pdf_to_ofx=1'; tipos ausentes usam todos os workers)
+app.config['CONVERSION_WORKERS'] = int(os.environ.get('CONVERSION_WORKERS', 4))
+app.config['CONVERSION_QUEUE_SIZE'] = int(os.environ.get('CONVERSION_QUEUE_SIZE', 64))
+# Lotes (/upload/batch): máximo de arquivos e de bytes descompactados
+app.config['BATCH_MAX_FILES'] = int(os.environ.get('BATCH_MAX_FILES', 50))
+app.config['BATCH_MAX_BYTES'] = int(os.environ.get('BATCH_MAX_BYTES', 1024 * 1024 * 1024))
+# Duração máxima de uma conexão de /progress/<task_id>/stream (o navegador
+# reconecta sozinho pelo EventSource se a conversão ainda não terminou) e
+# conexões simultâneas por processo: cada uma ocupa uma thread, e acima do
+# limite o stream responde 503 e a página passa a consultar /progress
+app.config['PROGRESS_STREAM_TIMEOUT'] = int(os.environ.get('PROGRESS_STREAM_TIMEOUT', 30))
+app.config['PROGRESS_STREAM_MAX'] = int(os.environ.get('PROGRESS_STREAM_MAX', 16))
+# Limpeza periódica de UPLOAD_FOLDER: cota em bytes, idade máxima desde o
+# último acesso, intervalo entre varreduras (0 desativa) e carência para
+# arquivos recém-acessados
+app.config['UPLOAD_QUOTA_BYTES'] = int(os.environ.get('UPLOAD_QUOTA_BYTES', 2 * 1024 * 1024 * 1024))
+app.config['UPLOAD_MAX_AGE'] = int(os.environ.get('UPLOAD_MAX_AGE', 3600))
+app.config['JANITOR_INTERVAL'] = int(os.environ.get('JANITOR_INTERVAL', 300))
+app.config['JANITOR_GRACE'] = int(os.environ.get('JANITOR_GRACE', 300))
+# Perfil de desempenho (cProfile + tracemalloc) de uma fração das conversões,
+# além das pedidas com profile=1 no upload (0 desativa a amostragem)
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['CONVERSION_TYPE_LIMITS'] = {
+    name.strip(): int(limit)
+    for name, limit in (
+        item.split('=', 1)
+        for item in os.environ.get('CONVERSION_TYPE_LIMITS', 'xlsb_to_xlsx=2').split(',')
+        if '=' in item
+    )
+}
 
 # Garantir que as pastas existam
-for folder in [UPLOAD_FOLDER, 'logs', 'templates']:
+for folder in [UPLOAD_FOLDER, CACHE_FOLDER, 'logs', 'templates']:
     os.makedirs(folder, exist_ok=True)
 
-# Dicionário para armazenar o progresso das conversões
-conversion_progress = {}
-
 def allowed_file(filename, conversion_type):
     """Verifica se a extensão do arquivo é permitida para o tipo de conversão"""
     ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
     return ext in ALLOWED_EXTENSIONS.get(conversion_type, set())
 
-def detect_formatting(value):
-    """Detecta formatação baseada no valor da célula"""
-    formatting = {
-        'font': None,
-        'fill': None,
-        'alignment': None,
-        'border': None,
-        'number_format': 'General'
-    }
+result_cache = ResultCache(CACHE_FOLDER, app.config['RESULT_CACHE_MAX_BYTES'])
+# XML de planilhas já renderizadas pelo motor 'parallel', por impressão digital
+sheet_cache = ResultCache(os.path.join(CACHE_FOLDER, 'sheets'), app.config['SHEET_CACHE_MAX_BYTES'])
+conversions.sheet_cache = sheet_cache
+
+def conversion_variant(conversion_type):
+    """Opções de configuração que alteram a saída de cada tipo de conversão"""
+    if conversion_type == 'xlsb_to_xlsx':
+        return f"{app.config['XLSB_ENGINE']}/{app.config['XLSX_WRITER']}"
+    if conversion_type == 'ofx_to_xlsx':
+        return app.config['OFX_ENGINE']
+    if conversion_type == 'pdf_to_ofx':
+        return f"{app.config['OFX_OUTPUT_VERSION']}/{app.config['PDF_LAYOUT']}/{PDF_LAYOUTS_DIGEST}"
+    return ''
+
+class UploadJanitor:
+    """Limpeza de UPLOAD_FOLDER por cota em bytes e tempo desde o último acesso.
     
-    if value is None:
-        return formatting
+    O índice em memória (tamanho e último acesso, em ordem LRU) é montado
+    uma vez ao iniciar e mantido pelo próprio app (uploads, resultados e
+    downloads); as varreduras não relistam a pasta, só conferem com os.stat
+    os arquivos que vão remover. Arquivos de tarefas na fila ou em andamento
+    em qualquer processo (active_files, lido do armazenamento de progresso)
+    e arquivos acessados há menos de grace segundos nunca são removidos.
+    Arquivos criados por outros processos entram no índice na revarredura
+    completa, feita a cada rescan_interval segundos.
+    """
     
-    try:
-        # Detectar números
-        if isinstance(value, (int, float)):
-            if isinstance(value, int):
-                formatting['number_format'] = '#,##0'
-            else:
-                if value == int(value):
-                    formatting['number_format'] = '#,##0'
-                else:
-                    formatting['number_format'] = '#,##0.00'
+    def __init__(self, folder, quota_bytes, max_age, grace, active_files, rescan_interval=3600):
+        self.folder = folder
+        self.quota_bytes = quota_bytes
+        self.max_age = max_age
+        self.grace = grace
+        self.active_files = active_files
+        self.rescan_interval = rescan_interval
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # nome do arquivo -> (tamanho, último acesso)
+        self._total_bytes = 0
+        self._last_rescan = 0.0
+        self.rescan()
+    
+    def rescan(self):
+        """Remonta o índice a partir da pasta"""
+        files = []
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((max(stat.st_mtime, stat.st_atime), entry.name, stat.st_size))
         
-        # Detectar texto longo
-        elif isinstance(value, str):
-            if len(value) > 20:
-                formatting['alignment'] = Alignment(wrap_text=True)
-            if value.isupper() or any(word in value.lower() for word in ['total', 'soma', 'quantidade', 'valor']):
-                formatting['font'] = Font(bold=True)
-                formatting['fill'] = PatternFill(start_color="DDDDDD", fill_type="solid")
-    
-    except Exception:
-        pass
+        with self._lock:
+            self._entries = OrderedDict((name, (size, access)) for access, name, size in sorted(files))
+            self._total_bytes = sum(size for size, _ in self._entries.values())
+            self._last_rescan = time.time()
     
-    return formatting
-
-def apply_formatting(cell, formatting):
-    """Aplica formatação a uma célula"""
-    try:
-        if formatting.get('font'):
-            cell.font = formatting['font']
-        if formatting.get('fill'):
-            cell.fill = formatting['fill']
-        if formatting.get('alignment'):
-            cell.alignment = formatting['alignment']
-        if formatting.get('number_format'):
-            cell.number_format = formatting['number_format']
-    except Exception as e:
-        logging.debug(f"Erro ao aplicar formatação: {e}")
-
-def parse_ofx_content(content):
-    """Parse OFX content to extract transactions - corrigido para formato brasileiro"""
-    transactions = []
-    
-    # Extrair informações do banco
-    bank_match = re.search(r'<BANKID>(\d+)', content)
-    acct_match = re.search(r'<ACCTID>([^<\n]+)', content)
-    
-    bank_id = bank_match.group(1) if bank_match else "0001"
-    account_id = acct_match.group(1) if acct_match else "000000001"
-    
-    # Encontrar todas as transações
-    stmttrn_blocks = re.findall(r'<STMTTRN>(.*?)</STMTTRN>', content, re.DOTALL)
-    
-    for block in stmttrn_blocks:
-        # Extrair campos da transação
-        trntype_match = re.search(r'<TRNTYPE>([^<\n]+)', block)
-        dtposted_match = re.search(r'<DTPOSTED>([^<\n]+)', block)
-        trnamt_match = re.search(r'<TRNAMT>([^<\n]+)', block)
-        memo_match = re.search(r'<MEMO>([^<\n]*)', block)
-        fitid_match = re.search(r'<FITID>([^<\n]+)', block)
-        checknum_match = re.search(r'<CHECKNUM>([^<\n]+)', block)
+    def track(self, filename):
+        """Registra (ou atualiza) um arquivo gravado pelo app"""
+        try:
+            size = os.path.getsize(os.path.join(self.folder, filename))
+        except OSError:
+            return
+        with self._lock:
+            if filename in self._entries:
+                self._total_bytes -= self._entries[filename][0]
+            self._entries[filename] = (size, time.time())
+            self._entries.move_to_end(filename)
+            self._total_bytes += size
+    
+    def touch(self, filename):
+        """Marca o arquivo como recém-acessado (download)"""
+        with self._lock:
+            if filename in self._entries:
+                self._entries[filename] = (self._entries[filename][0], time.time())
+                self._entries.move_to_end(filename)
+    
+    def sweep(self):
+        """Remove os arquivos expirados e, acima da cota, os menos acessados"""
+        if time.time() - self._last_rescan > self.rescan_interval:
+            self.rescan()
         
-        if trntype_match and dtposted_match and trnamt_match:
-            trntype = trntype_match.group(1).strip()
-            dtposted = dtposted_match.group(1).strip()
-            trnamt = trnamt_match.group(1).strip()
-            memo = memo_match.group(1).strip() if memo_match else ''
-            fitid = fitid_match.group(1).strip() if fitid_match else ''
-            checknum = checknum_match.group(1).strip() if checknum_match else ''
-            
-            # Converter valor - tratar vírgula como separador decimal (formato brasileiro)
-            try:
-                # Remover quebras de linha e espaços
-                trnamt_clean = trnamt.replace('\n', '').replace('\r', '').replace(' ', '')
-                # Substituir vírgula por ponto para conversão
-                trnamt_clean = trnamt_clean.replace(',', '.')
-                # Remover pontos de milhar se existirem
-                if trnamt_clean.count('.') > 1:
-                    # Se houver mais de um ponto, manter apenas o último como decimal
-                    parts = trnamt_clean.split('.')
-                    if len(parts) > 2:
-                        trnamt_clean = ''.join(parts[:-1]) + '.' + parts[-1]
-                valor = float(trnamt_clean)
-            except Exception as e:
-                logging.warning(f"Erro ao converter valor '{trnamt}': {e}")
-                valor = 0.0
-            
-            # Converter data OFX para formato legível
-            # Formato OFX: YYYYMMDDHHMMSS
-            if dtposted and len(dtposted) >= 8:
+        removed = 0
+        held = self.active_files()
+        now = time.time()
+        with self._lock:
+            for filename, (size, access) in list(self._entries.items()):
+                expired = now - access > self.max_age
+                if not expired and self._total_bytes <= self.quota_bytes:
+                    break
+                if now - access < self.grace:
+                    break
+                if filename in held:
+                    continue
+                
+                # Outro processo pode ter regravado o arquivo desde o registro
+                path = os.path.join(self.folder, filename)
                 try:
-                    dtposted_formatted = f"{dtposted[0:4]}-{dtposted[4:6]}-{dtposted[6:8]}"
-                except:
-                    dtposted_formatted = dtposted
-            else:
-                dtposted_formatted = dtposted
-            
-            transactions.append({
-                'Data': dtposted_formatted,
-                'Tipo': trntype,
-                'Valor': valor,
-                'Descrição': memo,
-                'ID': fitid,
-                'Cheque': checknum,
-                'Banco': bank_id,
-                'Conta': account_id
-            })
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    self._total_bytes -= self._entries.pop(filename)[0]
+                    continue
+                if stat.st_mtime > access + 1:
+                    self._total_bytes += stat.st_size - size
+                    self._entries[filename] = (stat.st_size, stat.st_mtime)
+                    self._entries.move_to_end(filename)
+                    continue
+                
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logging.warning(f"Erro ao remover {filename}: {e}")
+                    continue
+                self._total_bytes -= self._entries.pop(filename)[0]
+                removed += 1
+        
+        if removed:
+            logging.info(f"Limpeza de {self.folder}: {removed} arquivos removidos")
+        return removed
     
-    return transactions
+    def stats(self):
+        with self._lock:
+            return {
+                'files': len(self._entries),
+                'size_bytes': self._total_bytes,
+                'quota_bytes': self.quota_bytes,
+                'held': len(self.active_files())
+            }
 
-def convert_ofx_to_xlsx(filepath_in, filepath_out, task_id):
-    """Converte arquivo OFX para XLSX"""
-    try:
-        logging.info(f"Iniciando conversão OFX para XLSX: {filepath_in}")
-        
-        conversion_progress[task_id] = {
-            'status': 'iniciando',
-            'progress': 0,
-            'message': 'Iniciando conversão OFX...',
-            'filename': None,
-            'error': None,
-            'start_time': datetime.now().isoformat()
-        }
-        
-        if not os.path.exists(filepath_in):
-            raise FileNotFoundError(f"Arquivo não encontrado: {filepath_in}")
-        
-        file_size = os.path.getsize(filepath_in)
-        conversion_progress[task_id].update({
-            'progress': 10,
-            'message': f'Arquivo OFX carregado ({file_size / 1024:.1f} KB)'
-        })
-        
-        # Ler conteúdo do arquivo OFX
-        with open(filepath_in, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
-        
-        conversion_progress[task_id].update({
-            'progress': 30,
-            'message': 'Analisando transações OFX...'
-        })
-        
-        # Parse do conteúdo OFX
-        transactions = parse_ofx_content(content)
-        
-        if not transactions:
-            # Tentar parse alternativo
-            transactions = parse_ofx_alternative(content)
-        
-        conversion_progress[task_id].update({
-            'progress': 60,
-            'message': f'{len(transactions)} transações encontradas'
-        })
-        
-        if not transactions:
-            raise Exception("Nenhuma transação encontrada no arquivo OFX")
-        
-        # Criar DataFrame
-        df = pd.DataFrame(transactions)
-        
-        # Ordenar por data
-        if 'Data' in df.columns:
-            df = df.sort_values('Data')
-        
-        conversion_progress[task_id].update({
-            'progress': 80,
-            'message': 'Criando arquivo Excel...'
-        })
-        
-        # Criar arquivo Excel
-        with pd.ExcelWriter(filepath_out, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Transações', index=False)
-            
-            # Formatação básica
-            workbook = writer.book
-            worksheet = writer.sheets['Transações']
-            
-            # Formatar coluna de valor como moeda brasileira
-            for row in range(2, len(df) + 2):  # +2 porque a linha 1 é o cabeçalho
-                cell = worksheet.cell(row=row, column=3)  # Coluna C é Valor
-                cell.number_format = '"R$" #,##0.00'
-            
-            # Ajustar largura das colunas
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = get_column_letter(column[0].column)
-                for cell in column:
-                    try:
-                        if cell.value:
-                            max_length = max(max_length, len(str(cell.value)))
-                    except:
-                        pass
-                adjusted_width = min(max(max_length + 2, 10), 50)
-                worksheet.column_dimensions[column_letter].width = adjusted_width
-            
-            # Adicionar bordas
-            thin_border = Border(
-                left=Side(style='thin'),
-                right=Side(style='thin'),
-                top=Side(style='thin'), 
-                bottom=Side(style='thin')
-            )
-            
-            for row in worksheet.iter_rows(min_row=1, max_row=worksheet.max_row, min_col=1, max_col=worksheet.max_column):
-                for cell in row:
-                    cell.border = thin_border
-            
-            # Formatar cabeçalho
-            for cell in worksheet[1]:
-                cell.font = Font(bold=True)
-                cell.fill = PatternFill(start_color="DDDDDD", fill_type="solid")
-        
-        conversion_progress[task_id].update({
-            'progress': 100,
-            'message': f'Conversão concluída! {len(transactions)} transações processadas',
-            'status': 'completo',
-            'filename': os.path.basename(filepath_out),
-            'end_time': datetime.now().isoformat()
-        })
-        
-        logging.info(f"Conversão OFX->XLSX bem-sucedida: {filepath_out}")
-        
-    except Exception as e:
-        error_msg = f"Erro na conversão OFX: {str(e)}"
-        logging.error(error_msg)
-        conversion_progress[task_id].update({
-            'status': 'erro',
-            'message': error_msg,
-            'error': str(e),
-            'end_time': datetime.now().isoformat()
-        })
+upload_janitor = UploadJanitor(
+    UPLOAD_FOLDER,
+    app.config['UPLOAD_QUOTA_BYTES'],
+    app.config['UPLOAD_MAX_AGE'],
+    app.config['JANITOR_GRACE'],
+    conversion_progress.active_files
+)
+
+def run_janitor():
+    """Tarefa agendada: uma varredura por vez entre os processos do servidor"""
+    with open(os.path.join('logs', 'janitor.lock'), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        try:
+            upload_janitor.sweep()
+        except Exception as e:
+            logging.error(f"Erro na limpeza de {UPLOAD_FOLDER}: {e}")
+
+background_scheduler = BackgroundScheduler(daemon=True)
+if app.config['JANITOR_INTERVAL'] > 0:
+    background_scheduler.add_job(
+        run_janitor, 'interval',
+        seconds=app.config['JANITOR_INTERVAL'],
+        id='upload_janitor', max_instances=1, coalesce=True
+    )
+    background_scheduler.start()
+
+# Intervalo entre as verificações do pico de memória durante um perfil e
+# quantidade de funções e de locais de alocação no relatório
+PROFILE_SNAPSHOT_INTERVAL = 0.5
+PROFILE_TOP_FUNCTIONS = 40
+PROFILE_TOP_ALLOCATIONS = 25
 
-def parse_ofx_alternative(content):
-    """Método alternativo para parse de OFX"""
-    transactions = []
+class ForwardedProgressStore(MemoryProgressStore):
+    """Progresso de uma conversão executada no processo de perfil.
     
-    # Encontrar blocos STMTTRN
-    start_pos = 0
-    while True:
-        start_idx = content.find('<STMTTRN>', start_pos)
-        if start_idx == -1:
-            break
-            
-        end_idx = content.find('</STMTTRN>', start_idx)
-        if end_idx == -1:
-            break
-            
-        block = content[start_idx:end_idx + 10]  # +10 para incluir </STMTTRN>
-        
-        # Extrair campos manualmente
-        fields = {}
-        lines = block.split('\n')
-        for line in lines:
-            line = line.strip()
-            if line.startswith('<') and '>' in line:
-                tag_end = line.find('>')
-                tag = line[1:tag_end]
-                value = line[tag_end + 1:].strip()
-                fields[tag] = value
-        
-        if 'TRNTYPE' in fields and 'DTPOSTED' in fields and 'TRNAMT' in fields:
-            # Converter valor
-            trnamt = fields['TRNAMT'].replace(',', '.')
-            try:
-                # Se houver mais de um ponto, é formato com milhar
-                if trnamt.count('.') > 1:
-                    # Remover todos os pontos e adicionar apenas o decimal
-                    parts = trnamt.split('.')
-                    if len(parts) > 2:
-                        trnamt = ''.join(parts[:-1]) + '.' + parts[-1]
-                valor = float(trnamt)
-            except:
-                valor = 0.0
-            
-            # Formatar data
-            dtposted = fields['DTPOSTED']
-            if len(dtposted) >= 8:
-                dtposted_formatted = f"{dtposted[0:4]}-{dtposted[4:6]}-{dtposted[6:8]}"
-            else:
-                dtposted_formatted = dtposted
-            
-            transactions.append({
-                'Data': dtposted_formatted,
-                'Tipo': fields.get('TRNTYPE', ''),
-                'Valor': valor,
-                'Descrição': fields.get('MEMO', ''),
-                'ID': fields.get('FITID', ''),
-                'Cheque': fields.get('CHECKNUM', ''),
-                'Banco': '0001',
-                'Conta': '000000001'
-            })
-        
-        start_pos = end_idx + 10
+    Guarda as entradas em memória, como MemoryProgressStore, e repassa cada
+    alteração pela fila ao processo do servidor, onde relay_progress a
+    aplica em conversion_progress.
+    """
     
-    return transactions
-
-def extract_data_from_pdf(filepath_in):
-    """Extrai dados de PDF (implementação básica - precisa ser expandida)"""
-    # Esta é uma implementação simplificada
-    # Na prática, você precisaria de uma biblioteca como pdfplumber ou PyPDF2
-    # e implementar a lógica específica para seus PDFs
+    def __init__(self, ttl, updates, entries):
+        super().__init__(ttl)
+        self._updates = updates
+        for task_id, data in entries.items():
+            self._entries[task_id] = TaskProgress(self, task_id, data)
     
-    transactions = []
+    def update(self, task_id, changes):
+        super().update(task_id, changes)
+        self._updates.put((task_id, dict(changes), False))
     
+    def __setitem__(self, task_id, data):
+        self._entries[task_id] = TaskProgress(self, task_id, data)
+        super().update(task_id, data)
+        self._updates.put((task_id, dict(data), True))
+
+def init_profile_worker(updates, entries):
+    """Inicializador do processo de perfil: progresso repassado pela fila"""
+    conversions.conversion_progress = ForwardedProgressStore(app.config['PROGRESS_TTL'], updates, entries)
+
+def relay_progress(updates):
+    """Aplica em conversion_progress as alterações vindas do processo de perfil até receber None"""
+    while True:
+        item = updates.get()
+        if item is None:
+            return
+        task_id, data, replace = item
+        if replace or task_id not in conversion_progress:
+            conversion_progress[task_id] = data
+        else:
+            conversion_progress[task_id].update(data)
+
+def profile_paths(task_id):
+    """Arquivos do perfil de uma tarefa: (dump do pstats, relatório em texto)"""
+    base = os.path.join(app.config['UPLOAD_FOLDER'], f'profile_{secure_filename(task_id)}')
+    return f'{base}.prof', f'{base}.txt'
+
+def profile_conversion(conversion_func, filepath_in, filepath_out, task_id):
+    """Executa a conversão com perfil em um processo separado; indica se o perfil foi gravado.
+    
+    cProfile e tracemalloc valem para o processo inteiro; no processo de
+    perfil eles medem apenas esta conversão, e as demais conversões do
+    servidor seguem sem o custo da instrumentação. O progresso volta pela
+    fila (ForwardedProgressStore). As métricas da conversão ficam no processo
+    de perfil e não entram em /metrics, já que o cProfile distorce os tempos.
+    """
+    entries = {task_id: dict(conversion_progress[task_id])} if task_id in conversion_progress else {}
+    updates = multiprocessing.Queue()
+    relay = threading.Thread(target=relay_progress, args=(updates,), daemon=True)
+    relay.start()
     try:
-        # Para demonstração, criamos dados de exemplo
-        # Em produção, substitua por extração real do PDF
-        
-        # Exemplo de transações
-        transactions = [
-            {
-                'Data': '2024-01-15',
-                'Tipo': 'DEBIT',
-                'Valor': -150.00,
-                'Descrição': 'Supermercado',
-                'Categoria': 'Alimentação'
-            },
-            {
-                'Data': '2024-01-16',
-                'Tipo': 'CREDIT',
-                'Valor': 3000.00,
-                'Descrição': 'Salário',
-                'Categoria': 'Receita'
-            },
-            {
-                'Data': '2024-01-17',
-                'Tipo': 'DEBIT',
-                'Valor': -89.90,
-                'Descrição': 'Combustível',
-                'Categoria': 'Transporte'
-            }
-        ]
-        
+        with ProcessPoolExecutor(max_workers=1, initializer=init_profile_worker, initargs=(updates, entries)) as executor:
+            paths = executor.submit(write_profile, conversion_func, filepath_in, filepath_out, task_id).result()
     except Exception as e:
-        logging.error(f"Erro ao extrair dados do PDF: {e}")
+        logging.error(f"Erro no processo de perfil da tarefa {task_id}: {e}")
+        paths = ()
+        if task_id in conversion_progress:
+            conversion_progress[task_id].update({
+                'status': 'erro',
+                'message': f'Erro na conversão com perfil: {e}',
+                'error': str(e),
+                'end_time': datetime.now().isoformat()
+            })
+    finally:
+        # O processo de perfil já terminou: o None chega depois das últimas alterações
+        updates.put(None)
+        relay.join()
     
-    return transactions
+    for path in paths:
+        upload_janitor.track(os.path.basename(path))
+    return bool(paths)
 
-def generate_ofx_from_data(transactions, account_info=None):
-    """Gera conteúdo OFX a partir de dados de transações"""
+def write_profile(conversion_func, filepath_in, filepath_out, task_id):
+    """Executa a conversão sob cProfile e tracemalloc e grava o perfil em UPLOAD_FOLDER.
     
-    if account_info is None:
-        account_info = {
-            'bank_id': '0001',
-            'account_id': '000000001',
-            'account_type': 'CHECKING'
-        }
+    Roda no processo de perfil. O relatório traz as funções com maior tempo
+    acumulado e os locais com mais memória alocada no pico da conversão
+    (instantâneo tirado sempre que a memória rastreada cresce). Devolve os
+    caminhos do dump do pstats e do relatório.
+    """
+    profiler = cProfile.Profile()
+    peak = {'bytes': 0, 'snapshot': None}
+    finished = threading.Event()
     
-    # Header OFX
-    ofx_content = """OFXHEADER:100
-DATA:OFXSGML
-VERSION:102
-SECURITY:NONE
-ENCODING:USASCII
-CHARSET:1252
-COMPRESSION:NONE
-OLDFILEUID:NONE
-NEWFILEUID:NONE
-
-<OFX>
-    <SIGNONMSGSRSV1>
-        <SONRS>
-            <STATUS>
-                <CODE>0
-                <SEVERITY>INFO
-            </STATUS>
-            <DTSERVER>""" + datetime.now().strftime("%Y%m%d%H%M%S") + """
-            <LANGUAGE>POR
-            <FI>
-                <ORG>Banco Exemplo
-                <FID>""" + account_info['bank_id'] + """
-            </FI>
-        </SONRS>
-    </SIGNONMSGSRSV1>
-    <BANKMSGSRSV1>
-        <STMTTRNRS>
-            <TRNUID>1001
-            <STATUS>
-                <CODE>0
-                <SEVERITY>INFO
-            </STATUS>
-            <STMTRS>
-                <CURDEF>BRL
-                <BANKACCTFROM>
-                    <BANKID>""" + account_info['bank_id'] + """
-                    <ACCTID>""" + account_info['account_id'] + """
-                    <ACCTTYPE>""" + account_info['account_type'] + """
-                </BANKACCTFROM>
-                <BANKTRANLIST>
-"""
-    
-    # Adicionar transações
-    for i, trans in enumerate(transactions):
-        # Converter data para formato OFX
-        dtposted = trans.get('Data', '').replace('-', '')
-        if len(dtposted) == 10:  # YYYY-MM-DD
-            dtposted += "000000"  # Adicionar hora se necessário
-        
-        trntype = trans.get('Tipo', 'OTHER').upper()
-        trnamt = trans.get('Valor', 0)
-        memo = trans.get('Descrição', '')
-        
-        # Formatar valor com vírgula (formato brasileiro)
-        trnamt_formatted = f"{trnamt:,.2f}".replace(',', 'X').replace('.', ',').replace('X', '.')
-        
-        ofx_content += f"""                    <STMTTRN>
-                        <TRNTYPE>{trntype}
-                        <DTPOSTED>{dtposted}
-                        <TRNAMT>{trnamt_formatted}
-                        <FITID>{i+1:08d}
-                        <MEMO>{memo}
-                    </STMTTRN>
-"""
-    
-    # Footer OFX
-    ofx_content += """                </BANKTRANLIST>
-                <LEDGERBAL>
-                    <BALAMT>0.00
-                    <DTASOF>""" + datetime.now().strftime("%Y%m%d%H%M%S") + """
-                </LEDGERBAL>
-            </STMTRS>
-        </STMTTRNRS>
-    </BANKMSGSRSV1>
-</OFX>"""
-    
-    return ofx_content
-
-def convert_pdf_to_ofx(filepath_in, filepath_out, task_id):
-    """Converte arquivo PDF para OFX"""
+    def watch_peak():
+        while True:
+            current, _ = tracemalloc.get_traced_memory()
+            if current > peak['bytes'] * 1.1:
+                peak['bytes'] = current
+                peak['snapshot'] = tracemalloc.take_snapshot()
+            if finished.wait(PROFILE_SNAPSHOT_INTERVAL):
+                return
+    
+    tracemalloc.start()
+    watcher = threading.Thread(target=watch_peak, daemon=True)
+    watcher.start()
+    start = time.perf_counter()
     try:
-        logging.info(f"Iniciando conversão PDF para OFX: {filepath_in}")
-        
-        conversion_progress[task_id] = {
-            'status': 'iniciando',
-            'progress': 0,
-            'message': 'Iniciando conversão PDF...',
-            'filename': None,
-            'error': None,
-            'start_time': datetime.now().isoformat()
-        }
-        
-        if not os.path.exists(filepath_in):
-            raise FileNotFoundError(f"Arquivo não encontrado: {filepath_in}")
-        
-        file_size = os.path.getsize(filepath_in)
-        conversion_progress[task_id].update({
-            'progress': 10,
-            'message': f'Arquivo PDF carregado ({file_size / 1024:.1f} KB)'
-        })
-        
-        # Extrair dados do PDF
-        conversion_progress[task_id].update({
-            'progress': 30,
-            'message': 'Extraindo dados do PDF...'
-        })
-        
-        transactions = extract_data_from_pdf(filepath_in)
-        
-        conversion_progress[task_id].update({
-            'progress': 60,
-            'message': f'{len(transactions)} transações extraídas'
-        })
-        
-        # Gerar arquivo OFX
-        conversion_progress[task_id].update({
-            'progress': 80,
-            'message': 'Gerando arquivo OFX...'
-        })
-        
-        ofx_content = generate_ofx_from_data(transactions)
-        
-        # Salvar arquivo OFX
-        with open(filepath_out, 'w', encoding='utf-8') as f:
-            f.write(ofx_content)
-        
-        conversion_progress[task_id].update({
-            'progress': 100,
-            'message': f'Conversão concluída! Arquivo OFX gerado',
-            'status': 'completo',
-            'filename': os.path.basename(filepath_out),
-            'end_time': datetime.now().isoformat()
-        })
-        
-        logging.info(f"Conversão PDF->OFX bem-sucedida: {filepath_out}")
-        
-    except Exception as e:
-        error_msg = f"Erro na conversão PDF: {str(e)}"
-        logging.error(error_msg)
-        conversion_progress[task_id].update({
-            'status': 'erro',
-            'message': error_msg,
-            'error': str(e),
-            'end_time': datetime.now().isoformat()
-        })
+        profiler.runcall(conversion_func, filepath_in, filepath_out, task_id)
+    finally:
+        seconds = time.perf_counter() - start
+        finished.set()
+        watcher.join()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        snapshot = peak['snapshot'] or tracemalloc.take_snapshot()
+        tracemalloc.stop()
+    
+    stats_path, report_path = profile_paths(task_id)
+    profiler.dump_stats(stats_path)
+    
+    report = io.StringIO()
+    report.write(f"Perfil da tarefa {task_id}\n")
+    report.write(f"Arquivo: {os.path.basename(filepath_in)} ({os.path.getsize(filepath_in) / 1024 / 1024:.2f} MB)\n")
+    report.write(f"Tempo total: {seconds:.2f} s\n")
+    report.write(f"Pico de memória rastreada: {peak_bytes / 1024 / 1024:.1f} MB\n\n")
+    report.write("== Funções por tempo acumulado (cProfile) ==\n")
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+    report.write("== Maiores alocações no pico de memória (tracemalloc) ==\n")
+    statistics = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib*')
+    ]).statistics('lineno')
+    for stat in statistics[:PROFILE_TOP_ALLOCATIONS]:
+        frame = stat.traceback[0]
+        report.write(f"{stat.size / 1024:>12.1f} KB {stat.count:>10} blocos  {frame.filename}:{frame.lineno}\n")
+    
+    with open(report_path, 'w', encoding='utf-8') as f:
+        f.write(report.getvalue())
+    logging.info(f"Perfil da tarefa {task_id} gravado em {report_path}")
+    return stats_path, report_path
+
+def profiling_requested():
+    """Perfil pedido no upload (profile=1) ou sorteado por PROFILE_SAMPLE_RATE"""
+    if request.values.get('profile', '').lower() in ('1', 'true', 'sim'):
+        return True
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    return rate > 0 and random.random() < rate
 
-def convert_xlsb_to_xlsx_advanced(filepath_in, filepath_out, task_id):
-    """Conversão avançada que preserva dados e estrutura"""
+def run_conversion(conversion_func, filepath_in, filepath_out, task_id, cache_key, output_extension, profile=False):
+    """Executa a conversão e guarda o resultado no cache quando concluída"""
     try:
-        logging.info(f"Iniciando conversão avançada: {filepath_in} -> {filepath_out}")
-        
-        conversion_progress[task_id] = {
-            'status': 'iniciando',
-            'progress': 0,
-            'message': 'Iniciando conversão...',
-            'filename': None,
-            'error': None,
-            'start_time': datetime.now().isoformat()
-        }
-        
-        # Verificar se arquivo existe
-        if not os.path.exists(filepath_in):
-            raise FileNotFoundError(f"Arquivo não encontrado: {filepath_in}")
-        
-        file_size = os.path.getsize(filepath_in)
-        conversion_progress[task_id].update({
-            'progress': 10,
-            'message': f'Arquivo carregado ({file_size / 1024 / 1024:.1f} MB)'
-        })
-        
-        # Método 1: Tentar com pandas + openpyxl
+        if profile:
+            profile = profile_conversion(conversion_func, filepath_in, filepath_out, task_id)
+        else:
+            conversion_func(filepath_in, filepath_out, task_id)
+    finally:
+        upload_janitor.track(os.path.basename(filepath_out))
+    
+    if profile and task_id in conversion_progress:
+        conversion_progress[task_id].update({'profile_url': f'/profile/{task_id}'})
+    
+    # Resultados do método alternativo (fallback) não são guardados
+    progress = conversion_progress.get(task_id, {})
+    if progress.get('status') == 'completo' and not progress.get('fallback'):
         try:
-            conversion_progress[task_id].update({
-                'progress': 20,
-                'message': 'Lendo estrutura do arquivo XLSB...'
-            })
-            
-            # Ler metadados do arquivo
-            xlsb_file = pd.ExcelFile(filepath_in, engine='pyxlsb')
-            sheet_names = xlsb_file.sheet_names
-            
-            conversion_progress[task_id].update({
-                'progress': 30,
-                'message': f'Encontradas {len(sheet_names)} planilhas'
-            })
-            
-            # Criar workbook de saída
-            wb_out = Workbook()
-            # Remover sheet padrão
-            wb_out.remove(wb_out.active)
-            
-            # Processar cada planilha
-            for sheet_idx, sheet_name in enumerate(sheet_names):
-                progress = 30 + (sheet_idx * 60 / len(sheet_names))
-                conversion_progress[task_id].update({
-                    'progress': progress,
-                    'message': f'Processando: {sheet_name}'
-                })
-                
-                try:
-                    # Ler dados mantendo tipos originais
-                    df = pd.read_excel(
-                        filepath_in, 
-                        sheet_name=sheet_name, 
-                        engine='pyxlsb',
-                        dtype=object,
-                        keep_default_na=False
-                    )
-                    
-                    # Criar nova planilha
-                    ws_out = wb_out.create_sheet(title=sheet_name[:31])
-                    
-                    # Escrever dados
-                    for row_idx, row in enumerate(dataframe_to_rows(df, index=False, header=True), 1):
-                        for col_idx, value in enumerate(row, 1):
-                            cell = ws_out.cell(row=row_idx, column=col_idx, value=value)
-                            
-                            # Aplicar formatação detectada
-                            formatting = detect_formatting(value)
-                            apply_formatting(cell, formatting)
-                    
-                    # Ajustar largura das colunas
-                    for column in ws_out.columns:
-                        max_length = 0
-                        column_letter = get_column_letter(column[0].column)
-                        
-                        for cell in column:
-                            try:
-                                if cell.value:
-                                    length = len(str(cell.value))
-                                    max_length = max(max_length, length)
-                            except:
-                                pass
-                        
-                        adjusted_width = min(max(max_length + 2, 8), 50)
-                        ws_out.column_dimensions[column_letter].width = adjusted_width
-                    
-                    # Adicionar bordas básicas
-                    thin_border = Border(
-                        left=Side(style='thin'),
-                        right=Side(style='thin'),
-                        top=Side(style='thin'), 
-                        bottom=Side(style='thin')
-                    )
-                    
-                    for row in ws_out.iter_rows(min_row=1, max_row=ws_out.max_row, min_col=1, max_col=ws_out.max_column):
-                        for cell in row:
-                            if cell.value is not None:
-                                cell.border = thin_border
-                    
-                    logging.info(f"Planilha {sheet_name} processada com sucesso")
-                    
-                except Exception as e:
-                    logging.error(f"Erro na planilha {sheet_name}: {e}")
-                    # Criar planilha vazia como fallback
-                    ws_out = wb_out.create_sheet(title=sheet_name[:31])
-                    ws_out.cell(1, 1, value=f"Erro ao processar: {str(e)}")
-                    continue
-                
-                time.sleep(0.1)
-            
-            # Salvar arquivo
-            conversion_progress[task_id].update({
-                'progress': 95,
-                'message': 'Salvando arquivo XLSX...'
-            })
-            
-            wb_out.save(filepath_out)
-            
-            # Verificar se arquivo foi criado
-            if os.path.exists(filepath_out):
-                output_size = os.path.getsize(filepath_out)
-                conversion_progress[task_id].update({
-                    'progress': 100,
-                    'message': f'Conversão concluída! ({output_size / 1024 / 1024:.1f} MB)',
-                    'status': 'completo',
-                    'filename': os.path.basename(filepath_out),
-                    'end_time': datetime.now().isoformat()
-                })
-                logging.info(f"Conversão bem-sucedida: {filepath_out}")
-            else:
-                raise Exception("Arquivo de saída não foi criado")
-                
+            result_cache.put(cache_key, output_extension, filepath_out)
         except Exception as e:
-            logging.error(f"Erro no método principal: {e}")
-            
-            # Método 2: Fallback simples
-            conversion_progress[task_id].update({
-                'progress': 50,
-                'message': 'Usando método alternativo...'
-            })
+            logging.warning(f"Erro ao gravar resultado no cache: {e}")
+
+class QueueFullError(Exception):
+    """Fila de conversões cheia"""
+
+class ConversionScheduler:
+    """Fila de conversões com número fixo de workers e limite por tipo.
+    
+    Os jobs esperam em ordem de chegada; um worker livre pega o primeiro job
+    cujo tipo ainda está abaixo do limite, de modo que conversões leves (OFX)
+    não ficam presas atrás de XLSB pesados. Com a fila cheia, submit levanta
+    QueueFullError.
+    """
+    
+    def __init__(self, workers, max_queue, type_limits=None):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.type_limits = dict(type_limits or {})
+        self._cond = threading.Condition()
+        self._queue = deque()  # (task_id, conversion_type, target, args, enqueued_at)
+        self._running = {}     # tipo de conversão -> conversões em andamento
+        self._threads = []
+        self._completed = 0
+        self._total_wait = 0.0
+        self._last_wait = 0.0
+    
+    def _start(self):
+        # Workers criados no primeiro uso, para não iniciar threads na importação
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+    
+    def submit(self, task_id, conversion_type, target, args):
+        """Enfileira a conversão e devolve a posição na fila (1 = próxima)"""
+        return self.submit_many([(task_id, conversion_type, target, args)])[0]
+    
+    def submit_many(self, jobs):
+        """Enfileira todas as conversões ou nenhuma; devolve as posições na fila"""
+        with self._cond:
+            if len(self._queue) + len(jobs) > self.max_queue:
+                raise QueueFullError(f'Fila de conversões cheia ({self.max_queue} tarefas aguardando)')
+            if not jobs:
+                return []
+            self._start()
+            first = len(self._queue) + 1
+            now = time.monotonic()
+            for task_id, conversion_type, target, args in jobs:
+                self._queue.append((task_id, conversion_type, target, args, now))
+            self._publish_positions(first)
+            self._cond.notify(len(jobs))
+            return list(range(first, len(self._queue) + 1))
+    
+    def _publish_positions(self, start=1):
+        # A posição vai para o armazenamento de progresso, visível a todos os processos
+        for position, job in enumerate(itertools.islice(self._queue, start - 1, None), start):
+            if job[0] in conversion_progress:
+                conversion_progress[job[0]].update({
+                    'queue_position': position,
+                    'message': f'Aguardando na fila de conversão (posição {position})'
+                })
+    
+    def _next_job(self):
+        for index, job in enumerate(self._queue):
+            limit = self.type_limits.get(job[1], self.workers)
+            if self._running.get(job[1], 0) < limit:
+                del self._queue[index]
+                self._publish_positions(index + 1)
+                return job
+        return None
+    
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                task_id, conversion_type, target, args, enqueued_at = job
+                self._running[conversion_type] = self._running.get(conversion_type, 0) + 1
+                wait = time.monotonic() - enqueued_at
+                self._total_wait += wait
+                self._last_wait = wait
             
             try:
-                xlsb_file = pd.ExcelFile(filepath_in, engine='pyxlsb')
-                sheet_names = xlsb_file.sheet_names
-                
-                with pd.ExcelWriter(filepath_out, engine='openpyxl') as writer:
-                    for i, sheet_name in enumerate(sheet_names):
-                        df = pd.read_excel(filepath_in, sheet_name=sheet_name, engine='pyxlsb')
-                        df.to_excel(writer, sheet_name=sheet_name, index=False)
-                
-                conversion_progress[task_id].update({
-                    'progress': 100,
-                    'message': 'Conversão concluída (método simples)',
-                    'status': 'completo', 
-                    'filename': os.path.basename(filepath_out),
-                    'end_time': datetime.now().isoformat()
-                })
-                
-            except Exception as fallback_error:
-                raise Exception(f"Todos os métodos falharam: {str(e)} -> {str(fallback_error)}")
-        
-    except Exception as e:
-        error_msg = f"Erro na conversão: {str(e)}"
-        logging.error(error_msg)
-        conversion_progress[task_id].update({
-            'status': 'erro',
-            'message': error_msg,
-            'error': str(e),
-            'end_time': datetime.now().isoformat()
-        })
+                if task_id in conversion_progress:
+                    conversion_progress[task_id].update({
+                        'status': 'iniciando',
+                        'message': 'Preparando conversão...',
+                        'queue_position': None,
+                        'queue_wait': round(wait, 3)
+                    })
+                target(*args)
+            except Exception as e:
+                logging.error(f"Erro na tarefa {task_id}: {e}")
+            finally:
+                with self._cond:
+                    self._running[conversion_type] -= 1
+                    self._completed += 1
+                    self._cond.notify_all()
+    
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            started = self._completed + sum(self._running.values())
+            return {
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'type_limits': self.type_limits,
+                'queue_depth': len(self._queue),
+                'running': {name: count for name, count in self._running.items() if count},
+                'completed': self._completed,
+                'oldest_wait_seconds': round(now - self._queue[0][4], 3) if self._queue else 0.0,
+                'last_wait_seconds': round(self._last_wait, 3),
+                'avg_wait_seconds': round(self._total_wait / started, 3) if started else 0.0
+            }
+
+scheduler = ConversionScheduler(
+    app.config['CONVERSION_WORKERS'],
+    app.config['CONVERSION_QUEUE_SIZE'],
+    app.config['CONVERSION_TYPE_LIMITS']
+)
 
 @app.route('/')
 def index():
@@ -755,6 +570,78 @@ def upload_pdf_file():
     """Endpoint para upload de arquivos PDF"""
     return handle_upload('pdf_to_ofx', convert_pdf_to_ofx, '.ofx')
 
+def create_task(filename, conversion_type, conversion_func, output_extension, profile=False):
+    """Registra a conversão de um arquivo já salvo em UPLOAD_FOLDER.
+    
+    Devolve (dados da tarefa, job). Quando o resultado vem do cache, a
+    tarefa já nasce concluída e job é None; senão job é a tupla a ser
+    enfileirada em scheduler.submit/submit_many. Com profile, a conversão
+    roda sempre (sem consultar o cache) sob profile_conversion.
+    """
+    task_id = str(uuid.uuid4())
+    filepath_in = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    upload_janitor.track(filename)
+    
+    # Criar nome do arquivo de saída
+    base_name = os.path.splitext(filename)[0]
+    filename_out = f"{base_name}{output_extension}"
+    filepath_out = os.path.join(app.config['UPLOAD_FOLDER'], filename_out)
+    
+    # Informações iniciais
+    input_size = os.path.getsize(filepath_in)
+    details = {
+        'input_file': filename,
+        'input_size': f"{input_size / 1024 / 1024:.2f} MB",
+        'conversion_type': conversion_type
+    }
+    task = {
+        'task_id': task_id,
+        'filename': filename_out,
+        'conversion_type': conversion_type
+    }
+    
+    # Mesma entrada já convertida: devolve o resultado sem iniciar a conversão
+    cache_key = result_cache.make_key(filepath_in, conversion_type, conversion_variant(conversion_type))
+    if not profile and result_cache.get(cache_key, output_extension, filepath_out):
+        upload_janitor.track(filename_out)
+        now = datetime.now().isoformat()
+        conversion_progress[task_id] = {
+            'status': 'completo',
+            'progress': 100,
+            'message': 'Conversão concluída! (resultado em cache)',
+            'filename': filename_out,
+            'error': None,
+            'start_time': now,
+            'end_time': now,
+            'details': dict(details, cache='hit')
+        }
+        logging.info(f"Resultado em cache para {filename}: {filename_out}")
+        return dict(task, cached=True), None
+    
+    conversion_progress[task_id] = {
+        'status': 'na_fila',
+        'progress': 0,
+        'message': 'Aguardando na fila de conversão...',
+        'filename': filename_out,
+        'error': None,
+        'start_time': datetime.now().isoformat(),
+        'details': details,
+        'upload_files': [filename, filename_out]
+    }
+    job = (
+        task_id, conversion_type, run_conversion,
+        (conversion_func, filepath_in, filepath_out, task_id, cache_key, output_extension, profile)
+    )
+    if profile:
+        task['profile_url'] = f'/profile/{task_id}'
+    return task, job
+
+def queue_full_response():
+    """Resposta 503 para uploads recusados com a fila cheia"""
+    response = jsonify({'error': 'Servidor ocupado, tente novamente em instantes'})
+    response.headers['Retry-After'] = '30'
+    return response, 503
+
 def handle_upload(conversion_type, conversion_func, output_extension):
     """Manipula o upload e inicia a conversão"""
     try:
@@ -766,45 +653,24 @@ def handle_upload(conversion_type, conversion_func, output_extension):
             return jsonify({'error': 'Nenhum arquivo selecionado'}), 400
         
         if file and allowed_file(file.filename, conversion_type.split('_')[0]):
-            task_id = str(uuid.uuid4())
             filename = secure_filename(file.filename)
             filepath_in = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             file.save(filepath_in)
             
-            # Criar nome do arquivo de saída
-            base_name = os.path.splitext(filename)[0]
-            filename_out = f"{base_name}{output_extension}"
-            filepath_out = os.path.join(app.config['UPLOAD_FOLDER'], filename_out)
+            task, job = create_task(filename, conversion_type, conversion_func, output_extension, profiling_requested())
+            if job is None:
+                return jsonify(task)
             
-            # Informações iniciais
-            input_size = os.path.getsize(filepath_in)
-            conversion_progress[task_id] = {
-                'status': 'iniciando',
-                'progress': 0,
-                'message': 'Preparando conversão...',
-                'filename': filename_out,
-                'error': None,
-                'start_time': datetime.now().isoformat(),
-                'details': {
-                    'input_file': filename,
-                    'input_size': f"{input_size / 1024 / 1024:.2f} MB",
-                    'conversion_type': conversion_type
-                }
-            }
-            
-            # Iniciar conversão em thread separada
-            thread = threading.Thread(
-                target=conversion_func,
-                args=(filepath_in, filepath_out, task_id)
-            )
-            thread.daemon = True
-            thread.start()
+            # Enfileirar a conversão; com a fila cheia o upload é recusado
+            try:
+                task['queue_position'] = scheduler.submit(*job)
+            except QueueFullError as e:
+                logging.warning(f"Upload recusado ({filename}): {e}")
+                conversion_progress.pop(task['task_id'], None)
+                os.remove(filepath_in)
+                return queue_full_response()
             
-            return jsonify({
-                'task_id': task_id, 
-                'filename': filename_out,
-                'conversion_type': conversion_type
-            })
+            return jsonify(task)
         
         return jsonify({'error': 'Tipo de arquivo não permitido'}), 400
     
@@ -812,18 +678,291 @@ def handle_upload(conversion_type, conversion_func, output_extension):
         logging.error(f"Erro no upload: {e}")
         return jsonify({'error': f'Erro interno: {str(e)}'}), 500
 
-@app.route('/progress/<task_id>')
-def get_progress(task_id):
+def conversion_for_file(filename):
+    """Conversão correspondente à extensão do arquivo, ou None se não suportada"""
+    for conversion_type, (conversion_func, output_extension) in CONVERSIONS.items():
+        if allowed_file(filename, conversion_type.split('_')[0]):
+            return conversion_type, conversion_func, output_extension
+    return None
+
+def save_batch_members(batch_prefix):
+    """Salva em UPLOAD_FOLDER os arquivos do lote (ZIP ou vários 'files').
+    
+    Devolve [(nome original, nome salvo, conversão)] e a lista de nomes
+    ignorados por extensão não suportada.
+    """
+    uploads = [f for f in request.files.getlist('files') + request.files.getlist('file') if f.filename]
+    if len(uploads) == 1 and uploads[0].filename.lower().endswith('.zip'):
+        with zipfile.ZipFile(uploads[0].stream) as zf:
+            infos = [info for info in zf.infolist() if not info.is_dir() and not info.filename.startswith('__MACOSX/')]
+            if sum(info.file_size for info in infos) > app.config['BATCH_MAX_BYTES']:
+                raise ValueError('Conteúdo do ZIP excede o tamanho máximo do lote')
+            members = [(info.filename, functools.partial(zf.open, info)) for info in infos]
+            return save_members(batch_prefix, members)
+    
+    members = [(upload.filename, lambda upload=upload: upload.stream) for upload in uploads]
+    return save_members(batch_prefix, members)
+
+def save_members(batch_prefix, members):
+    """Grava os membros (nome, função que abre o conteúdo) com o prefixo do lote"""
+    if len(members) > app.config['BATCH_MAX_FILES']:
+        raise ValueError(f"Lote com mais de {app.config['BATCH_MAX_FILES']} arquivos")
+    
+    saved, ignored = [], []
+    for original_name, open_member in members:
+        name = secure_filename(os.path.basename(original_name))
+        conversion = conversion_for_file(name) if name else None
+        if conversion is None:
+            ignored.append(original_name)
+            continue
+        
+        # Prefixo do lote evita colisão com arquivos de mesmo nome de outros envios
+        filename = f'{batch_prefix}_{len(saved)}_{name}'
+        with open_member() as src, open(os.path.join(app.config['UPLOAD_FOLDER'], filename), 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        saved.append((name, filename, conversion))
+    return saved, ignored
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """Endpoint para lotes: um ZIP ou vários arquivos no campo 'files'.
+    
+    Cada arquivo vira uma tarefa comum na fila de conversão, de acordo com a
+    extensão (XLSB, OFX/QFX ou PDF). O lote tem o seu próprio task_id, com
+    progresso agregado em /progress/<batch_id> e o ZIP dos resultados em
+    /download/batch/<batch_id>.
+    """
+    try:
+        batch_id = str(uuid.uuid4())
+        try:
+            saved, ignored = save_batch_members(batch_id[:8])
+        except (ValueError, zipfile.BadZipFile) as e:
+            return jsonify({'error': f'Lote inválido: {str(e)}'}), 400
+        
+        if not saved:
+            return jsonify({'error': 'Nenhum arquivo suportado no lote', 'ignored': ignored}), 400
+        
+        tasks, jobs = [], []
+        for name, filename, (conversion_type, conversion_func, output_extension) in saved:
+            task, job = create_task(filename, conversion_type, conversion_func, output_extension, profiling_requested())
+            tasks.append(dict(task, name=name, output_name=os.path.splitext(name)[0] + output_extension))
+            if job is not None:
+                jobs.append(job)
+        
+        # O lote entra inteiro na fila ou é recusado inteiro
+        try:
+            scheduler.submit_many(jobs)
+        except QueueFullError as e:
+            logging.warning(f"Lote recusado ({len(saved)} arquivos): {e}")
+            for task in tasks:
+                conversion_progress.pop(task['task_id'], None)
+            for _, filename, _ in saved:
+                os.remove(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            return queue_full_response()
+        
+        conversion_progress[batch_id] = {
+            'status': 'processando',
+            'progress': 0,
+            'message': f'{len(tasks)} arquivos na fila de conversão',
+            'batch': True,
+            'tasks': tasks,
+            'error': None,
+            'start_time': datetime.now().isoformat()
+        }
+        logging.info(f"Lote {batch_id}: {len(tasks)} arquivos, {len(ignored)} ignorados")
+        
+        return jsonify({
+            'task_id': batch_id,
+            'files': tasks,
+            'ignored': ignored,
+            'download_url': f'/download/batch/{batch_id}'
+        })
+    
+    except Exception as e:
+        logging.error(f"Erro no upload do lote: {e}")
+        return jsonify({'error': f'Erro interno: {str(e)}'}), 500
+
+def run_merge(filepaths_in, filepath_out, task_id, input_names):
+    """Executa a consolidação OFX e registra o resultado para a limpeza"""
+    try:
+        merge_ofx_to_xlsx(filepaths_in, filepath_out, task_id, input_names)
+    finally:
+        upload_janitor.track(os.path.basename(filepath_out))
+
+@app.route('/upload/ofx/merge', methods=['POST'])
+def upload_ofx_merge():
+    """Endpoint para consolidar extratos OFX: um ZIP ou vários arquivos no campo 'files'.
+    
+    Extratos de períodos sobrepostos viram um único XLSX, sem as transações
+    repetidas e com uma planilha por conta (ver merge_ofx_to_xlsx). Arquivos
+    que não são OFX são ignorados.
+    """
+    try:
+        task_id = str(uuid.uuid4())
+        try:
+            saved, ignored = save_batch_members(task_id[:8])
+        except (ValueError, zipfile.BadZipFile) as e:
+            return jsonify({'error': f'Lote inválido: {str(e)}'}), 400
+        
+        statements = []
+        for name, filename, (conversion_type, _, _) in saved:
+            if conversion_type == 'ofx_to_xlsx':
+                statements.append((name, filename))
+                upload_janitor.track(filename)
+            else:
+                ignored.append(name)
+                os.remove(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        
+        if not statements:
+            return jsonify({'error': 'Nenhum arquivo OFX enviado', 'ignored': ignored}), 400
+        
+        filename_out = f'consolidado_{task_id[:8]}.xlsx'
+        filepaths_in = [os.path.join(app.config['UPLOAD_FOLDER'], filename) for _, filename in statements]
+        input_names = [name for name, _ in statements]
+        conversion_progress[task_id] = {
+            'status': 'na_fila',
+            'progress': 0,
+            'message': 'Aguardando na fila de conversão...',
+            'filename': filename_out,
+            'error': None,
+            'start_time': datetime.now().isoformat(),
+            'details': {
+                'input_files': input_names,
+                'conversion_type': 'ofx_merge'
+            },
+            'upload_files': [filename for _, filename in statements] + [filename_out]
+        }
+        
+        try:
+            queue_position = scheduler.submit(
+                task_id, 'ofx_merge', run_merge,
+                (filepaths_in, os.path.join(app.config['UPLOAD_FOLDER'], filename_out), task_id, input_names)
+            )
+        except QueueFullError as e:
+            logging.warning(f"Consolidação recusada ({len(statements)} arquivos): {e}")
+            conversion_progress.pop(task_id, None)
+            for filepath_in in filepaths_in:
+                os.remove(filepath_in)
+            return queue_full_response()
+        
+        logging.info(f"Consolidação {task_id}: {len(statements)} arquivos OFX, {len(ignored)} ignorados")
+        
+        return jsonify({
+            'task_id': task_id,
+            'filename': filename_out,
+            'conversion_type': 'ofx_merge',
+            'files': input_names,
+            'ignored': ignored,
+            'queue_position': queue_position
+        })
+    
+    except Exception as e:
+        logging.error(f"Erro no upload da consolidação: {e}")
+        return jsonify({'error': f'Erro interno: {str(e)}'}), 500
+
+def batch_progress(batch_data):
+    """Progresso agregado do lote a partir do progresso de cada arquivo"""
+    files = []
+    for task in batch_data['tasks']:
+        progress_data = conversion_progress.get(task['task_id']) or {
+            'status': 'erro',
+            'progress': 0,
+            'error': 'Tarefa expirada'
+        }
+        files.append({
+            'task_id': task['task_id'],
+            'name': task['name'],
+            'status': progress_data['status'],
+            'progress': progress_data.get('progress', 0),
+            'message': progress_data.get('message'),
+            'error': progress_data.get('error')
+        })
+    
+    finished = sum(1 for f in files if f['status'] in FINAL_STATUSES)
+    failed = sum(1 for f in files if f['status'] == 'erro')
+    return dict(
+        batch_data,
+        status='completo' if finished == len(files) else 'processando',
+        progress=sum(f['progress'] for f in files) / len(files),
+        message=f'{finished}/{len(files)} arquivos concluídos' + (f' ({failed} com erro)' if failed else ''),
+        files=files
+    )
+
+def read_progress(task_id):
+    """Progresso da tarefa (ou do lote) como devolvido pela API"""
     progress_data = conversion_progress.get(task_id, {
         'status': 'nao_encontrado',
         'progress': 0,
         'message': 'Tarefa não encontrada'
     })
-    return jsonify(progress_data)
+    if progress_data.get('batch'):
+        return batch_progress(progress_data)
+    return progress_data
+
+@app.route('/progress/<task_id>')
+def get_progress(task_id):
+    return jsonify(read_progress(task_id))
+
+# Intervalo mínimo entre eventos de um stream de progresso e entre comentários
+# de keep-alive, em segundos
+PROGRESS_STREAM_MIN_INTERVAL = 0.1
+PROGRESS_STREAM_KEEPALIVE = 15
+
+# Conexões de stream abertas neste processo (ver PROGRESS_STREAM_MAX)
+progress_streams = threading.BoundedSemaphore(app.config['PROGRESS_STREAM_MAX'])
+
+@app.route('/progress/<task_id>/stream')
+def stream_progress(task_id):
+    """Envia o progresso da tarefa por Server-Sent Events a cada alteração.
+    
+    A conexão fica aberta por até PROGRESS_STREAM_TIMEOUT segundos e só
+    acorda com atualizações da própria tarefa (ou dos arquivos do lote).
+    Acima de PROGRESS_STREAM_MAX conexões no processo a resposta é 503.
+    """
+    if not progress_streams.acquire(blocking=False):
+        response = jsonify({'error': 'Muitos acompanhamentos abertos; consulte /progress/<task_id>'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    
+    def generate():
+        deadline = time.monotonic() + app.config['PROGRESS_STREAM_TIMEOUT']
+        last_payload = None
+        last_sent = time.monotonic()
+        # Um lote muda com as tarefas dos seus arquivos
+        batch_data = conversion_progress.get(task_id) or {}
+        task_ids = [task_id] + [task['task_id'] for task in batch_data.get('tasks', ())]
+        
+        with conversion_progress.watch(task_ids) as changed:
+            # Reconexão do EventSource após 1 s, caso o stream termine antes da conversão
+            yield 'retry: 1000\n\n'
+            while time.monotonic() < deadline:
+                progress_data = read_progress(task_id)
+                payload = json.dumps(progress_data, default=str)
+                if payload != last_payload:
+                    yield f'data: {payload}\n\n'
+                    last_payload = payload
+                    last_sent = time.monotonic()
+                    if progress_data['status'] in FINAL_STATUSES or progress_data['status'] == 'nao_encontrado':
+                        yield 'event: end\ndata: {}\n\n'
+                        return
+                elif time.monotonic() - last_sent > PROGRESS_STREAM_KEEPALIVE:
+                    yield ': keep-alive\n\n'
+                    last_sent = time.monotonic()
+                
+                changed.wait(max(0, min(PROGRESS_STREAM_KEEPALIVE, deadline - time.monotonic())))
+                time.sleep(PROGRESS_STREAM_MIN_INTERVAL)
+    
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    response.call_on_close(progress_streams.release)
+    return response
 
 @app.route('/download/<filename>')
 def download_file(filename):
     try:
+        upload_janitor.touch(filename)
         return send_from_directory(
             app.config['UPLOAD_FOLDER'], 
             filename, 
@@ -834,22 +973,145 @@ def download_file(filename):
         logging.error(f"Erro no download: {e}")
         return jsonify({'error': 'Arquivo não encontrado'}), 404
 
+@app.route('/profile/<task_id>')
+@app.route('/profile/<task_id>/<kind>')
+def download_profile(task_id, kind='report'):
+    """Perfil de uma conversão: relatório em texto ou, com /pstats, o dump do cProfile"""
+    if kind not in ('report', 'pstats'):
+        return jsonify({'error': 'Formato de perfil inválido'}), 404
+    stats_path, report_path = profile_paths(task_id)
+    filename = os.path.basename(stats_path if kind == 'pstats' else report_path)
+    if not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
+        return jsonify({'error': 'Perfil não encontrado'}), 404
+
+    upload_janitor.touch(filename)
+    return send_from_directory(
+        app.config['UPLOAD_FOLDER'],
+        filename,
+        as_attachment=True,
+        download_name=filename
+    )
+
+class ZipStreamBuffer:
+    """Destino de escrita não posicionável para um ZipFile em streaming"""
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+@app.route('/download/batch/<batch_id>')
+def download_batch(batch_id):
+    """ZIP com os resultados do lote, enviado à medida que cada arquivo termina"""
+    batch_data = conversion_progress.get(batch_id)
+    if not batch_data or not batch_data.get('batch'):
+        return jsonify({'error': 'Lote não encontrado'}), 404
+    
+    def generate():
+        buffer = ZipStreamBuffer()
+        pending = list(batch_data['tasks'])
+        used_names = set()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf, \
+                conversion_progress.watch([task['task_id'] for task in pending]) as changed:
+            while pending:
+                for task in list(pending):
+                    progress_data = conversion_progress.get(task['task_id']) or {'status': 'erro', 'error': 'Tarefa expirada'}
+                    if progress_data['status'] not in FINAL_STATUSES:
+                        continue
+                    pending.remove(task)
+                    
+                    output_name = task['output_name']
+                    if output_name in used_names:
+                        base, ext = os.path.splitext(output_name)
+                        output_name = f"{base}_{len(used_names)}{ext}"
+                    used_names.add(output_name)
+                    
+                    if progress_data['status'] == 'completo':
+                        # XLSX já é compactado: gravado sem nova compressão
+                        compress_type = zipfile.ZIP_STORED if output_name.endswith('.xlsx') else zipfile.ZIP_DEFLATED
+                        info = zipfile.ZipInfo(output_name, time.localtime()[:6])
+                        info.compress_type = compress_type
+                        filepath_out = os.path.join(app.config['UPLOAD_FOLDER'], task['filename'])
+                        upload_janitor.touch(task['filename'])
+                        with open(filepath_out, 'rb') as src, zf.open(info, 'w', force_zip64=True) as dst:
+                            for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                                dst.write(chunk)
+                                yield buffer.pop()
+                    else:
+                        zf.writestr(f"{output_name}.erro.txt", str(progress_data.get('error') or 'Erro na conversão'))
+                    yield buffer.pop()
+                
+                if pending:
+                    changed.wait(PROGRESS_STREAM_KEEPALIVE)
+        yield buffer.pop()
+    
+    return Response(generate(), mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename=lote_{batch_id[:8]}.zip',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/cleanup', methods=['POST'])
 def cleanup_files():
+    """Executa a limpeza de UPLOAD_FOLDER imediatamente (ver UploadJanitor)"""
     try:
-        cutoff_time = time.time() - 3600  # 1 hora
-        removed = 0
-        
-        for filename in os.listdir(app.config['UPLOAD_FOLDER']):
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            if os.path.getctime(filepath) < cutoff_time:
-                os.remove(filepath)
-                removed += 1
-        
-        return jsonify({'message': f'{removed} arquivos removidos'})
+        removed = upload_janitor.sweep()
+        return jsonify({'message': f'{removed} arquivos removidos', **upload_janitor.stats()})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/cache')
+def get_cache_stats():
+    """Retorna os contadores do cache de resultados e do cache de planilhas"""
+    return jsonify(dict(result_cache.stats(), sheets=sheet_cache.stats()))
+
+@app.route('/api/queue')
+def get_queue_stats():
+    """Retorna o estado da fila de conversões"""
+    return jsonify(scheduler.stats())
+
+@app.route('/metrics')
+def get_metrics():
+    """Métricas no formato do Prometheus: tempos por etapa, fila e caches"""
+    queue = scheduler.stats()
+    caches = {'results': result_cache.stats(), 'sheets': sheet_cache.stats()}
+    # nome -> (tipo, descrição, [(rótulos, valor)])
+    metrics = {
+        'conversor_queue_depth': ('gauge', 'Conversões aguardando na fila.', [('', queue['queue_depth'])]),
+        'conversor_queue_oldest_wait_seconds': ('gauge', 'Espera da conversão mais antiga da fila.', [('', queue['oldest_wait_seconds'])]),
+        'conversor_queue_completed_total': ('counter', 'Conversões retiradas da fila e encerradas.', [('', queue['completed'])]),
+        'conversor_workers': ('gauge', 'Conversões simultâneas permitidas.', [('', queue['workers'])]),
+        'conversor_active_tasks': ('gauge', 'Conversões em andamento.', [
+            (f'{{type="{name}"}}', count) for name, count in sorted(queue['running'].items())
+        ] or [('', 0)]),
+        'conversor_progress_entries': ('gauge', 'Tarefas em conversion_progress.', [('', len(conversion_progress))]),
+        'conversor_uploads_bytes': ('gauge', 'Espaço ocupado em uploads/.', [('', upload_janitor.stats()['size_bytes'])]),
+        'conversor_cache_hits_total': ('counter', 'Acertos nos caches.', [
+            (f'{{cache="{name}"}}', stats['hits']) for name, stats in caches.items()
+        ]),
+        'conversor_cache_misses_total': ('counter', 'Faltas nos caches.', [
+            (f'{{cache="{name}"}}', stats['misses']) for name, stats in caches.items()
+        ]),
+        'conversor_cache_bytes': ('gauge', 'Tamanho dos caches em disco.', [
+            (f'{{cache="{name}"}}', stats['size_bytes']) for name, stats in caches.items()
+        ])
+    }
+    
+    lines = conversion_metrics.render()
+    for name, (metric_type, help_text, samples) in metrics.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}']
+        lines += [f'{name}{labels} {value}' for labels, value in samples]
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/formats')
 def get_supported_formats():
     """Retorna os formatos suportados"""
@@ -864,6 +1126,11 @@ def get_supported_formats():
             'to': 'xlsx', 
             'description': 'Open Financial Exchange para Excel'
         },
+        'ofx_merge': {
+            'from': 'ofx',
+            'to': 'xlsx',
+            'description': 'Vários extratos OFX consolidados em um Excel, sem duplicatas, uma planilha por conta'
+        },
         'pdf_to_ofx': {
             'from': 'pdf',
             'to': 'ofx',
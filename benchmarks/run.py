@@ -0,0 +1,258 @@
+"""Benchmarks dos conversores com arquivos sintéticos.
+
+Uso:
+    python benchmarks/run.py [--tier small|medium|large] [--engines pandas,streaming]
+                             [--writers openpyxl,direct] [--ofx-engines pandas,streaming]
+                             [--output resultados.json] [--compare baseline.json]
+
+Cada caso roda em um processo novo (tempo, linhas/s, pico de memória RSS e
+tamanho da saída), em uma pasta temporária própria, com os conversores do
+módulo conversions (sem o servidor, os logs nem o cache de planilhas do
+motor 'parallel'). Com --compare, os tempos são comparados com um resultado
+anterior e a execução termina com código 1 se algum caso ficar mais lento
+que o limite (--threshold).
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from queue import Empty
+
+import synthetic
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+DATA_DIR = os.path.join(BENCH_DIR, 'data')
+
+TIERS = ['small', 'medium', 'large']
+
+# Intervalo entre as verificações de que o processo do caso continua vivo
+MEASURE_POLL_INTERVAL = 1
+
+# Cargas de trabalho: nome -> (nível, tipo, parâmetros do gerador). Um nível
+# inclui as cargas dos níveis anteriores. Os extratos OFX saem em ordem de
+# data (leitura em uma passada no motor 'streaming'); os '_unordered' medem
+# a ordenação em memória.
+WORKLOADS = {
+    'xlsb_10k_numeric': ('small', 'xlsb', {'row_count': 10_000, 'kind': 'numeric'}),
+    'xlsb_10k_string': ('small', 'xlsb', {'row_count': 10_000, 'kind': 'string'}),
+    'ofx_100': ('small', 'ofx', {'transaction_count': 100}),
+    'ofx_10k': ('small', 'ofx', {'transaction_count': 10_000}),
+    'ofx_10k_unordered': ('small', 'ofx', {'transaction_count': 10_000, 'ordered': False}),
+    'xlsb_100k_numeric': ('medium', 'xlsb', {'row_count': 100_000, 'kind': 'numeric'}),
+    'xlsb_100k_string': ('medium', 'xlsb', {'row_count': 100_000, 'kind': 'string'}),
+    'xlsb_100k_50sheets': ('medium', 'xlsb', {'row_count': 100_000, 'sheet_count': 50, 'kind': 'string'}),
+    'ofx_100k': ('medium', 'ofx', {'transaction_count': 100_000}),
+    'ofx_100k_unordered': ('medium', 'ofx', {'transaction_count': 100_000, 'ordered': False}),
+    'xlsb_1m_numeric': ('large', 'xlsb', {'row_count': 1_000_000, 'kind': 'numeric'}),
+    'xlsb_1m_string': ('large', 'xlsb', {'row_count': 1_000_000, 'kind': 'string'}),
+    'ofx_500k': ('large', 'ofx', {'transaction_count': 500_000}),
+}
+
+def workload_path(name):
+    """Gera o arquivo da carga na primeira vez; devolve (caminho, nº de linhas)"""
+    _, kind, params = WORKLOADS[name]
+    os.makedirs(DATA_DIR, exist_ok=True)
+    path = os.path.join(DATA_DIR, f'{name}.v{synthetic.DATA_VERSION}.{kind}')
+    if kind == 'xlsb':
+        rows = params['row_count'] // params.get('sheet_count', 1) * params.get('sheet_count', 1)
+    else:
+        rows = params['transaction_count']
+    
+    if not os.path.exists(path):
+        print(f'Gerando {name}...', flush=True)
+        tmp_path = path + '.tmp'
+        if kind == 'xlsb':
+            synthetic.generate_xlsb(tmp_path, **params)
+        else:
+            synthetic.generate_ofx(tmp_path, **params)
+        os.replace(tmp_path, path)
+    return path, rows
+
+def run_case(queue, path_in, converter, engine, writer):
+    """Executa uma conversão em um processo novo e devolve as medidas pela fila"""
+    start = time.perf_counter()
+    try:
+        work_dir = tempfile.mkdtemp(prefix='bench_')
+        os.environ['PROGRESS_BACKEND'] = 'memory'
+        if engine:
+            os.environ['OFX_ENGINE' if converter == 'ofx_to_xlsx' else 'XLSB_ENGINE'] = engine
+        if writer:
+            os.environ['XLSX_WRITER'] = writer
+        sys.path.insert(0, APP_DIR)
+        
+        import logging
+        logging.disable(logging.INFO)
+        import conversions
+        
+        conversion_func, output_extension = conversions.CONVERSIONS[converter]
+        path_out = os.path.join(work_dir, 'saida' + output_extension)
+        start = time.perf_counter()
+        conversion_func(path_in, path_out, 'bench')
+        seconds = time.perf_counter() - start
+        
+        progress = conversions.conversion_progress.get('bench', {})
+        result = {
+            'status': 'ok' if progress.get('status') == 'completo' and not progress.get('fallback') else progress.get('status', 'erro'),
+            'seconds': seconds,
+            'output_bytes': os.path.getsize(path_out) if os.path.exists(path_out) else None,
+            'error': progress.get('error')
+        }
+    except Exception as e:
+        result = {
+            'status': 'erro',
+            'seconds': time.perf_counter() - start,
+            'output_bytes': None,
+            'error': f'{type(e).__name__}: {e}'
+        }
+    
+    # ru_maxrss em KB no Linux; RUSAGE_CHILDREN cobre os processos do motor 'parallel'
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    queue.put(dict(result, peak_rss_mb=peak_rss / 1024))
+
+def measure(path_in, converter, engine, writer):
+    """Medidas de um caso; um processo que termina sem responder vira status 'erro'"""
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run_case, args=(queue, path_in, converter, engine, writer))
+    start = time.perf_counter()
+    process.start()
+    try:
+        while True:
+            try:
+                return queue.get(timeout=MEASURE_POLL_INTERVAL)
+            except Empty:
+                if process.is_alive():
+                    continue
+                # O processo pode ter enviado o resultado logo antes de sair
+                try:
+                    return queue.get(timeout=MEASURE_POLL_INTERVAL)
+                except Empty:
+                    return {
+                        'status': 'erro',
+                        'seconds': time.perf_counter() - start,
+                        'peak_rss_mb': None,
+                        'output_bytes': None,
+                        'error': f'processo do caso terminou com código {process.exitcode}'
+                    }
+    finally:
+        process.join()
+
+def case_key(result):
+    return (result['workload'], result['converter'], result['engine'], result['writer'])
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path, threshold):
+    """Imprime a variação de tempo por caso; devolve o número de regressões"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {case_key(result): result for result in json.load(f)['results']}
+    
+    regressions = 0
+    print(f"\n{'caso':<60} {'antes':>9} {'agora':>9} {'variação':>9}")
+    for result in results:
+        previous = baseline.get(case_key(result))
+        label = ' / '.join(part for part in case_key(result) if part)
+        if previous is None or not previous['seconds'] or result['status'] != 'ok':
+            print(f"{label:<60} {'-':>9} {result['seconds']:>8.2f}s {'-':>9}")
+            continue
+        change = result['seconds'] / previous['seconds'] - 1
+        flag = ''
+        if change > threshold:
+            regressions += 1
+            flag = '  REGRESSÃO'
+        print(f"{label:<60} {previous['seconds']:>8.2f}s {result['seconds']:>8.2f}s {change:>+8.1%}{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks dos conversores com arquivos sintéticos.')
+    parser.add_argument('--tier', choices=TIERS, default='small', help='maior nível de carga a executar (padrão: small)')
+    parser.add_argument('--workloads', help='nomes das cargas, separados por vírgula (ignora --tier)')
+    parser.add_argument('--engines', default='pandas,streaming,parallel', help='motores XLSB, separados por vírgula')
+    parser.add_argument('--writers', default='openpyxl', help='backends de escrita XLSX, separados por vírgula')
+    parser.add_argument('--ofx-engines', default='pandas,streaming', help='motores OFX, separados por vírgula')
+    parser.add_argument('--repeat', type=int, default=1, help='execuções por caso; vale o menor tempo')
+    parser.add_argument('--output', default=os.path.join(BENCH_DIR, 'results.json'), help='arquivo JSON de resultados')
+    parser.add_argument('--compare', help='resultado anterior (JSON) para comparar os tempos')
+    parser.add_argument('--threshold', type=float, default=0.10, help='aumento de tempo tolerado na comparação (padrão: 0.10)')
+    args = parser.parse_args(argv)
+    
+    if args.workloads:
+        names = args.workloads.split(',')
+    else:
+        max_tier = TIERS.index(args.tier)
+        names = [name for name, (tier, _, _) in WORKLOADS.items() if TIERS.index(tier) <= max_tier]
+    
+    cases = []
+    for name in names:
+        _, kind, _ = WORKLOADS[name]
+        if kind == 'xlsb':
+            for engine in args.engines.split(','):
+                for writer in args.writers.split(','):
+                    cases.append((name, 'xlsb_to_xlsx', engine, writer))
+        else:
+            for engine in args.ofx_engines.split(','):
+                cases.append((name, 'ofx_to_xlsx', engine, None))
+    
+    results = []
+    for name, converter, engine, writer in cases:
+        path_in, rows = workload_path(name)
+        runs = [measure(path_in, converter, engine, writer) for _ in range(args.repeat)]
+        # Execuções com erro só contam se nenhuma terminou bem
+        best = min(runs, key=lambda run: (run['status'] != 'ok', run['seconds']))
+        peaks = [run['peak_rss_mb'] for run in runs if run['peak_rss_mb'] is not None]
+        result = {
+            'workload': name,
+            'converter': converter,
+            'engine': engine,
+            'writer': writer,
+            'rows': rows,
+            'input_bytes': os.path.getsize(path_in),
+            'seconds': round(best['seconds'], 4),
+            'rows_per_sec': round(rows / best['seconds']) if best['seconds'] else None,
+            'peak_rss_mb': round(max(peaks), 1) if peaks else None,
+            'output_bytes': best['output_bytes'],
+            'status': best['status'],
+            'error': best['error']
+        }
+        results.append(result)
+        label = ' / '.join(part for part in case_key(result) if part)
+        print(f"{label:<60} {result['seconds']:>8.2f}s {result['rows_per_sec'] or 0:>10} linhas/s {result['peak_rss_mb'] or 0:>8.1f} MB  {result['status']}", flush=True)
+    
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'meta': {
+                'date': datetime.now().isoformat(),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'repeat': args.repeat
+            },
+            'results': results
+        }, f, ensure_ascii=False, indent=2)
+    print(f'Resultados gravados em {args.output}')
+    
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print(f'{regressions} casos mais lentos que o limite de {args.threshold:.0%}')
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+"""Geradores de arquivos sintéticos para os benchmarks.
+
+Os arquivos são determinísticos (mesma semente, mesmos bytes) para que os
+resultados de execuções diferentes sejam comparáveis.
+
+O XLSB é gravado direto em BIFF12, só com os registros que o pyxlsb lê:
+lista de planilhas (workbook.bin), tabela de strings (sharedStrings.bin),
+dimensão, linhas e células de cada planilha. Não há biblioteca Python que
+grave XLSB.
+"""
+import random
+import struct
+import zipfile
+from datetime import date, timedelta
+from xml.sax.saxutils import quoteattr
+
+# Registros BIFF12 usados (mesmos IDs de pyxlsb.biff12)
+WORKBOOK = 0x0183
+WORKBOOK_END = 0x0184
+SHEETS = 0x018F
+SHEETS_END = 0x0190
+SHEET = 0x019C
+WORKSHEET = 0x0181
+WORKSHEET_END = 0x0182
+DIMENSION = 0x0194
+SHEETDATA = 0x0191
+SHEETDATA_END = 0x0192
+ROW = 0x0000
+NUM = 0x0002
+FLOAT = 0x0005
+STRING = 0x0007
+SST = 0x019F
+SST_END = 0x01A0
+SI = 0x0013
+
+# Registros acumulados antes de cada escrita no zip
+WRITE_BATCH = 4096
+
+# Versão dos geradores: muda sempre que os bytes gerados mudam, para que
+# arquivos antigos em benchmarks/data não sejam reaproveitados
+DATA_VERSION = 2
+
+RELATIONSHIPS_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+DOCUMENT_RELS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+
+WORDS = [
+    'CONSULTA', 'EXAME', 'LAUDO', 'PROCEDIMENTO', 'RETORNO', 'CIRURGIA', 'INTERNACAO',
+    'PACIENTE', 'MEDICO', 'CONVENIO', 'PARTICULAR', 'URGENCIA', 'ELETIVO', 'AMBULATORIO',
+    'RADIOLOGIA', 'ULTRASSOM', 'TOMOGRAFIA', 'RESSONANCIA', 'LABORATORIO', 'FISIOTERAPIA'
+]
+MEMOS = [
+    'TED-TRANSF ELET DISPON REMET', 'TITULO DE CAPITALIZACAO', 'APLIC.INVEST FACIL',
+    'RESGATE INVEST FACIL', 'SAQUE COM CARTAO ESPECIE', 'PAGTO COBRANCA', 'TARIFA BANCARIA',
+    'PIX RECEBIDO', 'PIX ENVIADO', 'DEB AUTOMATICO'
+]
+
+def record(rec_id, payload=b''):
+    """Registro BIFF12: ID (bytes do próprio valor) + tamanho em 7 bits + dados"""
+    header = rec_id.to_bytes(1 if rec_id < 0x100 else 2, 'little')
+    length = len(payload)
+    size = bytearray()
+    while True:
+        byte = length & 0x7F
+        length >>= 7
+        if length:
+            size.append(byte | 0x80)
+        else:
+            size.append(byte)
+            break
+    return header + bytes(size) + payload
+
+def wide_string(text):
+    data = text.encode('utf-16-le')
+    return struct.pack('<I', len(data) // 2) + data
+
+def cell_record(col, value, shared_strings):
+    """Célula BIFF12: inteiros como RK, decimais como double, textos na tabela"""
+    if isinstance(value, str):
+        string_idx = shared_strings.setdefault(value, len(shared_strings))
+        return record(STRING, struct.pack('<IIi', col, 0, string_idx))
+    if isinstance(value, int) and -2 ** 29 <= value < 2 ** 29:
+        return record(NUM, struct.pack('<IIi', col, 0, (value << 2) | 2))
+    return record(FLOAT, struct.pack('<IId', col, 0, float(value)))
+
+def write_xlsb(path, sheets):
+    """Grava um XLSB com as planilhas [(nome, linhas, nº de linhas, nº de colunas)]"""
+    shared_strings = {}
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for sheet_idx, (_, rows, row_count, col_count) in enumerate(sheets, 1):
+            with zf.open(f'xl/worksheets/sheet{sheet_idx}.bin', 'w', force_zip64=True) as out:
+                out.write(record(WORKSHEET))
+                out.write(record(DIMENSION, struct.pack('<IIII', 0, max(row_count - 1, 0), 0, max(col_count - 1, 0))))
+                out.write(record(SHEETDATA))
+                buffer = []
+                for row_idx, row in enumerate(rows):
+                    buffer.append(record(ROW, struct.pack('<IIH', row_idx, 0, 300) + bytes(7)))
+                    for col_idx, value in enumerate(row):
+                        if value is not None:
+                            buffer.append(cell_record(col_idx, value, shared_strings))
+                    if len(buffer) >= WRITE_BATCH:
+                        out.write(b''.join(buffer))
+                        buffer.clear()
+                out.write(b''.join(buffer))
+                out.write(record(SHEETDATA_END))
+                out.write(record(WORKSHEET_END))
+    
+        with zf.open('xl/sharedStrings.bin', 'w', force_zip64=True) as out:
+            out.write(record(SST, struct.pack('<II', len(shared_strings), len(shared_strings))))
+            buffer = []
+            for text in shared_strings:
+                buffer.append(record(SI, b'\x00' + wide_string(text)))
+                if len(buffer) >= WRITE_BATCH:
+                    out.write(b''.join(buffer))
+                    buffer.clear()
+            out.write(b''.join(buffer))
+            out.write(record(SST_END))
+    
+        workbook = [record(WORKBOOK), record(SHEETS)]
+        for sheet_idx, (name, _, _, _) in enumerate(sheets, 1):
+            workbook.append(record(SHEET, struct.pack('<II', 0, sheet_idx) + wide_string(f'rId{sheet_idx}') + wide_string(name)))
+        workbook += [record(SHEETS_END), record(WORKBOOK_END)]
+        zf.writestr('xl/workbook.bin', b''.join(workbook))
+    
+        relationships = ''.join(
+            f'<Relationship Id="rId{idx}" Type="{DOCUMENT_RELS}/worksheet" Target="worksheets/sheet{idx}.bin"/>'
+            for idx in range(1, len(sheets) + 1)
+        )
+        relationships += f'<Relationship Id="rId{len(sheets) + 1}" Type="{DOCUMENT_RELS}/sharedStrings" Target="sharedStrings.bin"/>'
+        zf.writestr('xl/_rels/workbook.bin.rels', f'<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="{RELATIONSHIPS_NS}">{relationships}</Relationships>')
+        zf.writestr('_rels/.rels', f'<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="{RELATIONSHIPS_NS}"><Relationship Id="rId1" Type="{DOCUMENT_RELS}/officeDocument" Target="xl/workbook.bin"/></Relationships>')
+    
+        content_type = 'application/vnd.ms-excel'
+        overrides = ''.join(
+            f'<Override PartName="/xl/worksheets/sheet{idx}.bin" ContentType={quoteattr(content_type + ".worksheet")}/>'
+            for idx in range(1, len(sheets) + 1)
+        )
+        zf.writestr(
+            '[Content_Types].xml',
+            '<?xml version="1.0" encoding="UTF-8"?><Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="bin" ContentType="application/vnd.ms-excel.sheet.binary.macroEnabled.main"/>'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            f'{overrides}</Types>'
+        )
+
+def numeric_rows(rng, row_count, col_count):
+    """Cabeçalho e linhas numéricas: códigos inteiros e valores decimais"""
+    yield [f'VALOR_{col_idx + 1}' for col_idx in range(col_count)]
+    for row_idx in range(1, row_count):
+        row = [row_idx]
+        for col_idx in range(1, col_count):
+            if col_idx % 3 == 0:
+                row.append(rng.randrange(1, 100000))
+            else:
+                row.append(round(rng.uniform(-50000, 50000), 2))
+        yield row
+
+def string_rows(rng, row_count, col_count):
+    """Cabeçalho e linhas com predominância de texto: repetidos, únicos e longos"""
+    yield [f'CAMPO_{col_idx + 1}' for col_idx in range(col_count)]
+    for row_idx in range(1, row_count):
+        row = [f'PAC-{row_idx:07d}']
+        for col_idx in range(1, col_count):
+            kind = col_idx % 4
+            if kind == 0:
+                row.append(round(rng.uniform(0, 5000), 2))
+            elif kind == 1:
+                row.append(rng.choice(WORDS))
+            elif kind == 2:
+                row.append(' '.join(rng.choice(WORDS) for _ in range(rng.randrange(2, 12))))
+            else:
+                row.append(f'{rng.choice(WORDS)} {rng.randrange(1, 1000)}')
+        yield row
+
+def generate_xlsb(path, row_count, sheet_count=1, col_count=10, kind='numeric', seed=42):
+    """XLSB com row_count linhas (cabeçalho incluso) distribuídas em sheet_count planilhas"""
+    rng = random.Random(seed)
+    make_rows = string_rows if kind == 'string' else numeric_rows
+    rows_per_sheet = max(row_count // sheet_count, 2)
+    sheets = [
+        (f'PLANILHA {sheet_idx + 1}', make_rows(rng, rows_per_sheet, col_count), rows_per_sheet, col_count)
+        for sheet_idx in range(sheet_count)
+    ]
+    write_xlsb(path, sheets)
+    return rows_per_sheet * sheet_count
+
+def generate_ofx(path, transaction_count, seed=42, ordered=True):
+    """Extrato OFX (SGML, como o dos bancos) com transaction_count blocos <STMTTRN>.
+    
+    Com ordered, as datas crescem ao longo de 2025, como nos extratos dos
+    bancos; senão cada transação tem um dia sorteado do ano.
+    """
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='ascii', newline='\n') as out:
+        out.write(
+            'OFXHEADER:100\nDATA:OFXSGML\nVERSION:102\nSECURITY:NONE\nENCODING:USASCII\n'
+            'CHARSET:1252\nCOMPRESSION:NONE\nOLDFILEUID:NONE\nNEWFILEUID:NONE\n\n'
+            '<OFX>\n<SIGNONMSGSRSV1>\n<SONRS>\n<STATUS>\n<CODE>0\n<SEVERITY>INFO\n</STATUS>\n'
+            '<DTSERVER>00000000000000\n<LANGUAGE>POR\n</SONRS>\n</SIGNONMSGSRSV1>\n'
+            '<BANKMSGSRSV1>\n<STMTTRNRS>\n<TRNUID>1001\n<STATUS>\n<CODE>0\n<SEVERITY>INFO\n</STATUS>\n'
+            '<STMTRS>\n<CURDEF>BRL\n<BANKACCTFROM>\n<BANKID>0237\n<ACCTID>33462\n<ACCTTYPE>CHECKING\n'
+            '</BANKACCTFROM>\n<BANKTRANLIST>\n<DTSTART>20250101\n<DTEND>20251231\n'
+        )
+        buffer = []
+        for idx in range(transaction_count):
+            amount = round(rng.uniform(-20000, 20000), 2)
+            # Valores com vírgula decimal
+            if ordered:
+                day = date(2025, 1, 1) + timedelta(days=idx * 365 // max(transaction_count, 1))
+            else:
+                day = date(2025, 1, 1) + timedelta(days=rng.randrange(365))
+            amount_text = f'{amount:.2f}'.replace('.', ',')
+            buffer.append(
+                f'<STMTTRN>\n<TRNTYPE>{"CREDIT" if amount >= 0 else "DEBIT"}\n'
+                f'<DTPOSTED>{day:%Y%m%d}120000\n<TRNAMT>{amount_text}\n'
+                f'<FITID>N{idx:08X}\n<CHECKNUM>{rng.randrange(1, 9999999)}\n'
+                f'<MEMO>{rng.choice(MEMOS)} {rng.randrange(1, 10000)}\n</STMTTRN>\n'
+            )
+            if len(buffer) >= WRITE_BATCH:
+                out.write(''.join(buffer))
+                buffer.clear()
+        out.write(''.join(buffer))
+        out.write(
+            '</BANKTRANLIST>\n<LEDGERBAL>\n<BALAMT>0,00\n<DTASOF>20251231\n</LEDGERBAL>\n'
+            '</STMTRS>\n</STMTTRNRS>\n</BANKMSGSRSV1>\n</OFX>\n'
+        )
+    return transaction_count
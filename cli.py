@@ -0,0 +1,206 @@
+"""Conversão em lote pela linha de comando, sem o servidor web.
+
+Uso:
+    python cli.py ENTRADAS... [-o PASTA_SAIDA] [-j PROCESSOS] [--report relatorio.csv]
+
+ENTRADAS podem ser arquivos, pastas (percorridas recursivamente) ou padrões
+glob ('dados/**/*.xlsb'). Saídas mais novas que a entrada são puladas, a
+menos que se use --force. Arquivos que são a saída de outra entrada da mesma
+execução (o .ofx gerado ao lado de um PDF) não são convertidos de novo.
+
+O módulo conversions só é importado nos processos de conversão, e apenas
+quando há algo a converter: uma execução sem arquivos pendentes termina sem
+carregar pandas, numpy ou openpyxl. Havendo conversões, cada processo
+carrega o módulo inteiro, com essas bibliotecas, qualquer que seja o tipo
+de arquivo; só o pdfplumber espera o primeiro PDF. O servidor (app.py) nunca
+é importado: nada é gravado em logs/, uploads/ ou cache/.
+"""
+import argparse
+import csv
+import glob
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Extensão de entrada -> (função de conversão em conversions.py, extensão de
+# saída); mesmo mapeamento de conversions.CONVERSIONS, repetido aqui para não
+# importar os conversores no processo principal
+CONVERSIONS = {
+    'xlsb': ('convert_xlsb_to_xlsx_advanced', '.xlsx'),
+    'ofx': ('convert_ofx_to_xlsx', '.xlsx'),
+    'qfx': ('convert_ofx_to_xlsx', '.xlsx'),
+    'pdf': ('convert_pdf_to_ofx', '.ofx')
+}
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Módulo conversions carregado em cada processo de conversão (ver load_conversions)
+_conversions = None
+
+def load_conversions():
+    """Importa os conversores no processo de conversão"""
+    global _conversions
+    if _conversions is None:
+        os.environ['PROGRESS_BACKEND'] = 'memory'
+        sys.path.insert(0, APP_DIR)
+        import conversions
+        _conversions = conversions
+    return _conversions
+
+def init_worker(engine, writer, verbose):
+    """Inicializador dos processos: opções dos conversores antes da importação"""
+    if engine:
+        os.environ['XLSB_ENGINE'] = engine
+    if writer:
+        os.environ['XLSX_WRITER'] = writer
+    # O motor 'parallel' e a extração de PDF abririam outro pool dentro de cada processo
+    os.environ.setdefault('XLSB_WORKERS', '1')
+    os.environ.setdefault('PDF_WORKERS', '1')
+    if verbose:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(processName)s - %(levelname)s - %(message)s')
+    else:
+        logging.disable(logging.INFO)
+
+def conversion_for(path):
+    ext = path.rsplit('.', 1)[1].lower() if '.' in path else ''
+    return CONVERSIONS.get(ext)
+
+def collect_inputs(patterns, output_dir=None):
+    """Lista (arquivo de entrada, pasta base) para arquivos, pastas e padrões glob"""
+    inputs = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            base = os.path.abspath(pattern)
+            for root, _, files in os.walk(base):
+                for name in sorted(files):
+                    if conversion_for(name):
+                        inputs.append((os.path.join(root, name), base))
+        else:
+            for path in sorted(glob.glob(pattern, recursive=True)):
+                if os.path.isfile(path) and conversion_for(path):
+                    path = os.path.abspath(path)
+                    inputs.append((path, os.path.dirname(path)))
+    
+    # Mesmo arquivo citado por mais de uma entrada é convertido uma vez
+    seen = set()
+    inputs = [item for item in inputs if not (item[0] in seen or seen.add(item[0]))]
+    
+    # Saídas de outras entradas (o .ofx de um PDF, convertido antes) não são
+    # entradas: seriam convertidas outra vez para .xlsx
+    outputs = {output_path(path, base, output_dir) for path, base in inputs}
+    return [item for item in inputs if item[0] not in outputs]
+
+def output_path(path_in, base, output_dir):
+    """Saída ao lado da entrada ou, com output_dir, espelhando a árvore de base"""
+    _, output_extension = conversion_for(path_in)
+    name = os.path.splitext(os.path.relpath(path_in, base))[0] + output_extension
+    if output_dir:
+        return os.path.join(os.path.abspath(output_dir), name)
+    return os.path.join(base, name)
+
+def is_up_to_date(path_in, path_out):
+    return os.path.exists(path_out) and os.path.getmtime(path_out) >= os.path.getmtime(path_in)
+
+def convert_file(path_in, path_out):
+    """Converte um arquivo no processo atual e devolve a linha do relatório"""
+    conversions = load_conversions()
+    function_name, output_extension = conversion_for(path_in)
+    conversion_func = getattr(conversions, function_name)
+    
+    # Grava em um arquivo temporário: uma execução interrompida não deixa
+    # saída parcial que pareça atualizada
+    os.makedirs(os.path.dirname(path_out), exist_ok=True)
+    tmp_out = f"{os.path.splitext(path_out)[0]}.tmp{output_extension}"
+    task_id = f'cli-{uuid.uuid4()}'
+    
+    start = time.perf_counter()
+    try:
+        conversion_func(path_in, tmp_out, task_id)
+        progress = conversions.conversion_progress.get(task_id, {})
+        if progress.get('status') == 'completo':
+            os.replace(tmp_out, path_out)
+            status, error = 'convertido', None
+        else:
+            status, error = 'erro', progress.get('error') or 'Conversão não concluída'
+    except Exception as e:
+        status, error = 'erro', str(e)
+    finally:
+        conversions.conversion_progress.pop(task_id, None)
+        if os.path.exists(tmp_out):
+            os.remove(tmp_out)
+    
+    return {
+        'entrada': path_in,
+        'saida': path_out,
+        'status': status,
+        'segundos': round(time.perf_counter() - start, 3),
+        'bytes_entrada': os.path.getsize(path_in),
+        'bytes_saida': os.path.getsize(path_out) if status == 'convertido' else None,
+        'erro': error
+    }
+
+def write_report(rows, report_path):
+    """Relatório por arquivo em CSV ou, com extensão .json, em JSON"""
+    if report_path.lower().endswith('.json'):
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+        return
+    
+    with open(report_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=['entrada', 'saida', 'status', 'segundos', 'bytes_entrada', 'bytes_saida', 'erro'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Converte arquivos XLSB, OFX e PDF em lote.')
+    parser.add_argument('inputs', nargs='+', help='arquivos, pastas ou padrões glob')
+    parser.add_argument('-o', '--output-dir', help='pasta de saída (padrão: ao lado de cada entrada)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='número de processos (padrão: nº de CPUs)')
+    parser.add_argument('--engine', choices=['pandas', 'streaming', 'parallel'], help='motor XLSB (padrão: XLSB_ENGINE)')
+    parser.add_argument('--writer', choices=['openpyxl', 'direct'], help='backend de escrita XLSX (padrão: XLSX_WRITER)')
+    parser.add_argument('--force', action='store_true', help='converte mesmo com a saída atualizada')
+    parser.add_argument('--report', help='grava o relatório por arquivo (.csv ou .json)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='mostra o log das conversões')
+    args = parser.parse_args(argv)
+    
+    rows = []
+    pending = []
+    for path_in, base in collect_inputs(args.inputs, args.output_dir):
+        path_out = output_path(path_in, base, args.output_dir)
+        if not args.force and is_up_to_date(path_in, path_out):
+            rows.append({
+                'entrada': path_in, 'saida': path_out, 'status': 'atualizado', 'segundos': 0,
+                'bytes_entrada': os.path.getsize(path_in), 'bytes_saida': os.path.getsize(path_out), 'erro': None
+            })
+        else:
+            pending.append((path_in, path_out))
+    
+    start = time.perf_counter()
+    if pending:
+        workers = max(1, min(args.jobs, len(pending)))
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(args.engine, args.writer, args.verbose)
+        ) as executor:
+            futures = [executor.submit(convert_file, path_in, path_out) for path_in, path_out in pending]
+            for future in as_completed(futures):
+                row = future.result()
+                rows.append(row)
+                print(f"{row['status']:<10} {row['segundos']:>8.2f}s  {row['entrada']}" + (f"  ({row['erro']})" if row['erro'] else ''))
+    
+    converted = sum(1 for row in rows if row['status'] == 'convertido')
+    failed = sum(1 for row in rows if row['status'] == 'erro')
+    skipped = sum(1 for row in rows if row['status'] == 'atualizado')
+    print(f"{converted} convertidos, {skipped} atualizados, {failed} com erro em {time.perf_counter() - start:.1f}s")
+    
+    if args.report:
+        write_report(rows, args.report)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,2950 @@
+"""Conversores XLSB -> XLSX, OFX -> XLSX e PDF -> OFX, sem o servidor web.
+
+Usado pelo app (app.py), pela linha de comando (cli.py) e pelos benchmarks.
+Importar este módulo não grava arquivos, não configura o logging e não
+inicia threads; a configuração vem das variáveis de ambiente no momento da
+importação (ver config).
+"""
+import os
+import time
+import logging
+import numpy as np
+import pandas as pd
+import threading
+import multiprocessing
+import itertools
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.styles.numbers import BUILTIN_FORMATS_REVERSE, BUILTIN_FORMATS_MAX_SIZE
+from openpyxl.utils import get_column_letter
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.styles.stylesheet import write_stylesheet
+from openpyxl.writer.theme import theme_xml
+from openpyxl.xml.functions import tostring
+import re
+import json
+import math
+import functools
+import contextlib
+import bisect
+import hashlib
+import sqlite3
+import codecs
+import operator
+import heapq
+import sys
+from array import array
+from collections import Counter, OrderedDict, deque
+from pandas.io.parsers import TextParser
+from xml.sax.saxutils import escape, quoteattr
+
+# Opções dos conversores, lidas do ambiente (o app as copia para app.config)
+config = {}
+# Motor da conversão XLSB -> XLSX: 'pandas' (DataFrame por planilha),
+# 'streaming' (linha a linha, com memória constante) ou 'parallel'
+# (uma planilha por processo, com XLSB_WORKERS processos)
+config['XLSB_ENGINE'] = os.environ.get('XLSB_ENGINE', 'pandas')
+config['XLSB_WORKERS'] = int(os.environ.get('XLSB_WORKERS', os.cpu_count() or 1))
+# Backend de escrita dos motores 'streaming' e 'parallel': 'openpyxl' ou
+# 'direct' (SpreadsheetML gravado direto no zip, ver XlsxDirectWriter)
+config['XLSX_WRITER'] = os.environ.get('XLSX_WRITER', 'openpyxl')
+# Motor da conversão OFX -> XLSX: 'pandas' (arquivo inteiro em um DataFrame)
+# ou 'streaming' (leitura em pedaços e gravação linha a linha)
+config['OFX_ENGINE'] = os.environ.get('OFX_ENGINE', 'pandas')
+# Formato dos OFX gerados (PDF -> OFX): 'sgml' (OFX 1.02) ou 'xml' (OFX 2.2)
+config['OFX_OUTPUT_VERSION'] = os.environ.get('OFX_OUTPUT_VERSION', 'sgml')
+# Extração de PDF: processos que leem as páginas, layout do extrato ('auto'
+# reconhece o banco pela primeira página) e JSON com layouts extras (ver
+# PDF_DEFAULT_LAYOUTS)
+config['PDF_WORKERS'] = int(os.environ.get('PDF_WORKERS', os.cpu_count() or 1))
+config['PDF_LAYOUT'] = os.environ.get('PDF_LAYOUT', 'auto')
+config['PDF_LAYOUTS_FILE'] = os.environ.get('PDF_LAYOUTS_FILE', '')
+# Armazenamento do progresso das conversões: 'memory' (dicionário do
+# processo) ou 'sqlite' (arquivo PROGRESS_DB compartilhado entre os workers
+# do gunicorn); tarefas concluídas sem atualização há PROGRESS_TTL segundos
+# são removidas (ver progress_expires)
+config['PROGRESS_BACKEND'] = os.environ.get('PROGRESS_BACKEND', 'memory')
+config['PROGRESS_DB'] = os.environ.get('PROGRESS_DB', os.path.join(tempfile.gettempdir(), 'conversor_progress.db'))
+config['PROGRESS_TTL'] = int(os.environ.get('PROGRESS_TTL', 3600))
+
+# Versão do conversor: faz parte da chave do cache de resultados e deve
+# mudar sempre que a saída de algum conversor mudar
+CONVERTER_VERSION = '2.1'
+
+# Progresso dentro de cada planilha: o relógio é consultado a cada
+# PROGRESS_ROW_BATCH linhas e o progresso gravado no máximo a cada
+# PROGRESS_UPDATE_INTERVAL segundos
+PROGRESS_ROW_BATCH = 1000
+PROGRESS_UPDATE_INTERVAL = 0.5
+
+# Linhas mantidas em memória no modo streaming para estimar a largura das
+# colunas (no modo write_only as larguras precisam vir antes das linhas)
+STREAMING_SAMPLE_ROWS = 1000
+
+# Status finais de uma conversão: gravados sem espera no armazenamento
+FINAL_STATUSES = {'completo', 'erro'}
+
+def progress_expires(data, task_exists):
+    """Indica se a entrada pode expirar por PROGRESS_TTL.
+    
+    Tarefas na fila ou em andamento nunca expiram. Lotes não têm status
+    próprio: só expiram depois que nenhum dos seus arquivos está mais no
+    armazenamento (task_exists).
+    """
+    if data.get('batch'):
+        return not any(task_exists(task['task_id']) for task in data['tasks'])
+    return data.get('status') in FINAL_STATUSES
+
+class TaskProgress(dict):
+    """Progresso de uma tarefa; update avisa o armazenamento de origem"""
+    
+    def __init__(self, store, task_id, data):
+        super().__init__(data)
+        self._store = store
+        self._task_id = task_id
+    
+    def update(self, *args, **kwargs):
+        changes = dict(*args, **kwargs)
+        super().update(changes)
+        self._store.update(self._task_id, changes)
+
+class ProgressWatch:
+    """Aviso de atualização das tarefas acompanhadas (ver ProgressWaiters.watch)"""
+    
+    def __init__(self, max_wait=None):
+        self.max_wait = max_wait
+        self._event = threading.Event()
+    
+    def set(self):
+        self._event.set()
+    
+    def wait(self, timeout):
+        """Bloqueia até uma atualização desde a última espera ou até timeout segundos"""
+        if self.max_wait is not None:
+            timeout = min(timeout, self.max_wait)
+        changed = self._event.wait(timeout)
+        self._event.clear()
+        return changed
+
+class ProgressWaiters:
+    """Quem acompanha cada tarefa: uma atualização acorda só quem acompanha aquela tarefa"""
+    
+    def __init__(self, max_wait=None):
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._watches = {}  # task_id -> ProgressWatch em uso
+    
+    def notify(self, task_id):
+        with self._lock:
+            watches = list(self._watches.get(task_id, ()))
+        for watch in watches:
+            watch.set()
+    
+    @contextlib.contextmanager
+    def watch(self, task_ids):
+        watch = ProgressWatch(self.max_wait)
+        with self._lock:
+            for task_id in task_ids:
+                self._watches.setdefault(task_id, set()).add(watch)
+        try:
+            yield watch
+        finally:
+            with self._lock:
+                for task_id in task_ids:
+                    watches = self._watches.get(task_id)
+                    if watches is not None:
+                        watches.discard(watch)
+                        if not watches:
+                            del self._watches[task_id]
+
+class MemoryProgressStore:
+    """Progresso das conversões em um dicionário do próprio processo.
+    
+    Mesma interface de dicionário usada pelos conversores
+    (conversion_progress[task_id].update({...})); entradas sem atualização
+    há mais de ttl segundos são removidas ao criar novas tarefas, se
+    progress_expires permitir.
+    """
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._touched = {}
+        self._last_sweep = time.monotonic()
+        self._waiters = ProgressWaiters()
+    
+    def update(self, task_id, changes):
+        self._touched[task_id] = time.monotonic()
+        self._waiters.notify(task_id)
+    
+    def watch(self, task_ids):
+        """Bloco em que o ProgressWatch devolvido é avisado das atualizações de task_ids"""
+        return self._waiters.watch(task_ids)
+    
+    def _sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < min(self.ttl, 60):
+            return
+        self._last_sweep = now
+        for task_id, touched in list(self._touched.items()):
+            data = self._entries.get(task_id)
+            if data is not None and (now - touched <= self.ttl or not progress_expires(data, self._entries.__contains__)):
+                continue
+            self._entries.pop(task_id, None)
+            self._touched.pop(task_id, None)
+    
+    def __getitem__(self, task_id):
+        data = self._entries[task_id]
+        self._touched[task_id] = time.monotonic()
+        return data
+    
+    def __setitem__(self, task_id, data):
+        self._sweep()
+        self._entries[task_id] = TaskProgress(self, task_id, data)
+        self.update(task_id, data)
+    
+    def __contains__(self, task_id):
+        return task_id in self._entries
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, task_id, default=None):
+        return self._entries.get(task_id, default)
+    
+    def pop(self, task_id, default=None):
+        self._touched.pop(task_id, None)
+        return self._entries.pop(task_id, default)
+    
+    def active_files(self):
+        """Arquivos de UPLOAD_FOLDER usados por tarefas na fila ou em andamento"""
+        return {
+            filename
+            for data in list(self._entries.values())
+            if data.get('status') not in FINAL_STATUSES
+            for filename in data.get('upload_files', ())
+        }
+
+class SQLiteProgressStore:
+    """Progresso das conversões em um banco SQLite compartilhado entre processos.
+    
+    As tarefas iniciadas neste processo ficam também em memória: cada update
+    só altera o dicionário local, e uma thread grava as tarefas alteradas a
+    cada flush_interval segundos. Mudanças de status (inclusive o final) são
+    gravadas na hora. Outros processos leem do banco.
+    
+    Linhas sem atualização há mais de ttl segundos expiram. A mesma thread
+    renova as tarefas deste processo que progress_expires ainda não libera
+    (na fila, em andamento ou lotes com arquivos pendentes), de modo que só
+    expiram as concluídas e as de processos encerrados.
+    """
+    
+    def __init__(self, path, ttl, flush_interval=0.5):
+        self.path = path
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._conn = threading.local()
+        self._lock = threading.Lock()
+        self._owned = {}     # tarefas deste processo -> (dados, momento da última alteração)
+        self._dirty = set()
+        self._flusher = None
+        self._last_sweep = 0.0
+        self._refresh_interval = min(ttl / 4, 60)
+        self._last_refresh = time.time()
+        # Atualizações de outros processos não avisam: a espera relê o banco
+        # a cada flush_interval
+        self._waiters = ProgressWaiters(max_wait=flush_interval)
+        
+        db = self._db()
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS progress ('
+            'task_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)'
+        )
+        db.execute('CREATE INDEX IF NOT EXISTS progress_updated ON progress (updated)')
+    
+    def _db(self):
+        # Uma conexão por thread (conexões sqlite3 não são compartilháveis)
+        db = getattr(self._conn, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._conn.db = db
+        return db
+    
+    def _write(self, task_id, data):
+        payload = json.dumps(data, default=str)
+        self._db().execute(
+            'INSERT OR REPLACE INTO progress (task_id, data, updated) VALUES (?, ?, ?)',
+            (task_id, payload, time.time())
+        )
+    
+    def _read(self, task_id):
+        row = self._db().execute(
+            'SELECT data FROM progress WHERE task_id = ? AND updated >= ?',
+            (task_id, time.time() - self.ttl)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def _sweep(self):
+        now = time.time()
+        if now - self._last_sweep < min(self.ttl, 60):
+            return
+        self._last_sweep = now
+        self._db().execute('DELETE FROM progress WHERE updated < ?', (now - self.ttl,))
+        with self._lock:
+            for task_id, (data, touched) in list(self._owned.items()):
+                if now - touched > self.ttl and progress_expires(data, self._owned.__contains__):
+                    del self._owned[task_id]
+                    self._dirty.discard(task_id)
+    
+    def _start_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+    
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+            if time.time() - self._last_refresh > self._refresh_interval:
+                self.refresh_live()
+    
+    def refresh_live(self):
+        """Renova as tarefas deste processo que ainda não podem expirar"""
+        now = time.time()
+        self._last_refresh = now
+        with self._lock:
+            live = [
+                task_id for task_id, (data, _) in self._owned.items()
+                if not progress_expires(data, self._owned.__contains__)
+            ]
+            for task_id in live:
+                self._owned[task_id] = (self._owned[task_id][0], now)
+            try:
+                self._db().executemany(
+                    'UPDATE progress SET updated = ? WHERE task_id = ?',
+                    [(now, task_id) for task_id in live]
+                )
+            except sqlite3.Error as e:
+                logging.warning(f"Erro ao renovar o progresso das tarefas: {e}")
+    
+    def flush(self):
+        """Grava as tarefas alteradas desde a última gravação"""
+        with self._lock:
+            for task_id in self._dirty:
+                if task_id not in self._owned:
+                    continue
+                try:
+                    self._write(task_id, self._owned[task_id][0])
+                except sqlite3.Error as e:
+                    logging.warning(f"Erro ao gravar progresso da tarefa {task_id}: {e}")
+            self._dirty.clear()
+    
+    def update(self, task_id, changes):
+        with self._lock:
+            if task_id not in self._owned:
+                self._owned[task_id] = (self._read(task_id) or {}, time.time())
+            data = self._owned[task_id][0]
+            status_changed = 'status' in changes and changes['status'] != data.get('status')
+            data.update(changes)
+            self._owned[task_id] = (data, time.time())
+            if status_changed:
+                self._dirty.discard(task_id)
+                self._write(task_id, data)
+            else:
+                self._dirty.add(task_id)
+                self._start_flusher()
+        self._waiters.notify(task_id)
+    
+    def watch(self, task_ids):
+        """Bloco em que o ProgressWatch devolvido é avisado das atualizações de task_ids.
+        
+        Atualizações feitas em outros processos não avisam; a espera dura no
+        máximo flush_interval, para que quem acompanha releia o banco.
+        """
+        return self._waiters.watch(task_ids)
+    
+    def __getitem__(self, task_id):
+        data = self.get(task_id)
+        if data is None:
+            raise KeyError(task_id)
+        return TaskProgress(self, task_id, data)
+    
+    def __setitem__(self, task_id, data):
+        with self._lock:
+            self._owned[task_id] = (dict(data), time.time())
+            self._dirty.discard(task_id)
+            self._write(task_id, data)
+            self._start_flusher()
+        self._waiters.notify(task_id)
+        self._sweep()
+    
+    def __contains__(self, task_id):
+        return self.get(task_id) is not None
+    
+    def __len__(self):
+        # Tarefas de todos os processos, exceto as expiradas
+        return self._db().execute(
+            'SELECT COUNT(*) FROM progress WHERE updated >= ?', (time.time() - self.ttl,)
+        ).fetchone()[0]
+    
+    def get(self, task_id, default=None):
+        with self._lock:
+            if task_id in self._owned:
+                return dict(self._owned[task_id][0])
+        data = self._read(task_id)
+        return default if data is None else data
+    
+    def pop(self, task_id, default=None):
+        data = self.get(task_id, default)
+        with self._lock:
+            self._owned.pop(task_id, None)
+            self._dirty.discard(task_id)
+        self._db().execute('DELETE FROM progress WHERE task_id = ?', (task_id,))
+        return data
+    
+    def active_files(self):
+        """Arquivos de UPLOAD_FOLDER usados por tarefas na fila ou em andamento, de todos os processos"""
+        files = set()
+        rows = self._db().execute('SELECT data FROM progress WHERE updated >= ?', (time.time() - self.ttl,))
+        for (payload,) in rows:
+            data = json.loads(payload)
+            if data.get('status') not in FINAL_STATUSES:
+                files.update(data.get('upload_files', ()))
+        return files
+
+def create_progress_store():
+    """Cria o armazenamento de progresso configurado em PROGRESS_BACKEND"""
+    backend = config['PROGRESS_BACKEND']
+    if backend == 'sqlite':
+        return SQLiteProgressStore(config['PROGRESS_DB'], config['PROGRESS_TTL'])
+    if backend != 'memory':
+        raise ValueError(f"PROGRESS_BACKEND inválido: {backend}")
+    return MemoryProgressStore(config['PROGRESS_TTL'])
+
+# Progresso das conversões, por task_id
+conversion_progress = create_progress_store()
+
+# Campos gravados antes da conversão que os conversores mantêm ao
+# reiniciar o progresso (ver start_progress): upload_files são os arquivos
+# de UPLOAD_FOLDER que a limpeza não pode remover antes do fim da tarefa, e
+# queue_wait os segundos de espera na fila (ver ConversionScheduler)
+TASK_LINK_FIELDS = ('upload_files', 'queue_wait')
+
+def start_progress(task_id, message):
+    """Progresso inicial de uma conversão, mantendo os campos de TASK_LINK_FIELDS já registrados"""
+    previous = conversion_progress.get(task_id) or {}
+    conversion_progress[task_id] = dict(
+        {field: previous[field] for field in TASK_LINK_FIELDS if field in previous},
+        status='iniciando',
+        progress=0,
+        message=message,
+        filename=None,
+        error=None,
+        start_time=datetime.now().isoformat()
+    )
+
+class StageTimer:
+    """Tempo por etapa e contadores de linhas e células de uma conversão.
+    
+    As etapas são medidas em blocos inteiros (uma planilha, o save), nunca
+    por célula; count_rows acrescenta apenas uma soma por linha.
+    """
+    
+    def __init__(self):
+        self.stages = {}
+        self.rows = 0
+        self.cells = 0
+        self._start = time.perf_counter()
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+    
+    def count_rows(self, rows):
+        """Repassa as linhas contando linhas e células"""
+        for row in rows:
+            self.rows += 1
+            self.cells += len(row)
+            yield row
+    
+    def elapsed(self):
+        return time.perf_counter() - self._start
+    
+    def as_dict(self):
+        return {
+            'timings': {name: round(seconds, 4) for name, seconds in self.stages.items()},
+            'total_seconds': round(self.elapsed(), 4),
+            'rows': self.rows,
+            'cells': self.cells
+        }
+
+class ConversionMetrics:
+    """Métricas das conversões deste processo, exportadas em /metrics.
+    
+    Histogramas de duração total e por etapa, por tipo de conversão, e
+    contadores de conversões, linhas e células. Cada processo do servidor
+    tem as próprias métricas.
+    """
+    
+    BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._durations = {}  # tipo -> [contagem por faixa, soma, total]
+        self._stages = {}     # (tipo, etapa) -> [contagem por faixa, soma, total]
+        self._conversions = Counter()  # (tipo, status)
+        self._rows = Counter()
+        self._cells = Counter()
+    
+    def _observe(self, histograms, key, value):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(self.BUCKETS, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+    
+    def observe(self, conversion_type, status, timer):
+        """Registra uma conversão encerrada"""
+        with self._lock:
+            self._conversions[(conversion_type, status)] += 1
+            self._rows[conversion_type] += timer.rows
+            self._cells[conversion_type] += timer.cells
+            self._observe(self._durations, conversion_type, timer.elapsed())
+            for name, seconds in timer.stages.items():
+                self._observe(self._stages, (conversion_type, name), seconds)
+    
+    def _histogram_lines(self, name, labels, histogram):
+        counts, total, count = histogram
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.BUCKETS + ('+Inf',), counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {total:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {count}')
+        return lines
+    
+    def render(self):
+        """Métricas no formato texto do Prometheus"""
+        with self._lock:
+            lines = [
+                '# HELP conversor_conversion_duration_seconds Duração total das conversões.',
+                '# TYPE conversor_conversion_duration_seconds histogram'
+            ]
+            for conversion_type, histogram in sorted(self._durations.items()):
+                lines += self._histogram_lines('conversor_conversion_duration_seconds', f'type="{conversion_type}"', histogram)
+            
+            lines += [
+                '# HELP conversor_stage_duration_seconds Duração de cada etapa das conversões.',
+                '# TYPE conversor_stage_duration_seconds histogram'
+            ]
+            for (conversion_type, stage), histogram in sorted(self._stages.items()):
+                lines += self._histogram_lines('conversor_stage_duration_seconds', f'type="{conversion_type}",stage="{stage}"', histogram)
+            
+            lines += [
+                '# HELP conversor_conversions_total Conversões encerradas, por status.',
+                '# TYPE conversor_conversions_total counter'
+            ]
+            for (conversion_type, status), count in sorted(self._conversions.items()):
+                lines.append(f'conversor_conversions_total{{type="{conversion_type}",status="{status}"}} {count}')
+            
+            for name, counter, help_text in (
+                ('conversor_rows_total', self._rows, 'Linhas gravadas.'),
+                ('conversor_cells_total', self._cells, 'Células gravadas.')
+            ):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+                for conversion_type, count in sorted(counter.items()):
+                    lines.append(f'{name}{{type="{conversion_type}"}} {count}')
+        return lines
+
+conversion_metrics = ConversionMetrics()
+
+def record_conversion_metrics(task_id, conversion_type, timer):
+    """Publica os tempos da conversão em details e nas métricas de /metrics"""
+    progress = conversion_progress.get(task_id) or {}
+    conversion_metrics.observe(conversion_type, progress.get('status', 'erro'), timer)
+    if task_id in conversion_progress:
+        conversion_progress[task_id].update({
+            'details': dict(progress.get('details') or {}, **timer.as_dict())
+        })
+
+# Estilos fixos das células convertidas (índices da tabela de build_style_table)
+STYLE_NONE = 0          # célula vazia: sem formatação nem borda
+STYLE_BORDER = 1        # texto comum e demais tipos: apenas borda
+STYLE_INTEGER = 2       # número inteiro: '#,##0'
+STYLE_DECIMAL = 3       # número decimal: '#,##0.00'
+STYLE_WRAP = 4          # texto longo: quebra de linha
+STYLE_HEADER = 5        # cabeçalho/total: negrito com fundo cinza
+STYLE_HEADER_WRAP = 6   # cabeçalho/total longo
+
+def make_style_array(wb, number_format='General', font=None, fill=None, alignment=None, border=None):
+    """Registra os componentes de um estilo no workbook e devolve o StyleArray"""
+    style = StyleArray()
+    if number_format in BUILTIN_FORMATS_REVERSE:
+        style.numFmtId = BUILTIN_FORMATS_REVERSE[number_format]
+    else:
+        style.numFmtId = wb._number_formats.add(number_format) + BUILTIN_FORMATS_MAX_SIZE
+    if font is not None:
+        style.fontId = wb._fonts.add(font)
+    if fill is not None:
+        style.fillId = wb._fills.add(fill)
+    if alignment is not None:
+        style.alignmentId = wb._alignments.add(alignment)
+    if border is not None:
+        style.borderId = wb._borders.add(border)
+    return style
+
+def build_style_table(wb):
+    """Registra os estilos fixos no workbook e devolve um StyleArray por estilo.
+    
+    Fontes, preenchimentos, bordas e alinhamentos são criados uma única vez;
+    as células recebem apenas uma cópia do StyleArray correspondente. Como a
+    ordem de registro é fixa, os índices de estilo são iguais em qualquer
+    workbook (o motor 'parallel' depende disso).
+    """
+    thin_border = Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'), 
+        bottom=Side(style='thin')
+    )
+    bold = Font(bold=True)
+    gray_fill = PatternFill(start_color="DDDDDD", fill_type="solid")
+    wrap = Alignment(wrap_text=True)
+    
+    table = [
+        make_style_array(wb),
+        make_style_array(wb, border=thin_border),
+        make_style_array(wb, number_format='#,##0', border=thin_border),
+        make_style_array(wb, number_format='#,##0.00', border=thin_border),
+        make_style_array(wb, alignment=wrap, border=thin_border),
+        make_style_array(wb, font=bold, fill=gray_fill, border=thin_border),
+        make_style_array(wb, font=bold, fill=gray_fill, alignment=wrap, border=thin_border)
+    ]
+    for style in table:
+        wb._cell_styles.add(style)
+    
+    return table
+
+def estimate_width(value):
+    """Comprimento aproximado do valor exibido, sem formatar números como texto"""
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        magnitude = abs(value)
+        if magnitude != magnitude or magnitude == float('inf'):
+            return 3
+        digits = int(math.log10(magnitude)) + 1 if magnitude >= 1 else 1
+        # Separadores de milhar e casas decimais de '#,##0' / '#,##0.00'
+        width = digits + (digits - 1) // 3
+        if isinstance(value, float) and not value.is_integer():
+            width += 3
+        return width + (value < 0)
+    return len(str(value))
+
+def apply_column_widths(ws_out, widths, min_width=8, max_width=50):
+    """Define a largura das colunas a partir dos comprimentos acumulados na escrita"""
+    for col_idx, max_length in widths.items():
+        adjusted_width = min(max(max_length + 2, min_width), max_width)
+        ws_out.column_dimensions[get_column_letter(col_idx)].width = adjusted_width
+
+def detect_formatting(value):
+    """Classifica o valor da célula em um dos estilos fixos (STYLE_*)"""
+    if value is None:
+        return STYLE_NONE
+    
+    try:
+        # Detectar números
+        if isinstance(value, (int, float)):
+            if isinstance(value, int) or value == int(value):
+                return STYLE_INTEGER
+            return STYLE_DECIMAL
+        
+        # Detectar texto longo e cabeçalhos/totais
+        elif isinstance(value, str):
+            wrap = len(value) > 20
+            if value.isupper() or any(word in value.lower() for word in ['total', 'soma', 'quantidade', 'valor']):
+                return STYLE_HEADER_WRAP if wrap else STYLE_HEADER
+            return STYLE_WRAP if wrap else STYLE_BORDER
+    
+    except Exception:
+        pass
+    
+    return STYLE_BORDER
+
+def apply_formatting(cell, style_id, style_table):
+    """Aplica um dos estilos fixos a uma célula"""
+    cell._style = StyleArray(style_table[style_id])
+
+def classify_column(values):
+    """Versão vetorizada de detect_formatting para uma coluna inteira (array object)"""
+    codes = np.full(len(values), STYLE_BORDER, dtype=np.int8)
+    if len(values) == 0:
+        return codes
+    
+    # Colunas só de inteiros dispensam a separação por tipo
+    if pd.api.types.infer_dtype(values, skipna=False) in ('integer', 'boolean'):
+        codes[:] = STYLE_INTEGER
+        return codes
+    
+    types = np.fromiter(map(type, values), dtype=object, count=len(values))
+    is_none = types == type(None)
+    is_int = (types == int) | (types == bool)
+    is_float = types == float
+    is_str = types == str
+    
+    codes[is_none] = STYLE_NONE
+    codes[is_int] = STYLE_INTEGER
+    
+    # Números: máscara de integralidade (NaN/infinito ficam só com borda)
+    if is_float.any():
+        numbers = values[is_float].astype(np.float64)
+        finite = np.isfinite(numbers)
+        integral = finite & (numbers == np.floor(np.where(finite, numbers, 0)))
+        codes[is_float] = np.select([integral, finite], [STYLE_INTEGER, STYLE_DECIMAL], STYLE_BORDER)
+    
+    # Textos: quebra de linha para textos longos e destaque para cabeçalhos/totais
+    if is_str.any():
+        strings = pd.Series(values[is_str], dtype=object)
+        wrap = (strings.str.len() > 20).to_numpy()
+        header = (
+            strings.str.isupper()
+            | strings.str.lower().str.contains('total|soma|quantidade|valor', regex=True)
+        ).to_numpy(dtype=bool)
+        codes[is_str] = np.select(
+            [header & wrap, header, wrap],
+            [STYLE_HEADER_WRAP, STYLE_HEADER, STYLE_WRAP],
+            STYLE_BORDER
+        )
+    
+    # Demais tipos (datas, escalares numpy...) seguem pela classificação célula a célula
+    other = ~(is_none | is_int | is_float | is_str)
+    if other.any():
+        codes[other] = [detect_formatting(value) for value in values[other]]
+    
+    return codes
+
+# Tags OFX usadas na planilha, com o texto que vem depois delas até o fim da
+# linha ou a próxima tag. Serve para SGML (OFX 1.x, tags de valor sem
+# fechamento) e XML (OFX 2.x, cujos fechamentos são ignorados); as demais
+# tags nem chegam ao Python
+OFX_TOKEN_RE = re.compile(r'<(/?STMTTRN|TRNTYPE|DTPOSTED|TRNAMT|MEMO|FITID|CHECKNUM|BANKID|ACCTID)>([^<\r\n]*)')
+# Pedaços em que o conteúdo é percorrido (limita a lista de tokens em memória)
+OFX_CHUNK_SIZE = 1024 * 1024
+OFX_DEFAULT_BANK_ID = "0001"
+OFX_DEFAULT_ACCOUNT_ID = "000000001"
+
+def parse_ofx_amount(text):
+    """Converte o valor OFX em float, com vírgula decimal e pontos de milhar (formato brasileiro)"""
+    amount = text.replace(' ', '').replace(',', '.')
+    if amount.count('.') > 1:
+        # Mais de um ponto: só o último é decimal
+        integer, _, decimals = amount.rpartition('.')
+        amount = integer.replace('.', '') + '.' + decimals
+    try:
+        return float(amount)
+    except ValueError as e:
+        logging.warning(f"Erro ao converter valor '{text}': {e}")
+        return 0.0
+
+def format_ofx_date(dtposted):
+    """Data OFX (YYYYMMDDHHMMSS...) no formato YYYY-MM-DD"""
+    if len(dtposted) >= 8:
+        return f"{dtposted[0:4]}-{dtposted[4:6]}-{dtposted[6:8]}"
+    return dtposted
+
+def ofx_transaction_row(fields, bank_id, account_id):
+    return {
+        'Data': format_ofx_date(fields['DTPOSTED'].strip()),
+        'Tipo': fields['TRNTYPE'].strip(),
+        'Valor': parse_ofx_amount(fields['TRNAMT'].strip()),
+        'Descrição': fields.get('MEMO', '').strip(),
+        'ID': fields.get('FITID', '').strip(),
+        'Cheque': fields.get('CHECKNUM', '').strip(),
+        'Banco': bank_id,
+        'Conta': account_id
+    }
+
+def iter_ofx_transactions(chunks):
+    """Transações de um OFX em uma única passada, já no formato da planilha.
+    
+    chunks são pedaços consecutivos do arquivo (ou [conteúdo]); uma tag
+    partida entre dois pedaços é completada com o pedaço seguinte. Cada
+    transação leva o banco e a conta declarados antes dela no extrato.
+    """
+    bank_id, account_id = OFX_DEFAULT_BANK_ID, OFX_DEFAULT_ACCOUNT_ID
+    fields = None
+    pending = ''
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is None:
+            text, pending = pending, ''
+        else:
+            # O trecho a partir da última tag pode estar incompleto
+            text = pending + chunk
+            cut = max(text.rfind('<'), 0)
+            text, pending = text[:cut], text[cut:]
+        
+        for tag, value in OFX_TOKEN_RE.findall(text):
+            if tag == 'STMTTRN' or tag == '/STMTTRN':
+                # Uma transação sem </STMTTRN> termina onde começa a seguinte
+                if fields and 'TRNTYPE' in fields and 'DTPOSTED' in fields and 'TRNAMT' in fields:
+                    yield ofx_transaction_row(fields, bank_id, account_id)
+                fields = {} if tag == 'STMTTRN' else None
+            elif fields is not None:
+                if tag not in fields:
+                    fields[tag] = value
+            elif tag == 'BANKID':
+                digits = re.match(r'\s*(\d+)', value)
+                if digits:
+                    bank_id = digits.group(1)
+            elif tag == 'ACCTID' and value.strip():
+                account_id = value.strip()
+    
+    if fields and 'TRNTYPE' in fields and 'DTPOSTED' in fields and 'TRNAMT' in fields:
+        yield ofx_transaction_row(fields, bank_id, account_id)
+
+def parse_ofx_content(content):
+    """Parse OFX content to extract transactions - corrigido para formato brasileiro"""
+    chunks = (content[start:start + OFX_CHUNK_SIZE] for start in range(0, len(content), OFX_CHUNK_SIZE))
+    return list(iter_ofx_transactions(chunks))
+
+# Colunas da planilha de transações OFX (mesma ordem de ofx_transaction_row)
+OFX_COLUMNS = ['Data', 'Tipo', 'Valor', 'Descrição', 'ID', 'Cheque', 'Banco', 'Conta']
+
+class OfxOrderError(Exception):
+    """Transação fora da ordem de data no motor 'streaming' do OFX"""
+
+def ofx_styles(wb_out):
+    """Estilos da planilha de transações: (cabeçalho, valor, demais células)"""
+    thin_border = Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'), 
+        bottom=Side(style='thin')
+    )
+    # Cabeçalho no mesmo padrão do pandas (centralizado), em negrito e fundo cinza
+    header_style = make_style_array(
+        wb_out,
+        font=Font(bold=True),
+        fill=PatternFill(start_color="DDDDDD", fill_type="solid"),
+        alignment=Alignment(horizontal='center', vertical='top'),
+        border=thin_border
+    )
+    # Coluna de valor como moeda brasileira
+    money_style = make_style_array(wb_out, number_format='"R$" #,##0.00', border=thin_border)
+    cell_style = make_style_array(wb_out, border=thin_border)
+    return header_style, money_style, cell_style
+
+def convert_ofx_pandas(filepath_in, filepath_out, task_id, timer):
+    """Motor 'pandas' do OFX: lê o arquivo inteiro, ordena em um DataFrame e grava com openpyxl"""
+    # Ler conteúdo do arquivo OFX
+    with timer.stage('read'), open(filepath_in, 'r', encoding='utf-8', errors='ignore') as f:
+        content = f.read()
+    
+    conversion_progress[task_id].update({
+        'progress': 30,
+        'message': 'Analisando transações OFX...'
+    })
+    
+    # Parse do conteúdo OFX
+    with timer.stage('parse'):
+        transactions = parse_ofx_content(content)
+    
+    conversion_progress[task_id].update({
+        'progress': 60,
+        'message': f'{len(transactions)} transações encontradas'
+    })
+    
+    if not transactions:
+        raise Exception("Nenhuma transação encontrada no arquivo OFX")
+    
+    # Criar DataFrame
+    with timer.stage('dataframe'):
+        df = pd.DataFrame(transactions)
+        
+        # Ordenar por data
+        if 'Data' in df.columns:
+            df = df.sort_values('Data')
+    
+    conversion_progress[task_id].update({
+        'progress': 80,
+        'message': 'Criando arquivo Excel...'
+    })
+    
+    # Criar arquivo Excel: valores, estilos e largura das colunas em uma única passada
+    wb_out = Workbook()
+    ws_out = wb_out.active
+    ws_out.title = 'Transações'
+    header_style, money_style, cell_style = ofx_styles(wb_out)
+    
+    columns = list(df.columns)
+    money_col = columns.index('Valor') + 1
+    widths = dict.fromkeys(range(1, len(columns) + 1), 0)
+    rows = itertools.chain([columns], df.itertuples(index=False, name=None))
+    
+    with timer.stage('write'):
+        for row_idx, row in enumerate(rows, 1):
+            for col_idx, value in enumerate(row, 1):
+                cell = ws_out.cell(row=row_idx, column=col_idx, value=value)
+                if row_idx == 1:
+                    cell._style = StyleArray(header_style)
+                elif col_idx == money_col:
+                    cell._style = StyleArray(money_style)
+                else:
+                    cell._style = StyleArray(cell_style)
+                
+                if value:
+                    length = estimate_width(value)
+                    if length > widths[col_idx]:
+                        widths[col_idx] = length
+    timer.rows = len(df) + 1
+    timer.cells = timer.rows * len(columns)
+    
+    # Ajustar largura das colunas
+    with timer.stage('column_widths'):
+        apply_column_widths(ws_out, widths, min_width=10)
+    
+    with timer.stage('save'):
+        wb_out.save(filepath_out)
+    
+    return len(transactions)
+
+def iter_ofx_file(filepath_in, report=None):
+    """Transações do arquivo OFX lido em pedaços de OFX_CHUNK_SIZE bytes.
+    
+    report(bytes_lidos) é chamado a cada pedaço.
+    """
+    def chunks():
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        bytes_read = 0
+        with open(filepath_in, 'rb') as f:
+            for data in iter(lambda: f.read(OFX_CHUNK_SIZE), b''):
+                bytes_read += len(data)
+                if report is not None:
+                    report(bytes_read)
+                yield decoder.decode(data)
+        yield decoder.decode(b'', final=True)
+    return iter_ofx_transactions(chunks())
+
+def ensure_date_order(transactions):
+    """Repassa as transações; levanta OfxOrderError na primeira com data anterior à da anterior"""
+    last_date = ''
+    for transaction in transactions:
+        if transaction['Data'] < last_date:
+            raise OfxOrderError(f"Transação de {transaction['Data']} depois de {last_date}")
+        last_date = transaction['Data']
+        yield transaction
+
+def ofx_sample_widths(sample):
+    """Largura das colunas da planilha de transações a partir de uma amostra de linhas"""
+    widths = dict.fromkeys(range(1, len(OFX_COLUMNS) + 1), 0)
+    widths.update(sample_column_widths([OFX_COLUMNS] + sample))
+    return widths
+
+def start_ofx_sheet(wb_out, title, widths, styles):
+    """Cria uma planilha de transações write_only, com larguras e cabeçalho.
+    
+    Devolve (planilha, células das colunas): uma célula estilizada por
+    coluna, reaproveitada em todas as linhas. O write_only serializa a
+    linha dentro de append, então basta trocar o valor.
+    """
+    header_style, money_style, cell_style = styles
+    ws_out = wb_out.create_sheet(title=title)
+    # No modo write_only as larguras precisam vir antes das linhas
+    apply_column_widths(ws_out, widths, min_width=10)
+    
+    header = []
+    for column in OFX_COLUMNS:
+        cell = WriteOnlyCell(ws_out, value=column)
+        cell._style = StyleArray(header_style)
+        header.append(cell)
+    ws_out.append(header)
+    
+    column_cells = []
+    for column in OFX_COLUMNS:
+        cell = WriteOnlyCell(ws_out)
+        cell._style = StyleArray(money_style if column == 'Valor' else cell_style)
+        column_cells.append(cell)
+    return ws_out, column_cells
+
+@contextlib.contextmanager
+def write_only_workbook():
+    """Workbook write_only que apaga os temporários das planilhas se a gravação falhar.
+    
+    Cada planilha write_only grava as linhas em um arquivo temporário que o
+    openpyxl só remove no save ou ao fim do processo.
+    """
+    wb_out = Workbook(write_only=True)
+    try:
+        yield wb_out
+    except BaseException:
+        for ws_out in wb_out.worksheets:
+            with contextlib.suppress(Exception):
+                if ws_out._rows is not None:
+                    ws_out._rows.close()
+                if ws_out._writer is not None:
+                    ws_out._writer.close()
+                    ws_out._writer.cleanup()
+        raise
+
+def write_ofx_streaming(filepath_out, transactions, timer):
+    """Grava as transações em um workbook write_only, uma linha por vez; devolve o número de transações"""
+    rows = (tuple(transaction.values()) for transaction in transactions)
+    with write_only_workbook() as wb_out:
+        with timer.stage('write'):
+            # Amostra inicial para a largura das colunas
+            sample = list(itertools.islice(rows, STREAMING_SAMPLE_ROWS))
+            ws_out, column_cells = start_ofx_sheet(wb_out, 'Transações', ofx_sample_widths(sample), ofx_styles(wb_out))
+            
+            count = 0
+            for row in itertools.chain(sample, rows):
+                for cell, value in zip(column_cells, row):
+                    cell.value = value
+                ws_out.append(column_cells)
+                count += 1
+        
+        if not count:
+            raise Exception("Nenhuma transação encontrada no arquivo OFX")
+        
+        timer.rows = count + 1
+        timer.cells = timer.rows * len(OFX_COLUMNS)
+        with timer.stage('save'):
+            wb_out.save(filepath_out)
+    return count
+
+def convert_ofx_streaming(filepath_in, filepath_out, task_id, timer):
+    """Motor 'streaming' do OFX: lê o arquivo em pedaços e grava cada transação ao ser lida.
+    
+    Extratos já em ordem de data (o caso comum) são convertidos em uma única
+    passada, com memória constante. Na primeira transação fora de ordem a
+    gravação é descartada (com o temporário da planilha, ver
+    write_only_workbook) e o arquivo é lido de novo, ordenado em memória.
+    """
+    file_size = os.path.getsize(filepath_in) or 1
+    
+    def report(bytes_read):
+        conversion_progress[task_id].update({
+            'progress': 30 + (bytes_read * 60 / file_size),
+            'message': f'Processando transações ({bytes_read / 1024 / 1024:.1f} MB lidos)'
+        })
+    
+    try:
+        return write_ofx_streaming(filepath_out, ensure_date_order(iter_ofx_file(filepath_in, report)), timer)
+    except OfxOrderError as e:
+        logging.info(f"Transações fora de ordem ({e}); ordenando em memória")
+    
+    conversion_progress[task_id].update({
+        'progress': 30,
+        'message': 'Ordenando transações por data...'
+    })
+    with timer.stage('sort'):
+        transactions = sorted(iter_ofx_file(filepath_in), key=operator.itemgetter('Data'))
+    
+    conversion_progress[task_id].update({
+        'progress': 80,
+        'message': f'{len(transactions)} transações encontradas'
+    })
+    return write_ofx_streaming(filepath_out, transactions, timer)
+
+# Motores disponíveis para a conversão OFX -> XLSX (ver OFX_ENGINE)
+OFX_ENGINES = {
+    'pandas': convert_ofx_pandas,
+    'streaming': convert_ofx_streaming
+}
+
+def convert_ofx_to_xlsx(filepath_in, filepath_out, task_id, engine=None):
+    """Converte arquivo OFX para XLSX"""
+    timer = StageTimer()
+    try:
+        logging.info(f"Iniciando conversão OFX para XLSX: {filepath_in}")
+        
+        start_progress(task_id, 'Iniciando conversão OFX...')
+        
+        if not os.path.exists(filepath_in):
+            raise FileNotFoundError(f"Arquivo não encontrado: {filepath_in}")
+        
+        engine = engine or config['OFX_ENGINE']
+        if engine not in OFX_ENGINES:
+            raise ValueError(f"Motor de conversão desconhecido: {engine}")
+        
+        file_size = os.path.getsize(filepath_in)
+        conversion_progress[task_id].update({
+            'progress': 10,
+            'message': f'Arquivo OFX carregado ({file_size / 1024:.1f} KB)'
+        })
+        
+        transaction_count = OFX_ENGINES[engine](filepath_in, filepath_out, task_id, timer)
+        
+        conversion_progress[task_id].update({
+            'progress': 100,
+            'message': f'Conversão concluída! {transaction_count} transações processadas',
+            'status': 'completo',
+            'filename': os.path.basename(filepath_out),
+            'end_time': datetime.now().isoformat()
+        })
+        
+        logging.info(f"Conversão OFX->XLSX bem-sucedida ({engine}): {filepath_out}")
+        
+    except Exception as e:
+        error_msg = f"Erro na conversão OFX: {str(e)}"
+        logging.error(error_msg)
+        conversion_progress[task_id].update({
+            'status': 'erro',
+            'message': error_msg,
+            'error': str(e),
+            'end_time': datetime.now().isoformat()
+        })
+    
+    record_conversion_metrics(task_id, 'ofx_to_xlsx', timer)
+
+# Caracteres não permitidos em nomes de planilha
+SHEET_TITLE_INVALID_RE = re.compile(r'[\\/*?:\[\]]')
+
+def is_ofx_date_ordered(filepath_in, report=None):
+    """Indica se as transações do arquivo estão em ordem de data (uma leitura em pedaços)"""
+    try:
+        deque(ensure_date_order(iter_ofx_file(filepath_in, report)), maxlen=0)
+    except OfxOrderError as e:
+        logging.info(f"Transações fora de ordem em {filepath_in} ({e})")
+        return False
+    return True
+
+class OfxDeduplicator:
+    """Índice das transações já gravadas na consolidação de extratos.
+    
+    Transações com FITID são identificadas por (banco, conta, FITID) em um
+    índice hash. Sem FITID, a chave é (banco, conta, valor, descrição) na
+    data corrente: como a consolidação segue em ordem de data, o índice
+    reserva só guarda um dia. Transações iguais sem FITID no mesmo extrato
+    são legítimas (duas compras idênticas no mesmo dia), então só são
+    descartadas as que outro extrato já trouxe na mesma quantidade.
+    """
+    
+    def __init__(self):
+        self.duplicates = 0
+        self._fitids = set()
+        self._fallback_date = None
+        self._fallback = {}  # chave -> [gravadas, Counter(extrato -> vistas)]
+    
+    def is_duplicate(self, transaction, source):
+        account = (transaction['Banco'], transaction['Conta'])
+        if transaction['ID']:
+            key = account + (transaction['ID'],)
+            if key in self._fitids:
+                self.duplicates += 1
+                return True
+            self._fitids.add(key)
+            return False
+        
+        if transaction['Data'] != self._fallback_date:
+            self._fallback_date = transaction['Data']
+            self._fallback.clear()
+        key = account + (transaction['Valor'], transaction['Descrição'])
+        entry = self._fallback.get(key)
+        if entry is None:
+            entry = self._fallback[key] = [0, Counter()]
+        entry[1][source] += 1
+        if entry[1][source] <= entry[0]:
+            self.duplicates += 1
+            return True
+        entry[0] = entry[1][source]
+        return False
+
+def write_ofx_merged(filepath_out, sources, timer):
+    """Intercala os extratos por data e grava cada conta em uma planilha.
+    
+    sources são iteráveis de transações de cada extrato, cada um em ordem
+    de data; heapq.merge mantém só a transação corrente de cada extrato.
+    Devolve (transações gravadas por conta, duplicatas descartadas).
+    """
+    dedup = OfxDeduplicator()
+    merged = heapq.merge(
+        *(zip(source, itertools.repeat(index)) for index, source in enumerate(sources)),
+        key=lambda item: item[0]['Data']
+    )
+    transactions = (transaction for transaction, source in merged if not dedup.is_duplicate(transaction, source))
+    
+    wb_out = Workbook(write_only=True)
+    styles = ofx_styles(wb_out)
+    sheets = {}  # (banco, conta) -> (planilha, células das colunas)
+    counts = Counter()
+    with timer.stage('write'):
+        # Mesmas larguras em todas as planilhas, pela amostra inicial
+        sample = list(itertools.islice(transactions, STREAMING_SAMPLE_ROWS))
+        widths = ofx_sample_widths([tuple(transaction.values()) for transaction in sample])
+        
+        for transaction in itertools.chain(sample, transactions):
+            account = (transaction['Banco'], transaction['Conta'])
+            if account not in sheets:
+                title = SHEET_TITLE_INVALID_RE.sub('', f'{account[0]}-{account[1]}')[:31]
+                sheets[account] = start_ofx_sheet(wb_out, title, widths, styles)
+            ws_out, column_cells = sheets[account]
+            for cell, value in zip(column_cells, transaction.values()):
+                cell.value = value
+            ws_out.append(column_cells)
+            counts[account] += 1
+    
+    if not counts:
+        raise Exception("Nenhuma transação encontrada nos arquivos OFX")
+    
+    timer.rows = sum(counts.values()) + len(counts)
+    timer.cells = timer.rows * len(OFX_COLUMNS)
+    with timer.stage('save'):
+        wb_out.save(filepath_out)
+    return counts, dedup.duplicates
+
+def merge_ofx_to_xlsx(filepaths_in, filepath_out, task_id, input_names=None):
+    """Consolida vários extratos OFX em um XLSX, sem duplicatas, com uma planilha por conta.
+    
+    Cada extrato é lido em pedaços e as transações são intercaladas por
+    data (ver write_ofx_merged). Extratos fora de ordem de data são
+    ordenados em memória antes do intercalamento. input_names são os nomes
+    dos arquivos enviados, mostrados nos detalhes no lugar dos nomes em disco.
+    """
+    timer = StageTimer()
+    try:
+        logging.info(f"Iniciando consolidação de {len(filepaths_in)} arquivos OFX")
+        
+        start_progress(task_id, 'Iniciando consolidação OFX...')
+        
+        for filepath_in in filepaths_in:
+            if not os.path.exists(filepath_in):
+                raise FileNotFoundError(f"Arquivo não encontrado: {filepath_in}")
+        
+        total_size = sum(os.path.getsize(filepath_in) for filepath_in in filepaths_in) or 1
+        bytes_read = [0] * len(filepaths_in)
+        
+        def reporter(index, start, span, message):
+            def report(file_bytes_read):
+                bytes_read[index] = file_bytes_read
+                conversion_progress[task_id].update({
+                    'progress': start + (sum(bytes_read) * span / total_size),
+                    'message': f'{message} ({sum(bytes_read) / 1024 / 1024:.1f} MB lidos)'
+                })
+            return report
+        
+        # Primeira leitura só confere a ordem de data: o intercalamento
+        # precisa de cada extrato ordenado, e os que não estão são
+        # ordenados em memória
+        with timer.stage('scan'):
+            ordered = [
+                is_ofx_date_ordered(filepath_in, reporter(index, 10, 20, 'Verificando extratos'))
+                for index, filepath_in in enumerate(filepaths_in)
+            ]
+        
+        bytes_read[:] = [0] * len(filepaths_in)
+        sources = []
+        for index, filepath_in in enumerate(filepaths_in):
+            transactions = iter_ofx_file(filepath_in, reporter(index, 30, 60, 'Consolidando transações'))
+            if not ordered[index]:
+                with timer.stage('sort'):
+                    transactions = sorted(transactions, key=operator.itemgetter('Data'))
+            sources.append(transactions)
+        
+        counts, duplicates = write_ofx_merged(filepath_out, sources, timer)
+        
+        transaction_count = sum(counts.values())
+        conversion_progress[task_id].update({
+            'progress': 100,
+            'message': f'Consolidação concluída! {transaction_count} transações em {len(counts)} contas ({duplicates} duplicadas descartadas)',
+            'status': 'completo',
+            'filename': os.path.basename(filepath_out),
+            'end_time': datetime.now().isoformat(),
+            'details': {
+                'input_files': input_names or [os.path.basename(filepath_in) for filepath_in in filepaths_in],
+                'conversion_type': 'ofx_merge',
+                'accounts': {f'{bank_id}-{account_id}': count for (bank_id, account_id), count in counts.items()},
+                'duplicates': duplicates
+            }
+        })
+        
+        logging.info(f"Consolidação OFX bem-sucedida: {filepath_out}")
+        
+    except Exception as e:
+        error_msg = f"Erro na consolidação OFX: {str(e)}"
+        logging.error(error_msg)
+        conversion_progress[task_id].update({
+            'status': 'erro',
+            'message': error_msg,
+            'error': str(e),
+            'end_time': datetime.now().isoformat()
+        })
+    
+    record_conversion_metrics(task_id, 'ofx_merge', timer)
+
+# Layouts de extrato em PDF: nome -> regras aplicadas ao texto de cada página.
+#   detect: regex procurada na primeira página para reconhecer o banco
+#   row: regex de uma linha de transação, com os grupos data (dd/mm,
+#        dd/mm/aa ou dd/mm/aaaa), descricao, valor (formato brasileiro) e,
+#        opcionais, tipo (C/D ou '-' depois do valor)
+#   skip: regex das linhas que casam com row mas não são transações (saldos)
+#   account: regex da primeira página com o grupo conta
+#   bank_id: código do banco no OFX
+# Layouts extras (ou que substituem estes) vêm do JSON em PDF_LAYOUTS_FILE
+PDF_DEFAULT_LAYOUTS = {
+    'generico': {
+        'row': r'^(?P<data>\d{2}/\d{2}(?:/\d{2,4})?)\s+(?P<descricao>.+?)\s+'
+               r'(?P<valor>-?\s?(?:\d{1,3}(?:\.\d{3})+|\d+),\d{2})\s*(?P<tipo>[CD-])?'
+               r'(?:\s+-?\s?(?:\d{1,3}(?:\.\d{3})+|\d+),\d{2}\s*[CD-]?)?$',
+        'skip': r'SALDO',
+        'account': r'CONTA(?:\s+CORRENTE)?\s*:?\s*(?P<conta>[\d.-]+)',
+        'bank_id': OFX_DEFAULT_BANK_ID
+    }
+}
+
+def load_pdf_layouts(path):
+    """Layouts padrão mais os do arquivo JSON em path, se houver"""
+    layouts = dict(PDF_DEFAULT_LAYOUTS)
+    if path:
+        with open(path, encoding='utf-8') as f:
+            layouts.update(json.load(f))
+    return layouts
+
+PDF_LAYOUTS = load_pdf_layouts(config['PDF_LAYOUTS_FILE'])
+# Faz parte da variante do cache de resultados do PDF -> OFX
+PDF_LAYOUTS_DIGEST = hashlib.sha1(json.dumps(PDF_LAYOUTS, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+def detect_pdf_layout(text):
+    """Nome do layout configurado em PDF_LAYOUT ou, em 'auto', do primeiro cujo detect aparece no texto"""
+    name = config['PDF_LAYOUT']
+    if name != 'auto':
+        if name not in PDF_LAYOUTS:
+            raise ValueError(f"Layout de PDF desconhecido: {name}")
+        return name
+    for name, layout in PDF_LAYOUTS.items():
+        if layout.get('detect') and re.search(layout['detect'], text, re.IGNORECASE | re.MULTILINE):
+            return name
+    return 'generico'
+
+def parse_pdf_date(text, default_year):
+    """Data dd/mm[/aa[aa]] no formato YYYY-MM-DD, ou None se inválida"""
+    parts = [int(part) for part in text.split('/')]
+    year = parts[2] if len(parts) > 2 else default_year
+    if year < 100:
+        year += 2000
+    try:
+        return datetime(year, parts[1], parts[0]).strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
+def parse_pdf_page(text, layout, default_year):
+    """Transações de uma página de extrato, de acordo com o layout.
+    
+    Linhas sem data (quando o row do layout a torna opcional) ficam com
+    Data None e recebem a data da transação anterior em extract_data_from_pdf,
+    mesmo que ela esteja na página anterior.
+    """
+    row_re = re.compile(layout['row'], re.IGNORECASE)
+    skip_re = re.compile(layout['skip'], re.IGNORECASE) if layout.get('skip') else None
+    transactions = []
+    for line in text.splitlines():
+        match = row_re.match(line.strip())
+        if match is None or (skip_re is not None and skip_re.search(line)):
+            continue
+        fields = match.groupdict()
+        
+        date = None
+        if fields.get('data'):
+            date = parse_pdf_date(fields['data'], default_year)
+            if date is None:
+                continue
+        amount = parse_ofx_amount(fields['valor'])
+        if (fields.get('tipo') or '').upper() in ('D', '-'):
+            amount = -abs(amount)
+        elif (fields.get('tipo') or '').upper() == 'C':
+            amount = abs(amount)
+        
+        transactions.append({
+            'Data': date,
+            'Tipo': 'DEBIT' if amount < 0 else 'CREDIT',
+            'Valor': amount,
+            'Descrição': ' '.join(fields['descricao'].split())
+        })
+    return transactions
+
+# PDF aberto em cada processo de extração, reaproveitado entre as páginas
+# que o mesmo processo ler
+_worker_pdf = None
+
+def extract_pdf_page(filepath_in, page_number, layout, default_year):
+    """Extrai as transações de uma página em um processo separado"""
+    global _worker_pdf
+    if _worker_pdf is None or _worker_pdf.stream.name != filepath_in:
+        if _worker_pdf is not None:
+            _worker_pdf.close()
+        import pdfplumber
+        _worker_pdf = pdfplumber.open(filepath_in)
+    page = _worker_pdf.pages[page_number]
+    try:
+        return parse_pdf_page(page.extract_text() or '', layout, default_year)
+    finally:
+        # Os objetos da página (caracteres, linhas) não são mais necessários
+        page.flush_cache()
+
+def extract_data_from_pdf(filepath_in, report=None):
+    """Extrai as transações de um extrato em PDF, página a página.
+    
+    A primeira página é lida no processo atual: dela saem o layout (ver
+    detect_pdf_layout), o ano das datas sem ano e a conta. As demais são
+    distribuídas entre PDF_WORKERS processos. report(páginas lidas, total)
+    é chamado a cada página concluída. Devolve (transações em ordem, dados
+    da conta para o OFX).
+    """
+    # pdfplumber só é carregado quando há um PDF a converter
+    import pdfplumber
+    
+    with pdfplumber.open(filepath_in) as pdf:
+        page_count = len(pdf.pages)
+        if not page_count:
+            raise Exception("PDF sem páginas")
+        first_page = pdf.pages[0]
+        first_text = first_page.extract_text() or ''
+        first_page.flush_cache()
+        
+        layout_name = detect_pdf_layout(first_text)
+        layout = PDF_LAYOUTS[layout_name]
+        year = re.search(r'\d{2}/\d{2}/(\d{4})', first_text)
+        default_year = int(year.group(1)) if year else datetime.now().year
+        account = re.search(layout['account'], first_text, re.IGNORECASE) if layout.get('account') else None
+        account_info = {
+            'bank_id': layout.get('bank_id', OFX_DEFAULT_BANK_ID),
+            'account_id': account.group('conta') if account else OFX_DEFAULT_ACCOUNT_ID,
+            'account_type': 'CHECKING'
+        }
+        logging.info(f"PDF com {page_count} páginas, layout '{layout_name}'")
+        
+        pages = {0: parse_pdf_page(first_text, layout, default_year)}
+        if report is not None:
+            report(1, page_count)
+        
+        workers = max(1, min(config['PDF_WORKERS'], page_count - 1))
+        if workers == 1:
+            for page_number in range(1, page_count):
+                page = pdf.pages[page_number]
+                pages[page_number] = parse_pdf_page(page.extract_text() or '', layout, default_year)
+                page.flush_cache()
+                if report is not None:
+                    report(len(pages), page_count)
+    
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(extract_pdf_page, filepath_in, page_number, layout, default_year): page_number
+                for page_number in range(1, page_count)
+            }
+            not_done = set(futures)
+            while not_done:
+                finished, not_done = wait(not_done, timeout=PROGRESS_UPDATE_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    pages[futures[future]] = future.result()
+                if report is not None:
+                    report(len(pages), page_count)
+    
+    # Páginas na ordem do extrato; linhas sem data herdam a da anterior
+    transactions = []
+    last_date = None
+    for page_number in range(page_count):
+        for transaction in pages[page_number]:
+            if transaction['Data'] is None:
+                if last_date is None:
+                    continue
+                transaction['Data'] = last_date
+            last_date = transaction['Data']
+            transactions.append(transaction)
+    return transactions, account_info
+
+# Documento OFX gerado a partir de transações (ver iter_ofx_document). Os
+# modelos estão em SGML (OFX 1.02); a versão XML (OFX 2.x) fecha as tags de
+# valor (ver sgml_to_xml)
+OFX_SGML_HEADER = """OFXHEADER:100
+DATA:OFXSGML
+VERSION:102
+SECURITY:NONE
+ENCODING:USASCII
+CHARSET:1252
+COMPRESSION:NONE
+OLDFILEUID:NONE
+NEWFILEUID:NONE
+
+"""
+OFX_XML_HEADER = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<?OFX OFXHEADER="200" VERSION="220" SECURITY="NONE" OLDFILEUID="NONE" NEWFILEUID="NONE"?>
+"""
+OFX_DOCUMENT_START = """<OFX>
+    <SIGNONMSGSRSV1>
+        <SONRS>
+            <STATUS>
+                <CODE>0
+                <SEVERITY>INFO
+            </STATUS>
+            <DTSERVER>{now}
+            <LANGUAGE>POR
+            <FI>
+                <ORG>Banco Exemplo
+                <FID>{bank_id}
+            </FI>
+        </SONRS>
+    </SIGNONMSGSRSV1>
+    <BANKMSGSRSV1>
+        <STMTTRNRS>
+            <TRNUID>1001
+            <STATUS>
+                <CODE>0
+                <SEVERITY>INFO
+            </STATUS>
+            <STMTRS>
+                <CURDEF>BRL
+                <BANKACCTFROM>
+                    <BANKID>{bank_id}
+                    <ACCTID>{account_id}
+                    <ACCTTYPE>{account_type}
+                </BANKACCTFROM>
+                <BANKTRANLIST>
+"""
+# Modelo de transação com formatação '%' (mais rápida que str.format por linha):
+# tipo, data, valor, FITID e descrição
+OFX_TRANSACTION = """                    <STMTTRN>
+                        <TRNTYPE>%s
+                        <DTPOSTED>%s
+                        <TRNAMT>%s
+                        <FITID>%08d
+                        <MEMO>%s
+                    </STMTTRN>
+"""
+OFX_DOCUMENT_END = """                </BANKTRANLIST>
+                <LEDGERBAL>
+                    <BALAMT>0.00
+                    <DTASOF>{now}
+                </LEDGERBAL>
+            </STMTRS>
+        </STMTTRNRS>
+    </BANKMSGSRSV1>
+</OFX>"""
+
+# Transações formatadas e gravadas de uma vez
+OFX_WRITE_BATCH = 1000
+def sgml_to_xml(template):
+    """Fecha as tags de valor de um modelo SGML (<TAG>valor -> <TAG>valor</TAG>)"""
+    return re.sub(r'<([A-Z0-9.]+)>([^<\n]+)$', r'<\1>\2</\1>', template, flags=re.MULTILINE)
+
+OFX_TEMPLATES = {
+    'sgml': (OFX_SGML_HEADER + OFX_DOCUMENT_START, OFX_TRANSACTION, OFX_DOCUMENT_END),
+    'xml': tuple(sgml_to_xml(template) for template in (OFX_XML_HEADER + OFX_DOCUMENT_START, OFX_TRANSACTION, OFX_DOCUMENT_END))
+}
+
+def iter_ofx_document(transactions, account_info=None, version='sgml'):
+    """Gera o documento OFX em pedaços: cabeçalho, lotes de transações e rodapé.
+    
+    transactions pode ser qualquer iterável (inclusive um gerador); só um
+    lote de OFX_WRITE_BATCH transações fica em memória. Os pedaços podem ir
+    direto para um arquivo (write_ofx) ou para uma resposta HTTP em
+    streaming. version é 'sgml' (OFX 1.02, valores no formato brasileiro)
+    ou 'xml' (OFX 2.2, valores com ponto decimal e textos escapados).
+    """
+    if version not in OFX_TEMPLATES:
+        raise ValueError(f"Versão OFX desconhecida: {version}")
+    if account_info is None:
+        account_info = {
+            'bank_id': OFX_DEFAULT_BANK_ID,
+            'account_id': OFX_DEFAULT_ACCOUNT_ID,
+            'account_type': 'CHECKING'
+        }
+    
+    start, transaction_template, end = OFX_TEMPLATES[version]
+    xml = version == 'xml'
+    now = datetime.now().strftime("%Y%m%d%H%M%S")
+    yield start.format(now=now, **account_info)
+    
+    transactions = iter(transactions)
+    fitid = 0
+    while True:
+        batch = list(itertools.islice(transactions, OFX_WRITE_BATCH))
+        if not batch:
+            break
+        
+        # Valores do lote formatados de uma vez: com vírgula decimal e ponto
+        # de milhar no SGML (formato brasileiro), com ponto decimal no XML
+        amounts = [trans.get('Valor', 0) for trans in batch]
+        if xml:
+            amounts = [f"{amount:.2f}" for amount in amounts]
+        else:
+            amounts = [
+                f"{amount:,.2f}".replace(',', 'X').replace('.', ',').replace('X', '.')
+                for amount in amounts
+            ]
+        
+        pieces = []
+        for trans, trnamt in zip(batch, amounts):
+            fitid += 1
+            # Converter data para formato OFX
+            dtposted = trans.get('Data', '').replace('-', '')
+            if len(dtposted) == 10:  # YYYY-MM-DD
+                dtposted += "000000"  # Adicionar hora se necessário
+            trntype = trans.get('Tipo', 'OTHER').upper()
+            memo = trans.get('Descrição', '')
+            if xml:
+                trntype, memo = xml_text(trntype), xml_text(memo)
+            pieces.append(transaction_template % (trntype, dtposted, trnamt, fitid, memo))
+        yield ''.join(pieces)
+    
+    yield end.format(now=now)
+
+def write_ofx(out, transactions, account_info=None, version='sgml'):
+    """Grava o documento OFX em out (arquivo de texto) à medida que é gerado"""
+    for piece in iter_ofx_document(transactions, account_info, version):
+        out.write(piece)
+
+def generate_ofx_from_data(transactions, account_info=None, version='sgml'):
+    """Gera conteúdo OFX a partir de dados de transações"""
+    return ''.join(iter_ofx_document(transactions, account_info, version))
+
+def convert_pdf_to_ofx(filepath_in, filepath_out, task_id):
+    """Converte arquivo PDF para OFX"""
+    timer = StageTimer()
+    try:
+        logging.info(f"Iniciando conversão PDF para OFX: {filepath_in}")
+        
+        start_progress(task_id, 'Iniciando conversão PDF...')
+        
+        if not os.path.exists(filepath_in):
+            raise FileNotFoundError(f"Arquivo não encontrado: {filepath_in}")
+        
+        file_size = os.path.getsize(filepath_in)
+        conversion_progress[task_id].update({
+            'progress': 10,
+            'message': f'Arquivo PDF carregado ({file_size / 1024:.1f} KB)'
+        })
+        
+        # Extrair dados do PDF
+        conversion_progress[task_id].update({
+            'progress': 20,
+            'message': 'Extraindo dados do PDF...'
+        })
+        
+        def report(pages_done, page_count):
+            conversion_progress[task_id].update({
+                'progress': 20 + (pages_done * 60 / page_count),
+                'message': f'Extraindo transações (página {pages_done}/{page_count})'
+            })
+        
+        with timer.stage('extract'):
+            transactions, account_info = extract_data_from_pdf(filepath_in, report)
+        timer.rows = len(transactions)
+        
+        if not transactions:
+            raise Exception("Nenhuma transação encontrada no PDF (layout do extrato não reconhecido)")
+        
+        conversion_progress[task_id].update({
+            'progress': 80,
+            'message': f'{len(transactions)} transações extraídas'
+        })
+        
+        # Gerar arquivo OFX
+        conversion_progress[task_id].update({
+            'progress': 90,
+            'message': 'Gerando arquivo OFX...'
+        })
+        
+        # Gerar e salvar o OFX em streaming, sem montar o documento em memória
+        with timer.stage('write'), open(filepath_out, 'w', encoding='utf-8') as f:
+            write_ofx(f, transactions, account_info, version=config['OFX_OUTPUT_VERSION'])
+        
+        conversion_progress[task_id].update({
+            'progress': 100,
+            'message': f'Conversão concluída! {len(transactions)} transações no arquivo OFX',
+            'status': 'completo',
+            'filename': os.path.basename(filepath_out),
+            'end_time': datetime.now().isoformat()
+        })
+        
+        logging.info(f"Conversão PDF->OFX bem-sucedida: {filepath_out}")
+        
+    except Exception as e:
+        error_msg = f"Erro na conversão PDF: {str(e)}"
+        logging.error(error_msg)
+        conversion_progress[task_id].update({
+            'status': 'erro',
+            'message': error_msg,
+            'error': str(e),
+            'end_time': datetime.now().isoformat()
+        })
+    
+    record_conversion_metrics(task_id, 'pdf_to_ofx', timer)
+
+# Registro BIFF12 de célula com texto da tabela compartilhada (BrtCellIsst)
+BIFF12_STRING_CELL = 0x07
+
+def scan_string_refs(data):
+    """Índices da tabela de strings referenciados pelas células de um sheetN.bin.
+    
+    Percorre só os cabeçalhos dos registros BIFF12, sem decodificar as
+    células; nos registros de texto o índice fica após coluna e estilo.
+    """
+    refs = set()
+    pos, end = 0, len(data)
+    while pos < end:
+        # Tipo do registro: até 4 bytes com bit de continuação
+        record_type = data[pos]
+        pos += 1
+        if record_type & 0x80:
+            record_type = None
+            for _ in range(3):
+                byte = data[pos]
+                pos += 1
+                if not byte & 0x80:
+                    break
+        
+        # Tamanho do registro: até 4 bytes de 7 bits
+        size = 0
+        for shift in (0, 7, 14, 21):
+            byte = data[pos]
+            pos += 1
+            size |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+        
+        if record_type == BIFF12_STRING_CELL:
+            refs.add(int.from_bytes(data[pos + 8:pos + 12], 'little'))
+        pos += size
+    
+    return refs
+
+class XlsbSession:
+    """Arquivo XLSB aberto uma única vez por conversão.
+    
+    O pyxlsb lê o índice de planilhas e a tabela de strings compartilhadas ao
+    abrir o arquivo; a sessão mantém esse estado e entrega leitores de
+    planilha (linhas do pyxlsb ou DataFrames) aos motores e ao fallback.
+    """
+    
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.excel_file = pd.ExcelFile(filepath, engine='pyxlsb')
+        self.sheet_names = self.excel_file.sheet_names
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def get_sheet(self, sheet_idx):
+        """Leitor pyxlsb da planilha (índice a partir de 0)"""
+        return self.excel_file.book.get_sheet(sheet_idx + 1)
+    
+    def read_dataframe(self, sheet_name, **kwargs):
+        """Lê a planilha em um DataFrame reaproveitando o arquivo já aberto"""
+        return self.excel_file.parse(sheet_name, **kwargs)
+    
+    def sheet_fingerprint(self, sheet_idx, variant=''):
+        """Hash do binário da planilha e das strings compartilhadas que ela referencia.
+        
+        Duas planilhas com a mesma impressão digital geram exatamente as
+        mesmas células, mesmo que o restante do arquivo tenha mudado.
+        """
+        # O pyxlsb não expõe o caminho das partes; usa o mesmo mapeamento de get_sheet
+        book = self.excel_file.book
+        target = book._sheets[sheet_idx][1].split('/')
+        data = book._zf.read('xl/{}/{}'.format(target[0], target[-1]))
+        
+        digest = hashlib.sha256(data)
+        if book.stringtable is not None:
+            for string_idx in sorted(scan_string_refs(data)):
+                digest.update(str(book.stringtable[string_idx]).encode('utf-8', 'surrogatepass'))
+                digest.update(b'\0')
+        digest.update(f'|{variant}|{CONVERTER_VERSION}'.encode('utf-8'))
+        return digest.hexdigest()
+    
+    def close(self):
+        self.excel_file.close()
+
+def track_rows(rows, total_rows, report):
+    """Repassa as linhas chamando report(linhas lidas, total) periodicamente"""
+    last_report = time.monotonic()
+    for row_number, row in enumerate(rows, 1):
+        if row_number % PROGRESS_ROW_BATCH == 0:
+            now = time.monotonic()
+            if now - last_report >= PROGRESS_UPDATE_INTERVAL:
+                last_report = now
+                report(row_number, total_rows)
+        yield row
+
+def sheet_progress_reporter(task_id, sheet_name, start, end):
+    """Função report de track_rows que distribui [start, end] pelas linhas da planilha"""
+    def report(done, total):
+        fraction = min(done / total, 1.0) if total else 0.0
+        conversion_progress[task_id].update({
+            'progress': start + (end - start) * fraction,
+            'message': f'Processando: {sheet_name} ({done}/{total} linhas)' if total else f'Processando: {sheet_name} ({done} linhas)'
+        })
+    return report
+
+def sheet_row_count(sheet):
+    """Número de linhas da planilha pyxlsb segundo a dimensão gravada no arquivo"""
+    if sheet.dimension is None:
+        return None
+    return sheet.dimension.r + sheet.dimension.h
+
+# Linhas convertidas de uma vez de volta em valores Python na escrita (ver TypedSheet.iter_rows)
+TYPED_CHUNK_ROWS = 4096
+
+class ColumnBuilder:
+    """Acumula os valores de uma coluna em armazenamento tipado, durante a leitura.
+    
+    A coluna começa vazia e assume o tipo do primeiro valor: números em um
+    array de doubles, textos como códigos de uma tabela de categorias. Ao
+    surgir um valor de outro tipo (ou booleano), ela passa a uma lista de
+    objetos. Células vazias são preenchidas só quando aparece o valor
+    seguinte da coluna (ou em finish), então linhas curtas não custam nada.
+    
+    Os inteiros vindos do XLSB cabem exatamente em um double (são RK de 30
+    bits ou doubles inteiros convertidos por normalize_xlsb_value).
+    """
+    __slots__ = ('kind', 'count', 'blank', 'numbers', 'codes', 'index', 'objects')
+    
+    def __init__(self):
+        self.kind = None  # None enquanto a coluna só tiver células vazias
+        self.count = 0
+        self.blank = bytearray()
+        self.numbers = self.codes = self.index = self.objects = None
+    
+    def pad(self, count):
+        """Completa a coluna com células vazias até count linhas"""
+        missing = count - self.count
+        if missing <= 0:
+            return
+        self.blank.extend(b'\x01' * missing)
+        if self.kind == 'number':
+            self.numbers.frombytes(bytes(8 * missing))
+        elif self.kind == 'category':
+            self.codes.extend(array('i', [-1]) * missing)
+        elif self.kind == 'object':
+            self.objects.extend([''] * missing)
+        self.count = count
+    
+    def _start(self, kind):
+        self.kind = kind
+        if kind == 'number':
+            self.numbers = array('d', bytes(8 * self.count))
+        else:
+            self.codes = array('i', [-1]) * self.count
+            self.index = {}
+    
+    def _to_objects(self):
+        self.objects = self.to_list()
+        self.kind = 'object'
+        self.numbers = self.codes = self.index = None
+    
+    def append(self, row_idx, value):
+        """Grava value na linha row_idx (as linhas anteriores sem valor ficam vazias)"""
+        if row_idx != self.count:
+            self.pad(row_idx)
+        cls = value.__class__
+        if cls is str and not value:
+            self.pad(row_idx + 1)
+            return
+        
+        if self.kind is None:
+            if cls is float or cls is int:
+                self._start('number')
+            elif cls is str:
+                self._start('category')
+            else:
+                self.objects = [''] * self.count
+                self.kind = 'object'
+        
+        kind = self.kind
+        if kind == 'number' and (cls is float or cls is int):
+            self.numbers.append(value)
+        elif kind == 'category' and cls is str:
+            code = self.index.get(value)
+            if code is None:
+                code = self.index[value] = len(self.index)
+            self.codes.append(code)
+        else:
+            if kind != 'object':
+                self._to_objects()
+            self.objects.append(value)
+        self.blank.append(0)
+        self.count += 1
+    
+    def to_list(self):
+        """Valores como na leitura pelo pandas: vazias como '' e números inteiros como int"""
+        if self.kind == 'number':
+            return ['' if blank else (int(number) if number.is_integer() else number)
+                    for number, blank in zip(self.numbers, self.blank)]
+        if self.kind == 'category':
+            categories = list(self.index) + ['']
+            return [categories[code] for code in self.codes]
+        if self.kind == 'object':
+            return list(self.objects)
+        return [''] * self.count
+    
+    def finish(self, count):
+        """Coluna pronta (TypedColumn) com count linhas"""
+        self.pad(count)
+        blank = np.frombuffer(bytes(self.blank), dtype=bool)
+        if self.kind is None:
+            return TypedColumn('int', np.zeros(count, dtype=np.int64), blank)
+        if self.kind == 'number':
+            values = np.frombuffer(self.numbers, dtype=np.float64).copy()
+            numbers = values[~blank]
+            if np.all(numbers == np.floor(numbers)) and (not len(numbers) or np.abs(numbers).max() < 2 ** 53):
+                values = values.astype(np.int64)
+            return TypedColumn('int' if values.dtype == np.int64 else 'float', values, blank)
+        if self.kind == 'category':
+            codes = np.frombuffer(self.codes, dtype=np.int32).copy()
+            # Textos quase todos distintos não ganham nada com a tabela de categorias
+            if len(self.index) > count // 2:
+                return TypedColumn('object', np_object_array(self.to_list()), blank)
+            return TypedColumn('category', codes, blank, list(self.index))
+        return TypedColumn('object', np_object_array(self.objects), blank)
+
+def np_object_array(values):
+    """Array object unidimensional com os valores (sem interpretar sequências)"""
+    array_out = np.empty(len(values), dtype=object)
+    array_out[:] = values
+    return array_out
+
+class TypedColumn:
+    """Coluna de planilha em armazenamento compacto.
+    
+    kind é 'int' (int64), 'float' (float64), 'category' (códigos int32 de
+    categories, -1 para vazio) ou 'object' (tipos misturados). blank marca
+    as células vazias, lidas pelo pandas como ''. Estilos e larguras são
+    calculados direto nos arrays (ver style_codes e max_width).
+    """
+    __slots__ = ('kind', 'values', 'blank', 'categories')
+    
+    def __init__(self, kind, values, blank, categories=None):
+        self.kind = kind
+        self.values = values
+        self.blank = blank
+        self.categories = categories
+    
+    def __len__(self):
+        return len(self.values)
+    
+    @property
+    def nbytes(self):
+        size = self.values.nbytes + self.blank.nbytes
+        if self.kind == 'object':
+            size += sum(sys.getsizeof(value) for value in self.values)
+        elif self.kind == 'category':
+            size += sum(sys.getsizeof(value) for value in self.categories)
+        return size
+    
+    def chunk(self, start, stop):
+        """Valores Python das linhas [start, stop), com '' nas células vazias"""
+        if self.kind == 'category':
+            lookup = np_object_array(self.categories + [''])
+            return lookup[self.values[start:stop]].tolist()
+        values = self.values[start:stop].tolist()
+        if self.kind == 'float':
+            numbers = self.values[start:stop]
+            for idx in np.flatnonzero(np.isfinite(numbers) & (numbers == np.floor(numbers))).tolist():
+                values[idx] = int(values[idx])
+        if self.kind != 'object':
+            for idx in np.flatnonzero(self.blank[start:stop]).tolist():
+                values[idx] = ''
+        return values
+    
+    def style_codes(self):
+        """Estilo (STYLE_*) de cada célula, como classify_column faria com os valores lidos pelo pandas"""
+        if self.kind == 'object':
+            return classify_column(self.values)
+        if self.kind == 'category':
+            category_codes = classify_column(np_object_array(self.categories))
+            return np.append(category_codes, np.int8(STYLE_BORDER))[self.values]
+        
+        codes = np.full(len(self.values), STYLE_INTEGER, dtype=np.int8)
+        if self.kind == 'float':
+            finite = np.isfinite(self.values)
+            integral = finite & (self.values == np.floor(np.where(finite, self.values, 0)))
+            codes = np.select([integral, finite], [STYLE_INTEGER, STYLE_DECIMAL], STYLE_BORDER).astype(np.int8)
+        codes[self.blank] = STYLE_BORDER
+        return codes
+    
+    def max_width(self):
+        """Maior estimate_width entre os valores não vazios (como na escrita célula a célula)"""
+        if self.kind == 'object':
+            return max((estimate_width(value) for value in self.values if value), default=0)
+        if self.kind == 'category':
+            used = np.bincount(self.values[self.values >= 0], minlength=len(self.categories)) > 0
+            return max((len(value) for value, is_used in zip(self.categories, used) if is_used), default=0)
+        
+        numbers = self.values[~self.blank & (self.values != 0)].astype(np.float64)
+        if not len(numbers):
+            return 0
+        finite = np.isfinite(numbers)
+        magnitude = np.abs(np.where(finite, numbers, 0))
+        digits = np.where(magnitude >= 1, np.floor(np.log10(np.maximum(magnitude, 1))) + 1, 1)
+        widths = digits + (digits - 1) // 3 + (numbers < 0)
+        if self.kind == 'float':
+            widths += 3 * (numbers != np.floor(np.where(finite, numbers, 0)))
+        widths = np.where(finite, widths, 3)
+        return int(widths.max())
+
+class TypedSheet:
+    """Planilha lida em colunas tipadas, com os mesmos valores que o pandas leria.
+    
+    Equivale a read_excel(dtype=object, keep_default_na=False): a primeira
+    linha vira o cabeçalho (nomes repetidos ou vazios tratados pelo próprio
+    pandas), linhas vazias intermediárias são mantidas e as do fim,
+    descartadas, e as células vazias valem ''.
+    """
+    
+    def __init__(self, columns, typed_columns, row_count):
+        self.columns = columns
+        self.typed_columns = typed_columns
+        self.row_count = row_count
+    
+    def __len__(self):
+        return self.row_count
+    
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.typed_columns)
+    
+    def iter_rows(self):
+        """Cabeçalho e linhas de dados como listas de valores Python"""
+        yield list(self.columns)
+        for start in range(0, self.row_count, TYPED_CHUNK_ROWS):
+            stop = min(start + TYPED_CHUNK_ROWS, self.row_count)
+            yield from zip(*(column.chunk(start, stop) for column in self.typed_columns))
+    
+    def style_codes(self):
+        """Matriz de estilos (linhas x colunas); a linha 0 é o cabeçalho"""
+        codes = np.empty((self.row_count + 1, len(self.columns)), dtype=np.int8)
+        codes[0] = [detect_formatting(value) for value in self.columns]
+        for col_idx, column in enumerate(self.typed_columns):
+            codes[1:, col_idx] = column.style_codes()
+        return codes
+    
+    def column_widths(self):
+        return {
+            col_idx: max(estimate_width(name) if name else 0, column.max_width())
+            for col_idx, (name, column) in enumerate(zip(self.columns, self.typed_columns), 1)
+        }
+
+def read_typed_sheet(session, sheet_idx, report=None):
+    """Lê a planilha em colunas tipadas, linha a linha, sem DataFrame de objetos"""
+    header = None
+    builders = []
+    row_count = 0
+    pending_blank = 0
+    for row in iter_sheet_rows(session, sheet_idx, report):
+        while row and (row[-1] is None or row[-1] == ''):
+            row.pop()
+        # Linhas vazias só contam se houver linha com dados depois delas
+        if not row:
+            pending_blank += 1
+            continue
+        if header is None:
+            if not pending_blank:
+                header = row
+                continue
+            header = []
+            pending_blank -= 1
+        
+        row_count += pending_blank
+        pending_blank = 0
+        if len(row) > len(builders):
+            builders.extend(ColumnBuilder() for _ in range(len(row) - len(builders)))
+        for col_idx, value in enumerate(row):
+            if value is not None:
+                builders[col_idx].append(row_count, value)
+        row_count += 1
+    
+    if header is None:
+        return TypedSheet([], [], 0)
+    
+    width = max(len(header), len(builders))
+    builders.extend(ColumnBuilder() for _ in range(width - len(builders)))
+    header = ['' if value is None else value for value in header] + [''] * (width - len(header))
+    # Nomes das colunas pelo próprio pandas ('Unnamed: N', 'nome.1'...)
+    columns = TextParser(
+        [header], header=0, dtype=object, keep_default_na=False, skip_blank_lines=False
+    ).read().columns.tolist()
+    return TypedSheet(columns, [builder.finish(row_count) for builder in builders], row_count)
+
+def convert_xlsb_pandas(session, filepath_out, task_id, timer):
+    """Motor 'pandas': lê cada planilha em colunas tipadas (TypedSheet) e grava com openpyxl"""
+    sheet_names = session.sheet_names
+    
+    conversion_progress[task_id].update({
+        'progress': 30,
+        'message': f'Encontradas {len(sheet_names)} planilhas'
+    })
+    
+    # Criar workbook de saída
+    wb_out = Workbook()
+    # Remover sheet padrão
+    wb_out.remove(wb_out.active)
+    style_table = build_style_table(wb_out)
+    
+    # Processar cada planilha
+    for sheet_idx, sheet_name in enumerate(sheet_names):
+        progress = 30 + (sheet_idx * 60 / len(sheet_names))
+        conversion_progress[task_id].update({
+            'progress': progress,
+            'message': f'Lendo: {sheet_name}'
+        })
+        
+        try:
+            # Ler dados em colunas tipadas, com os mesmos valores do pandas
+            step = 60 / len(sheet_names)
+            with timer.stage('read'):
+                sheet = read_typed_sheet(
+                    session, sheet_idx,
+                    sheet_progress_reporter(task_id, sheet_name, progress, progress + step / 2)
+                )
+            
+            # Criar nova planilha
+            ws_out = wb_out.create_sheet(title=sheet_name[:31])
+            
+            # Classificar a formatação de todas as células de uma vez
+            with timer.stage('classify'):
+                style_codes = sheet.style_codes()
+            
+            # Escrever dados lidos direto dos arrays de cada coluna
+            report = sheet_progress_reporter(task_id, sheet_name, progress + step / 2, progress + step)
+            rows = track_rows(sheet.iter_rows(), len(sheet) + 1, report)
+            with timer.stage('write'):
+                for row_idx, row in enumerate(rows, 1):
+                    row_codes = style_codes[row_idx - 1].tolist()
+                    for col_idx, value in enumerate(row, 1):
+                        cell = ws_out.cell(row=row_idx, column=col_idx, value=value)
+                        
+                        # Aplicar formatação detectada (inclui a borda)
+                        apply_formatting(cell, row_codes[col_idx - 1], style_table)
+            timer.rows += len(sheet) + 1
+            timer.cells += (len(sheet) + 1) * len(sheet.columns)
+            
+            # Ajustar largura das colunas
+            with timer.stage('column_widths'):
+                apply_column_widths(ws_out, sheet.column_widths())
+            
+            logging.info(f"Planilha {sheet_name} processada com sucesso ({sheet.nbytes / 1024 / 1024:.1f} MB em colunas tipadas)")
+            
+        except Exception as e:
+            logging.error(f"Erro na planilha {sheet_name}: {e}")
+            # Criar planilha vazia como fallback
+            ws_out = wb_out.create_sheet(title=sheet_name[:31])
+            ws_out.cell(1, 1, value=f"Erro ao processar: {str(e)}")
+    
+    # Salvar arquivo
+    conversion_progress[task_id].update({
+        'progress': 95,
+        'message': 'Salvando arquivo XLSX...'
+    })
+    
+    with timer.stage('save'):
+        wb_out.save(filepath_out)
+
+def normalize_xlsb_value(value):
+    """Converte floats inteiros do pyxlsb em int, como faz o leitor do pandas"""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def iter_xlsb_rows(sheet):
+    """Itera as linhas de uma planilha pyxlsb sem carregá-la inteira na memória.
+    
+    Linhas vazias intermediárias são devolvidas como listas vazias para
+    preservar a posição original dos dados.
+    """
+    next_row = 0
+    for row in sheet.rows(sparse=True):
+        values = [normalize_xlsb_value(cell.v) for cell in row]
+        while values and values[-1] is None:
+            values.pop()
+        if not values:
+            continue
+        
+        row_number = row[0].r
+        while next_row < row_number:
+            yield []
+            next_row += 1
+        yield values
+        next_row = row_number + 1
+
+def iter_sheet_rows(session, sheet_idx, report=None):
+    """Abre a planilha e itera as linhas; erros de leitura surgem durante a iteração.
+    
+    Com report, o progresso é informado como em track_rows, tendo como total
+    a dimensão da planilha.
+    """
+    with session.get_sheet(sheet_idx) as sheet:
+        rows = iter_xlsb_rows(sheet)
+        if report is not None:
+            rows = track_rows(rows, sheet_row_count(sheet), report)
+        yield from rows
+
+def sample_column_widths(sample):
+    """Maior comprimento estimado por coluna nas linhas da amostra"""
+    widths = {}
+    for row in sample:
+        for col_idx, value in enumerate(row, 1):
+            if value:
+                widths[col_idx] = max(widths.get(col_idx, 0), estimate_width(value))
+    return widths
+
+def write_sheet_streaming(ws_out, rows, style_table):
+    """Grava as linhas em uma planilha write_only, uma linha por vez"""
+    # Amostra inicial para a largura das colunas
+    rows = iter(rows)
+    sample = list(itertools.islice(rows, STREAMING_SAMPLE_ROWS))
+    apply_column_widths(ws_out, sample_column_widths(sample))
+    
+    row_count = 0
+    for row in itertools.chain(sample, rows):
+        cells = []
+        for value in row:
+            if value is None:
+                cells.append(None)
+                continue
+            cell = WriteOnlyCell(ws_out, value=value)
+            apply_formatting(cell, detect_formatting(value), style_table)
+            cells.append(cell)
+        ws_out.append(cells)
+        row_count += 1
+    
+    return row_count
+
+SPREADSHEETML_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+RELATIONSHIPS_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+# Linhas acumuladas antes de cada escrita no zip (cada write comprime um bloco)
+DIRECT_WRITE_BATCH_ROWS = 512
+
+def xml_text(value):
+    """Escapa o texto para XML, removendo caracteres de controle inválidos"""
+    return escape(ILLEGAL_CHARACTERS_RE.sub('', value))
+
+def xml_string_element(tag, value):
+    """Elemento de texto (<t>) preservando espaços nas extremidades"""
+    text = xml_text(value)
+    if text != text.strip():
+        return f'<{tag} xml:space="preserve">{text}</{tag}>'
+    return f'<{tag}>{text}</{tag}>'
+
+def write_sheet_xml(out, rows, shared_strings=None):
+    """Grava o XML de uma planilha (sheetN.xml) em out, uma linha por vez.
+    
+    O atributo s de cada célula é o próprio ID do estilo fixo (STYLE_*), que
+    coincide com a ordem de cellXfs em direct_styles_xml. Com shared_strings
+    (dict texto -> índice) os textos vão para a tabela compartilhada; sem ela
+    são gravados inline e o XML não depende do workbook (motor 'parallel').
+    
+    Se a leitura das linhas falhar, a planilha é encerrada com a linha de
+    erro e a exceção é repassada.
+    """
+    rows = iter(rows)
+    error = None
+    try:
+        sample = list(itertools.islice(rows, STREAMING_SAMPLE_ROWS))
+    except Exception as e:
+        sample, error = [], e
+    
+    widths = sample_column_widths(sample)
+    out.write(f'{XML_DECLARATION}<worksheet xmlns="{SPREADSHEETML_NS}">'.encode('utf-8'))
+    if widths:
+        cols = ''.join(
+            f'<col min="{col_idx}" max="{col_idx}" width="{min(max(max_length + 2, 8), 50)}" customWidth="1"/>'
+            for col_idx, max_length in sorted(widths.items())
+        )
+        out.write(f'<cols>{cols}</cols>'.encode('utf-8'))
+    out.write(b'<sheetData>')
+    
+    letters = []
+    buffer = []
+    row_number = 0
+    try:
+        for row in (itertools.chain(sample, rows) if error is None else ()):
+            row_number += 1
+            if not row:
+                continue
+            while len(letters) < len(row):
+                letters.append(get_column_letter(len(letters) + 1))
+            
+            cells = [f'<row r="{row_number}">']
+            for col_idx, value in enumerate(row):
+                if value is None:
+                    continue
+                ref = f'{letters[col_idx]}{row_number}'
+                style_id = detect_formatting(value)
+                if isinstance(value, bool):
+                    cells.append(f'<c r="{ref}" s="{style_id}" t="b"><v>{int(value)}</v></c>')
+                elif isinstance(value, int):
+                    cells.append(f'<c r="{ref}" s="{style_id}"><v>{value}</v></c>')
+                elif isinstance(value, float):
+                    # Mesmo formato numérico do openpyxl; NaN/infinito ficam vazios
+                    if math.isfinite(value):
+                        cells.append(f'<c r="{ref}" s="{style_id}"><v>{"%.16g" % value}</v></c>')
+                    else:
+                        cells.append(f'<c r="{ref}" s="{style_id}"/>')
+                else:
+                    text = value if isinstance(value, str) else str(value)
+                    if shared_strings is None:
+                        cells.append(f'<c r="{ref}" s="{style_id}" t="inlineStr"><is>{xml_string_element("t", text)}</is></c>')
+                    else:
+                        string_idx = shared_strings.setdefault(text, len(shared_strings))
+                        cells.append(f'<c r="{ref}" s="{style_id}" t="s"><v>{string_idx}</v></c>')
+            cells.append('</row>')
+            buffer.append(''.join(cells))
+            
+            if len(buffer) >= DIRECT_WRITE_BATCH_ROWS:
+                out.write(''.join(buffer).encode('utf-8'))
+                buffer.clear()
+    except Exception as e:
+        error = e
+    
+    if error is not None:
+        row_number += 1
+        message = f"Erro ao processar: {str(error)}"
+        buffer.append(
+            f'<row r="{row_number}"><c r="A{row_number}" t="inlineStr">'
+            f'<is>{xml_string_element("t", message)}</is></c></row>'
+        )
+    
+    out.write(''.join(buffer).encode('utf-8'))
+    out.write(b'</sheetData></worksheet>')
+    
+    if error is not None:
+        raise error
+    return row_number
+
+@functools.lru_cache(maxsize=1)
+def direct_styles_xml():
+    """styles.xml com os estilos fixos, na mesma ordem dos IDs STYLE_*"""
+    wb = Workbook(write_only=True)
+    build_style_table(wb)
+    return XML_DECLARATION.encode('utf-8') + tostring(write_stylesheet(wb))
+
+class XlsxDirectWriter:
+    """Grava um XLSX diretamente no zip, sem objetos de célula do openpyxl.
+    
+    As planilhas são gravadas em streaming (write_sheet_xml) na ordem em que
+    são adicionadas; a tabela de strings compartilhadas (sem repetições), o
+    styles.xml fixo e as demais partes do pacote são gravados em close().
+    Usado como gerenciador de contexto, um erro chama abort() no lugar de
+    close().
+    """
+    
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._file = open(filepath, 'wb')
+        self._zip = zipfile.ZipFile(self._file, 'w', zipfile.ZIP_DEFLATED)
+        self._sheet_titles = []
+        self._shared_strings = {}
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+    
+    def abort(self):
+        """Fecha o arquivo sem completar o pacote e apaga a saída incompleta"""
+        if self._file.closed:
+            return
+        # O zip recusa fechar com uma planilha ainda aberta; o arquivo é fechado de qualquer forma
+        with contextlib.suppress(Exception):
+            self._zip.close()
+        self._file.close()
+        with contextlib.suppress(OSError):
+            os.remove(self.filepath)
+    
+    def _open_sheet_part(self, title):
+        self._sheet_titles.append(title[:31])
+        part_name = f'xl/worksheets/sheet{len(self._sheet_titles)}.xml'
+        return self._zip.open(part_name, 'w', force_zip64=True)
+    
+    def add_sheet(self, title, rows):
+        """Adiciona uma planilha a partir das linhas; devolve o número de linhas"""
+        with self._open_sheet_part(title) as out:
+            return write_sheet_xml(out, rows, self._shared_strings)
+    
+    def add_sheet_part(self, title, part_path):
+        """Adiciona uma planilha já renderizada (XML com strings inline)"""
+        with self._open_sheet_part(title) as out, open(part_path, 'rb') as src:
+            shutil.copyfileobj(src, out)
+    
+    def _write_shared_strings(self):
+        with self._zip.open('xl/sharedStrings.xml', 'w', force_zip64=True) as out:
+            count = len(self._shared_strings)
+            out.write(f'{XML_DECLARATION}<sst xmlns="{SPREADSHEETML_NS}" count="{count}" uniqueCount="{count}">'.encode('utf-8'))
+            buffer = []
+            for text in self._shared_strings:
+                buffer.append(f'<si>{xml_string_element("t", text)}</si>')
+                if len(buffer) >= DIRECT_WRITE_BATCH_ROWS:
+                    out.write(''.join(buffer).encode('utf-8'))
+                    buffer.clear()
+            out.write(''.join(buffer).encode('utf-8'))
+            out.write(b'</sst>')
+    
+    def close(self):
+        if self._file.closed:
+            return
+        
+        sheet_count = len(self._sheet_titles)
+        sheets = ''.join(
+            f'<sheet name={quoteattr(title)} sheetId="{idx}" r:id="rId{idx}"/>'
+            for idx, title in enumerate(self._sheet_titles, 1)
+        )
+        self._zip.writestr(
+            'xl/workbook.xml',
+            f'{XML_DECLARATION}<workbook xmlns="{SPREADSHEETML_NS}" xmlns:r="{RELATIONSHIPS_NS}">'
+            f'<sheets>{sheets}</sheets></workbook>'
+        )
+        
+        relationships = [
+            (f'rId{idx}', 'worksheet', f'worksheets/sheet{idx}.xml')
+            for idx in range(1, sheet_count + 1)
+        ]
+        relationships += [
+            (f'rId{sheet_count + 1}', 'styles', 'styles.xml'),
+            (f'rId{sheet_count + 2}', 'theme', 'theme/theme1.xml'),
+            (f'rId{sheet_count + 3}', 'sharedStrings', 'sharedStrings.xml')
+        ]
+        self._zip.writestr(
+            'xl/_rels/workbook.xml.rels',
+            XML_DECLARATION
+            + '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            + ''.join(
+                f'<Relationship Id="{rel_id}" Type="{RELATIONSHIPS_NS}/{rel_type}" Target="{target}"/>'
+                for rel_id, rel_type, target in relationships
+            )
+            + '</Relationships>'
+        )
+        self._zip.writestr(
+            '_rels/.rels',
+            XML_DECLARATION
+            + '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            + f'<Relationship Id="rId1" Type="{RELATIONSHIPS_NS}/officeDocument" Target="xl/workbook.xml"/>'
+            + '</Relationships>'
+        )
+        
+        content_type = 'application/vnd.openxmlformats-officedocument'
+        overrides = [
+            ('/xl/workbook.xml', f'{content_type}.spreadsheetml.sheet.main+xml'),
+            ('/xl/styles.xml', f'{content_type}.spreadsheetml.styles+xml'),
+            ('/xl/theme/theme1.xml', f'{content_type}.theme+xml'),
+            ('/xl/sharedStrings.xml', f'{content_type}.spreadsheetml.sharedStrings+xml')
+        ]
+        overrides += [
+            (f'/xl/worksheets/sheet{idx}.xml', f'{content_type}.spreadsheetml.worksheet+xml')
+            for idx in range(1, sheet_count + 1)
+        ]
+        self._zip.writestr(
+            '[Content_Types].xml',
+            XML_DECLARATION
+            + '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            + '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            + '<Default Extension="xml" ContentType="application/xml"/>'
+            + ''.join(f'<Override PartName="{part}" ContentType="{ctype}"/>' for part, ctype in overrides)
+            + '</Types>'
+        )
+        
+        self._zip.writestr('xl/styles.xml', direct_styles_xml())
+        self._zip.writestr('xl/theme/theme1.xml', theme_xml)
+        self._write_shared_strings()
+        self._zip.close()
+        self._file.close()
+
+def convert_xlsb_streaming(session, filepath_out, task_id, timer):
+    """Motor 'streaming': lê com pyxlsb e grava linha a linha.
+    
+    Nenhuma planilha é carregada inteira na memória, então o consumo fica
+    limitado independentemente do número de linhas. A gravação usa um
+    workbook write_only do openpyxl ou o XlsxDirectWriter (XLSX_WRITER). O
+    cabeçalho é gravado como está no arquivo original (sem os nomes gerados
+    pelo pandas).
+    """
+    sheet_names = session.sheet_names
+    
+    conversion_progress[task_id].update({
+        'progress': 30,
+        'message': f'Encontradas {len(sheet_names)} planilhas'
+    })
+    
+    direct = config['XLSX_WRITER'] == 'direct'
+    # Um erro fora das planilhas (que leva ao fallback) fecha o zip ou apaga
+    # os temporários do openpyxl antes de a saída ser gravada de novo
+    with contextlib.ExitStack() as stack:
+        if direct:
+            writer = stack.enter_context(XlsxDirectWriter(filepath_out))
+        else:
+            wb_out = stack.enter_context(write_only_workbook())
+            style_table = build_style_table(wb_out)
+        
+        for sheet_idx, sheet_name in enumerate(sheet_names):
+            progress = 30 + (sheet_idx * 60 / len(sheet_names))
+            conversion_progress[task_id].update({
+                'progress': progress,
+                'message': f'Processando: {sheet_name}'
+            })
+            
+            ws_out = None if direct else wb_out.create_sheet(title=sheet_name[:31])
+            report = sheet_progress_reporter(task_id, sheet_name, progress, progress + 60 / len(sheet_names))
+            try:
+                # Leitura e gravação intercaladas: uma única etapa por planilha
+                rows = timer.count_rows(iter_sheet_rows(session, sheet_idx, report))
+                with timer.stage('write'):
+                    if direct:
+                        row_count = writer.add_sheet(sheet_name, rows)
+                    else:
+                        row_count = write_sheet_streaming(ws_out, rows, style_table)
+                logging.info(f"Planilha {sheet_name} processada com sucesso ({row_count} linhas)")
+            except Exception as e:
+                logging.error(f"Erro na planilha {sheet_name}: {e}")
+                # O backend direto já encerra a planilha com a linha de erro
+                if ws_out is not None:
+                    ws_out.append([f"Erro ao processar: {str(e)}"])
+        
+        conversion_progress[task_id].update({
+            'progress': 95,
+            'message': 'Salvando arquivo XLSX...'
+        })
+        
+        with timer.stage('save'):
+            if direct:
+                writer.close()
+            else:
+                wb_out.save(filepath_out)
+
+# Sessão XLSB de cada processo do motor 'parallel', reaproveitada entre as
+# planilhas que o mesmo processo converter
+_worker_session = None
+# Linhas lidas e total de linhas de cada planilha, em memória compartilhada
+# com o processo principal (ver init_worker_progress)
+_worker_progress = None
+
+def init_worker_progress(rows_done, rows_total):
+    """Inicializador dos processos do motor 'parallel'"""
+    global _worker_progress
+    _worker_progress = (rows_done, rows_total)
+
+def report_worker_progress(sheet_idx):
+    """Função report de track_rows que publica as linhas lidas na memória compartilhada"""
+    def report(done, total):
+        if _worker_progress is not None:
+            rows_done, rows_total = _worker_progress
+            rows_total[sheet_idx] = total or 0
+            rows_done[sheet_idx] = done
+    return report
+
+def get_worker_session(filepath):
+    """Abre o XLSB uma vez por processo de trabalho"""
+    global _worker_session
+    if _worker_session is None or _worker_session.filepath != filepath:
+        if _worker_session is not None:
+            _worker_session.close()
+        _worker_session = XlsbSession(filepath)
+    return _worker_session
+
+def render_sheet_part(filepath_in, sheet_idx, sheet_name, part_path, xlsx_writer='openpyxl'):
+    """Converte uma planilha em um processo separado e grava o XML dela em part_path.
+    
+    Devolve (linhas, células) gravadas.
+    """
+    session = get_worker_session(filepath_in)
+    timer = StageTimer()
+    rows = timer.count_rows(iter_sheet_rows(session, sheet_idx, report_worker_progress(sheet_idx)))
+    
+    if xlsx_writer == 'direct':
+        with open(part_path, 'wb') as out:
+            return write_sheet_xml(out, rows), timer.cells
+    
+    wb_out = Workbook(write_only=True)
+    style_table = build_style_table(wb_out)
+    ws_out = wb_out.create_sheet(title=sheet_name[:31])
+    row_count = write_sheet_streaming(ws_out, rows, style_table)
+    
+    # O workbook temporário tem uma única planilha; só o XML dela é aproveitado
+    tmp_xlsx = part_path + '.xlsx'
+    wb_out.save(tmp_xlsx)
+    with zipfile.ZipFile(tmp_xlsx) as zf:
+        with zf.open('xl/worksheets/sheet1.xml') as src, open(part_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+    os.remove(tmp_xlsx)
+    
+    return row_count, timer.cells
+
+def assemble_xlsx_parts(skeleton_path, parts, filepath_out):
+    """Monta o XLSX final trocando as planilhas do esqueleto pelos XMLs gerados"""
+    with zipfile.ZipFile(skeleton_path) as zin, \
+            zipfile.ZipFile(filepath_out, 'w', zipfile.ZIP_DEFLATED) as zout:
+        for item in zin.infolist():
+            part_path = parts.get(item.filename)
+            with zout.open(item.filename, 'w') as dst:
+                if part_path:
+                    with open(part_path, 'rb') as src:
+                        shutil.copyfileobj(src, dst)
+                else:
+                    with zin.open(item) as src:
+                        shutil.copyfileobj(src, dst)
+
+# XML de planilhas já renderizadas pelo motor 'parallel', por impressão
+# digital; definido pelo app (sem cache, todas as planilhas são convertidas)
+sheet_cache = None
+
+def convert_xlsb_parallel(session, filepath_out, task_id, timer):
+    """Motor 'parallel': converte cada planilha em um processo separado.
+    
+    Cada processo gera o XML da sua planilha; o arquivo final é montado na
+    ordem original das planilhas, a partir de um esqueleto do openpyxl com os
+    mesmos estilos fixos (ver build_style_table) ou pelo XlsxDirectWriter.
+    
+    Planilhas idênticas às de uma conversão anterior (mesma impressão
+    digital, ver XlsbSession.sheet_fingerprint) reaproveitam o XML guardado
+    em sheet_cache, quando há um; só as planilhas alteradas são convertidas.
+    """
+    sheet_names = session.sheet_names
+    
+    conversion_progress[task_id].update({
+        'progress': 30,
+        'message': f'Encontradas {len(sheet_names)} planilhas'
+    })
+    
+    work_dir = tempfile.mkdtemp(prefix='xlsb_parts_')
+    try:
+        parts = {}
+        errors = {}
+        fingerprints = {}
+        pending = []
+        variant = config['XLSX_WRITER']
+        
+        # Reaproveitar as planilhas que não mudaram desde uma conversão anterior
+        for sheet_idx, sheet_name in enumerate(sheet_names):
+            part_path = os.path.join(work_dir, f'sheet{sheet_idx + 1}.xml')
+            with timer.stage('fingerprint'):
+                try:
+                    fingerprint = session.sheet_fingerprint(sheet_idx, variant)
+                except Exception as e:
+                    logging.warning(f"Erro ao calcular impressão digital da planilha {sheet_name}: {e}")
+                    fingerprint = None
+                cached = fingerprint and sheet_cache is not None and sheet_cache.get(fingerprint, '.xml', part_path)
+            
+            if cached:
+                parts[f'xl/worksheets/sheet{sheet_idx + 1}.xml'] = part_path
+                logging.info(f"Planilha {sheet_name} reaproveitada de conversão anterior")
+            else:
+                fingerprints[sheet_idx] = fingerprint
+                pending.append(sheet_idx)
+        
+        done = len(sheet_names) - len(pending)
+        if done:
+            conversion_progress[task_id].update({
+                'progress': 30 + (done * 60 / len(sheet_names)),
+                'message': f'{done} planilhas sem alteração reaproveitadas'
+            })
+        
+        # Linhas lidas por planilha, atualizadas pelos processos durante a conversão
+        rows_done = multiprocessing.RawArray('q', len(sheet_names))
+        rows_total = multiprocessing.RawArray('q', len(sheet_names))
+        
+        workers = max(1, min(config['XLSB_WORKERS'], len(pending)))
+        with timer.stage('render'), ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker_progress,
+            initargs=(rows_done, rows_total)
+        ) as executor:
+            futures = {
+                executor.submit(
+                    render_sheet_part, session.filepath, sheet_idx, sheet_names[sheet_idx],
+                    os.path.join(work_dir, f'sheet{sheet_idx + 1}.xml'),
+                    config['XLSX_WRITER']
+                ): sheet_idx
+                for sheet_idx in pending
+            }
+            
+            not_done = set(futures)
+            while not_done:
+                finished, not_done = wait(not_done, timeout=PROGRESS_UPDATE_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    sheet_idx = futures[future]
+                    sheet_name = sheet_names[sheet_idx]
+                    part_path = os.path.join(work_dir, f'sheet{sheet_idx + 1}.xml')
+                    try:
+                        row_count, cell_count = future.result()
+                        timer.rows += row_count
+                        timer.cells += cell_count
+                        parts[f'xl/worksheets/sheet{sheet_idx + 1}.xml'] = part_path
+                        logging.info(f"Planilha {sheet_name} processada com sucesso ({row_count} linhas)")
+                    except Exception as e:
+                        logging.error(f"Erro na planilha {sheet_name}: {e}")
+                        errors[sheet_idx] = e
+                    
+                    if sheet_idx not in errors and fingerprints[sheet_idx] and sheet_cache is not None:
+                        try:
+                            sheet_cache.put(fingerprints[sheet_idx], '.xml', part_path)
+                        except Exception as e:
+                            logging.warning(f"Erro ao guardar a planilha {sheet_name} no cache: {e}")
+                    done += 1
+                
+                # Planilhas concluídas contam inteiras; as em andamento, pelas linhas lidas
+                running = sum(
+                    min(rows_done[futures[future]] / rows_total[futures[future]], 1.0)
+                    for future in not_done if rows_total[futures[future]]
+                )
+                conversion_progress[task_id].update({
+                    'progress': 30 + ((done + running) * 60 / len(sheet_names)),
+                    'message': f'Processadas {done}/{len(sheet_names)} planilhas'
+                })
+        
+        conversion_progress[task_id].update({
+            'progress': 95,
+            'message': 'Salvando arquivo XLSX...'
+        })
+        
+        with timer.stage('save'):
+            if config['XLSX_WRITER'] == 'direct':
+                with XlsxDirectWriter(filepath_out) as writer:
+                    for sheet_idx, sheet_name in enumerate(sheet_names):
+                        part_path = parts.get(f'xl/worksheets/sheet{sheet_idx + 1}.xml')
+                        if part_path:
+                            writer.add_sheet_part(sheet_name, part_path)
+                        else:
+                            writer.add_sheet(sheet_name, [[f"Erro ao processar: {str(errors[sheet_idx])}"]])
+                return
+            
+            # Esqueleto com todas as planilhas; as que falharam recebem o aviso de erro
+            wb_out = Workbook(write_only=True)
+            build_style_table(wb_out)
+            for sheet_idx, sheet_name in enumerate(sheet_names):
+                ws_out = wb_out.create_sheet(title=sheet_name[:31])
+                if sheet_idx in errors:
+                    ws_out.append([f"Erro ao processar: {str(errors[sheet_idx])}"])
+            
+            skeleton_path = os.path.join(work_dir, 'skeleton.xlsx')
+            wb_out.save(skeleton_path)
+            assemble_xlsx_parts(skeleton_path, parts, filepath_out)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+# Motores disponíveis para a conversão XLSB -> XLSX (ver XLSB_ENGINE)
+XLSB_ENGINES = {
+    'pandas': convert_xlsb_pandas,
+    'streaming': convert_xlsb_streaming,
+    'parallel': convert_xlsb_parallel
+}
+
+def convert_xlsb_to_xlsx_advanced(filepath_in, filepath_out, task_id, engine=None):
+    """Conversão avançada que preserva dados e estrutura"""
+    session = None
+    timer = StageTimer()
+    try:
+        logging.info(f"Iniciando conversão avançada: {filepath_in} -> {filepath_out}")
+        
+        start_progress(task_id, 'Iniciando conversão...')
+        
+        # Verificar se arquivo existe
+        if not os.path.exists(filepath_in):
+            raise FileNotFoundError(f"Arquivo não encontrado: {filepath_in}")
+        
+        engine = engine or config['XLSB_ENGINE']
+        if engine not in XLSB_ENGINES:
+            raise ValueError(f"Motor de conversão desconhecido: {engine}")
+        
+        file_size = os.path.getsize(filepath_in)
+        conversion_progress[task_id].update({
+            'progress': 10,
+            'message': f'Arquivo carregado ({file_size / 1024 / 1024:.1f} MB)'
+        })
+        
+        conversion_progress[task_id].update({
+            'progress': 20,
+            'message': 'Lendo estrutura do arquivo XLSB...'
+        })
+        
+        # Abrir o XLSB uma única vez para o método principal e o fallback
+        with timer.stage('open'):
+            session = XlsbSession(filepath_in)
+        
+        # Método 1: motor selecionado (pandas, streaming ou parallel)
+        try:
+            XLSB_ENGINES[engine](session, filepath_out, task_id, timer)
+            
+            # Verificar se arquivo foi criado
+            if os.path.exists(filepath_out):
+                output_size = os.path.getsize(filepath_out)
+                conversion_progress[task_id].update({
+                    'progress': 100,
+                    'message': f'Conversão concluída! ({output_size / 1024 / 1024:.1f} MB)',
+                    'status': 'completo',
+                    'filename': os.path.basename(filepath_out),
+                    'end_time': datetime.now().isoformat()
+                })
+                logging.info(f"Conversão bem-sucedida ({engine}): {filepath_out}")
+            else:
+                raise Exception("Arquivo de saída não foi criado")
+                
+        except Exception as e:
+            logging.error(f"Erro no método principal: {e}")
+            
+            # Método 2: Fallback simples
+            conversion_progress[task_id].update({
+                'progress': 50,
+                'message': 'Usando método alternativo...'
+            })
+            
+            try:
+                with timer.stage('fallback'), pd.ExcelWriter(filepath_out, engine='openpyxl') as writer:
+                    for i, sheet_name in enumerate(session.sheet_names):
+                        df = session.read_dataframe(sheet_name)
+                        df.to_excel(writer, sheet_name=sheet_name, index=False)
+                
+                conversion_progress[task_id].update({
+                    'progress': 100,
+                    'message': 'Conversão concluída (método simples)',
+                    'status': 'completo', 
+                    'fallback': True,
+                    'filename': os.path.basename(filepath_out),
+                    'end_time': datetime.now().isoformat()
+                })
+                
+            except Exception as fallback_error:
+                raise Exception(f"Todos os métodos falharam: {str(e)} -> {str(fallback_error)}")
+        
+    except Exception as e:
+        error_msg = f"Erro na conversão: {str(e)}"
+        logging.error(error_msg)
+        conversion_progress[task_id].update({
+            'status': 'erro',
+            'message': error_msg,
+            'error': str(e),
+            'end_time': datetime.now().isoformat()
+        })
+    finally:
+        if session is not None:
+            session.close()
+        record_conversion_metrics(task_id, 'xlsb_to_xlsx', timer)
+
+class ResultCache:
+    """Cache em disco dos arquivos convertidos, endereçado pelo conteúdo da entrada.
+    
+    A chave combina o SHA-256 dos bytes de entrada, o tipo de conversão, as
+    opções que alteram a saída e CONVERTER_VERSION. O índice em memória
+    guarda a ordem de uso (LRU) e o tamanho total, limitado a max_bytes; ao
+    iniciar, é reconstruído a partir da data de modificação dos arquivos.
+    """
+    
+    def __init__(self, folder, max_bytes):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # nome do arquivo -> tamanho em bytes
+        self._total_bytes = 0
+        self._load()
+    
+    def _load(self):
+        files = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if name.endswith('.tmp') or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, name, stat.st_size))
+        
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._total_bytes += size
+    
+    @staticmethod
+    def make_key(filepath, conversion_type, variant=''):
+        """Chave do cache para o arquivo de entrada e o tipo de conversão"""
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        digest.update(f'|{conversion_type}|{variant}|{CONVERTER_VERSION}'.encode('utf-8'))
+        return digest.hexdigest()
+    
+    def get(self, key, extension, filepath_out):
+        """Copia o resultado em cache para filepath_out; devolve False se não houver"""
+        name = key + extension
+        path = os.path.join(self.folder, name)
+        with self._lock:
+            if name not in self._entries:
+                self.misses += 1
+                return False
+            
+            try:
+                shutil.copyfile(path, filepath_out)
+                os.utime(path)
+            except OSError as e:
+                logging.warning(f"Entrada do cache indisponível ({name}): {e}")
+                self._total_bytes -= self._entries.pop(name)
+                self.misses += 1
+                return False
+            
+            self._entries.move_to_end(name)
+            self.hits += 1
+            return True
+    
+    def put(self, key, extension, filepath):
+        """Guarda uma cópia do resultado e remove as entradas menos usadas além do limite"""
+        size = os.path.getsize(filepath)
+        if size > self.max_bytes:
+            return
+        
+        name = key + extension
+        path = os.path.join(self.folder, name)
+        tmp_path = path + '.tmp'
+        shutil.copyfile(filepath, tmp_path)
+        
+        with self._lock:
+            os.replace(tmp_path, path)
+            if name in self._entries:
+                self._total_bytes -= self._entries[name]
+            self._entries[name] = size
+            self._entries.move_to_end(name)
+            self._total_bytes += size
+            
+            while self._total_bytes > self.max_bytes and self._entries:
+                old_name, old_size = self._entries.popitem(last=False)
+                self._total_bytes -= old_size
+                try:
+                    os.remove(os.path.join(self.folder, old_name))
+                except OSError as e:
+                    logging.warning(f"Erro ao remover entrada do cache ({old_name}): {e}")
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'size_bytes': self._total_bytes,
+                'max_bytes': self.max_bytes
+            }
+
+# Conversões disponíveis: tipo -> (função, extensão de saída)
+CONVERSIONS = {
+    'xlsb_to_xlsx': (convert_xlsb_to_xlsx_advanced, '.xlsx'),
+    'ofx_to_xlsx': (convert_ofx_to_xlsx, '.xlsx'),
+    'pdf_to_ofx': (convert_pdf_to_ofx, '.ofx')
+}
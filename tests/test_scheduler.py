@@ -0,0 +1,68 @@
+"""Fila de conversões (ConversionScheduler) com um conversor de verdade.
+
+Uso:
+    python -m unittest discover tests
+"""
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import synthetic
+
+class QueueWaitTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # O app grava logs/, uploads/ e cache/ na pasta atual
+        cls.work_dir = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(cls.work_dir.cleanup)
+        cls.previous_dir = os.getcwd()
+        cls.addClassCleanup(os.chdir, cls.previous_dir)
+        os.chdir(cls.work_dir.name)
+        os.makedirs('logs')
+        os.environ['JANITOR_INTERVAL'] = '0'
+        os.environ['PROGRESS_BACKEND'] = 'memory'
+        import app
+        cls.app = app
+        logging.disable(logging.INFO)
+        cls.addClassCleanup(logging.disable, logging.NOTSET)
+
+    def wait_final(self, task_id, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            progress = self.app.conversion_progress.get(task_id, {})
+            if progress.get('status') in self.app.FINAL_STATUSES:
+                return progress
+            time.sleep(0.05)
+        self.fail(f'Tarefa {task_id} não terminou em {timeout}s')
+
+    def test_queue_wait_survives_conversion(self):
+        app = self.app
+        path_in = os.path.join(self.work_dir.name, 'extrato.ofx')
+        path_out = os.path.join(self.work_dir.name, 'extrato.xlsx')
+        synthetic.generate_ofx(path_in, 50)
+
+        # Um único worker, ocupado pela primeira tarefa até release
+        scheduler = app.ConversionScheduler(1, 10)
+        release = threading.Event()
+        app.conversion_progress['bloqueio'] = {'status': 'na_fila'}
+        app.conversion_progress['ofx'] = {'status': 'na_fila', 'upload_files': ['extrato.ofx', 'extrato.xlsx']}
+        scheduler.submit('bloqueio', 'teste', release.wait, ())
+        scheduler.submit('ofx', 'ofx_to_xlsx', app.convert_ofx_to_xlsx, (path_in, path_out, 'ofx'))
+        time.sleep(0.3)
+        release.set()
+
+        progress = self.wait_final('ofx')
+        self.assertEqual(progress['status'], 'completo')
+        self.assertGreaterEqual(progress.get('queue_wait', 0), 0.3)
+        self.assertEqual(progress['upload_files'], ['extrato.ofx', 'extrato.xlsx'])
+
+if __name__ == '__main__':
+    unittest.main()